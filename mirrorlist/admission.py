@@ -0,0 +1,50 @@
+# Licensed under the MIT/X11 license
+
+# Admission control for mirrorlist_server.py: at most a fixed number of
+# requests (or connections) are let in at once. Under a burst the others
+# wait a little for their turn and are turned away after that, instead
+# of all of them slowing down together.
+
+import threading
+import time
+
+# enter() results
+ADMITTED = 1
+# there was no room right away: the server is overloaded, so the caller
+# should keep its work cheap
+QUEUED = 2
+
+
+class Admission(object):
+    """ Lets at most limit callers in at once; the others wait up to wait
+    seconds for their turn. """
+
+    def __init__(self, limit, wait):
+        self.limit = limit
+        self.wait = wait
+        self.active = 0
+        self.turn = threading.Condition(threading.Lock())
+
+    def enter(self, wait=None):
+        """ Returns ADMITTED or QUEUED, or None if there still was no room
+        after waiting wait seconds (default: the wait of the instance).
+        Every admitted caller has to leave() again. """
+        with self.turn:
+            if self.active < self.limit:
+                self.active += 1
+                return ADMITTED
+            if wait is None:
+                wait = self.wait
+            deadline = time.time() + wait
+            while self.active >= self.limit:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.turn.wait(remaining)
+            self.active += 1
+            return QUEUED
+
+    def leave(self):
+        with self.turn:
+            self.active -= 1
+            self.turn.notify()
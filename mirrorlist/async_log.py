@@ -0,0 +1,150 @@
+# Licensed under the MIT/X11 license
+
+# Access logging for mirrorlist_server.py off the request path.
+#
+# The request threads only append their messages to a bounded buffer.
+# A background thread writes them out in batches: the access log lines
+# with a single write() per batch on a file opened with O_APPEND, so the
+# batches of several worker processes never interleave within a line,
+# and the syslog messages through the given logger. When the buffer is
+# full, because the disk or syslog cannot keep up, messages are dropped
+# and counted instead of blocking the requests.
+
+from collections import deque
+import os
+import sys
+import threading
+
+
+class AsyncLog(object):
+    """ Buffers access log lines (for the file at path, if any) and
+    syslog messages (for syslogger, if any) and writes them from a
+    background thread once start() was called; until then they are
+    written right away. """
+
+    def __init__(self, path=None, syslogger=None, size=10000,
+                 interval=1.0, batch=256):
+        self.path = path
+        self.syslogger = syslogger
+        self.size = size
+        self.interval = interval
+        self.batch = batch
+        self.fd = None
+        if path is not None:
+            self.fd = self.open()
+        self.dropped = 0
+        self.reported = 0
+        self.reopen_requested = False
+        self.thread = None
+        self.reset()
+
+    def open(self):
+        return os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                       0o644)
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.buffer = deque()
+        self.stopping = False
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def after_fork(self):
+        """ Starts over in a forked child: the lock may have been held by
+        a thread of the parent, and the parent's writer thread and its
+        pending messages are not the child's. """
+        self.reset()
+        self.start()
+
+    def log(self, message):
+        self.add((False, message))
+
+    def syslog(self, message):
+        self.add((True, message))
+
+    def add(self, entry):
+        if self.thread is None:
+            self.write([entry])
+            return
+        with self.lock:
+            if len(self.buffer) >= self.size:
+                self.dropped += 1
+                return
+            self.buffer.append(entry)
+            if len(self.buffer) == self.batch:
+                self.wakeup.notify()
+
+    def reopen(self):
+        """ Reopens the access log after logrotate moved it away. Only
+        sets a flag while the writer thread runs, so it can be called
+        from a signal handler. """
+        if self.thread is None:
+            self.reopen_file()
+        else:
+            self.reopen_requested = True
+            # the writer picks it up with its next batch at the latest
+
+    def reopen_file(self):
+        self.reopen_requested = False
+        if self.path is None:
+            return
+        fd = self.fd
+        self.fd = self.open()
+        if fd is not None:
+            os.close(fd)
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.buffer and not self.stopping:
+                    self.wakeup.wait(self.interval)
+                entries = self.buffer
+                self.buffer = deque()
+                stopping = self.stopping
+            self.write(entries)
+            if stopping:
+                return
+
+    def write(self, entries):
+        if self.reopen_requested:
+            try:
+                self.reopen_file()
+            except (IOError, OSError) as e:
+                sys.stderr.write("cannot reopen %s: %s\n" % (self.path, e))
+                sys.stderr.flush()
+        lines = []
+        for is_syslog, message in entries:
+            if not is_syslog:
+                lines.append(message)
+            elif self.syslogger is not None:
+                self.syslogger.info(message)
+        if lines and self.fd is not None:
+            data = ''.join(lines)
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            try:
+                while data:
+                    data = data[os.write(self.fd, data):]
+            except (IOError, OSError):
+                self.dropped += len(lines)
+        if self.dropped != self.reported:
+            sys.stderr.write(
+                "dropped %d log messages\n" % (self.dropped - self.reported))
+            sys.stderr.flush()
+            self.reported = self.dropped
+
+    def close(self):
+        """ Writes what is left and stops the writer thread. """
+        if self.thread is not None:
+            with self.lock:
+                self.stopping = True
+                self.wakeup.notify()
+            self.thread.join()
+            self.thread = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
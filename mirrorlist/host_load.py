@@ -0,0 +1,110 @@
+# Licensed under the MIT/X11 license
+
+# Load-aware weights for the weighted shuffle of mirrorlist_server.py.
+#
+# Every process counts how often it sent clients to each host (the first
+# host of an answer) during a sliding window, in one plain array per
+# bucket of the window, indexed by host id. The counters are not locked:
+# they are only approximate anyway. A count is the sum of the buckets
+# in the window, read when it is asked for, so a race can only lose an
+# increment: one made to a bucket which was just expired. Nothing is kept
+# that a race could leave stale.
+#
+# A host gets a budget of answers per window proportional to its declared
+# bandwidth; every answer uses up as many connections as the host allows
+# each client (max_connections). The closer a host gets to its budget,
+# the lower its weight in the shuffle.
+
+from array import array
+import time
+
+from weighted_shuffle import clamp_weight
+
+
+class LoadCounter(object):
+    """ Counts events per host id over the last window seconds, in
+    buckets of window / buckets seconds. """
+
+    def __init__(self, window, size, buckets=6):
+        self.window = window
+        self.size = size
+        self.buckets = buckets
+        self.bucket_length = float(window) / buckets
+        self.counts = [self.zeros() for i in range(buckets)]
+        self.epochs = [None] * buckets
+        self.epoch = None
+
+    def zeros(self):
+        return array('l', [0]) * self.size
+
+    def grow(self, size):
+        """ Makes room for host ids below size, keeping the counts. """
+        if size <= self.size:
+            return
+        extra = array('l', [0]) * (size - self.size)
+        for counts in self.counts:
+            counts.extend(extra)
+        self.size = size
+
+    def bucket(self, now=None):
+        if now is None:
+            now = time.time()
+        epoch = int(now / self.bucket_length)
+        if epoch != self.epoch:
+            # forget the buckets which fell out of the window, also the
+            # ones skipped while nothing was counted
+            self.epoch = epoch
+            for i, bucket_epoch in enumerate(self.epochs):
+                if bucket_epoch is not None and \
+                        bucket_epoch <= epoch - self.buckets:
+                    self.expire(i)
+        i = epoch % self.buckets
+        if self.epochs[i] != epoch:
+            self.expire(i)
+            self.epochs[i] = epoch
+        return self.counts[i]
+
+    def expire(self, i):
+        self.counts[i] = self.zeros()
+        self.epochs[i] = None
+
+    def add(self, hostid, now=None):
+        if 0 <= hostid < self.size:
+            counts = self.bucket(now)
+            # a bucket expired while grow() ran may still be short
+            if hostid < len(counts):
+                counts[hostid] += 1
+
+    def count(self, hostid, now=None):
+        if not 0 <= hostid < self.size:
+            return 0
+        # expire what is older than the window before reading
+        self.bucket(now)
+        return sum(
+            counts[hostid] for counts in self.counts
+            if hostid < len(counts))
+
+
+class LoadAwareWeights(object):
+    """ The bandwidth weights of the hosts, lowered for hosts which are
+    using up their budget of capacity * bandwidth connections per window.
+    Usable as the weights of weighted_order(). """
+
+    # weights are integers, keep some resolution for the lowered ones
+    scale = 100
+
+    def __init__(self, bandwidth, max_connections, load, capacity):
+        self.bandwidth = bandwidth
+        self.max_connections = max_connections
+        self.load = load
+        self.capacity = capacity
+        self.now = time.time()
+
+    def __getitem__(self, hostid):
+        weight = clamp_weight(self.bandwidth.get(hostid))
+        budget = self.capacity * weight
+        used = self.load.count(hostid, self.now) * \
+            clamp_weight(self.max_connections.get(hostid))
+        if used >= budget:
+            return 1
+        return max(1, int(self.scale * weight * (budget - used) / budget))
@@ -0,0 +1,145 @@
+# Licensed under the MIT/X11 license
+
+# Compact representation of the host id sets of the mirrorlist_cache.
+#
+# Every directory of the cache holds a set of host ids per country and
+# a list of hcurl ids per host. With tens of thousands of directories
+# most of them are equal, so mirrorlist_server.py keeps them as sorted
+# array('i') vectors, hands out one shared instance for equal vectors,
+# country maps and strings, and does the few set operations it needs
+# on the sorted vectors. Nothing must modify a vector once it has been
+# handed out.
+
+from array import array
+from bisect import bisect_left
+import heapq
+import struct
+import sys
+
+empty = array('i')
+
+
+def unpack_vector(buf, offset):
+    """ Reads a vector packed as a little-endian count followed by the
+    sorted values. Returns (vector, offset after the vector). """
+    (n,) = struct.unpack_from('<I', buf, offset)
+    start = offset + 4
+    end = start + 4 * n
+    v = array('i')
+    frombytes(v, buf[start:end])
+    if sys.byteorder == 'big':
+        v.byteswap()
+    return v, end
+
+
+def frombytes(a, data):
+    # array.fromstring() is called frombytes() since python 3.2
+    if hasattr(a, 'frombytes'):
+        a.frombytes(bytes(data))
+    else:
+        a.fromstring(bytes(data))
+
+
+def contains(v, hostid):
+    """ Tells whether the sorted vector v contains hostid. """
+    i = bisect_left(v, hostid)
+    return i < len(v) and v[i] == hostid
+
+
+def union(vectors):
+    """ Returns the sorted union of the sorted vectors. """
+    vectors = [v for v in vectors if len(v) > 0]
+    if len(vectors) == 0:
+        return empty
+    if len(vectors) == 1:
+        return vectors[0]
+    result = array('i')
+    last = None
+    for hostid in heapq.merge(*vectors):
+        if hostid != last:
+            result.append(hostid)
+            last = hostid
+    return result
+
+
+def select(v, keep):
+    """ Returns the vector of the host ids in v for which keep(hostid)
+    is true, v itself if that is all of them. """
+    result = array('i', [hostid for hostid in v if keep(hostid)])
+    if len(result) == len(v):
+        return v
+    return result
+
+
+class Interner(object):
+    """ Converts mirrorlist_cache entries into their compact form and
+    shares equal vectors, maps and strings between all entries converted
+    by the same instance. """
+
+    def __init__(self):
+        self.atoms = {}
+        self.vectors = {}
+        self.maps = {}
+        # subcaches which are already shared in the source (shrink()
+        # does that and pickle keeps it) are only converted once
+        self.converted = {}
+
+    def atom(self, value):
+        """ Returns the shared instance of a string or integer. """
+        return self.atoms.setdefault(value, value)
+
+    def vector(self, values, ordered=False):
+        """ Returns the shared vector of values; they get sorted unless
+        their order matters (ordered). """
+        if not ordered:
+            values = sorted(values)
+        key = tuple(values)
+        v = self.vectors.get(key)
+        if v is None:
+            if len(key) == 0:
+                v = empty
+            else:
+                v = array('i', key)
+            self.vectors[key] = v
+        return v
+
+    def _converted(self, source, convert):
+        try:
+            original, result = self.converted[id(source)]
+            if original is source:
+                return result
+        except KeyError:
+            pass
+        result = convert(source)
+        self.converted[id(source)] = (source, result)
+        return result
+
+    def _map(self, d, ordered):
+        m = dict(
+            (self.atom(key), self.vector(values, ordered))
+            for key, values in d.items())
+        # the vectors are shared already, so their ids identify them
+        key = (ordered, tuple(sorted(
+            (k, id(v)) for k, v in m.items())))
+        return self.maps.setdefault(key, m)
+
+    def map(self, d, ordered=False):
+        """ Returns the shared {key: vector} version of a dict of host
+        id sets ({country: set(hostid)}) or, if ordered is set, of hcurl
+        id lists ({hostid: [hcurl id]}). """
+        return self._converted(d, lambda d: self._map(d, ordered))
+
+    def directory(self, c):
+        """ Returns the compact version of a mirrorlist_cache entry. """
+        compact = dict(c)
+        compact['global'] = self._converted(c['global'], self.vector)
+        compact['byCountry'] = self.map(c['byCountry'])
+        compact['byCountryInternet2'] = self.map(c['byCountryInternet2'])
+        compact['byHostId'] = self.map(c['byHostId'], ordered=True)
+        if compact.get('subpath') is not None:
+            compact['subpath'] = self.atom(compact['subpath'])
+        return compact
+
+    def countries(self, countries):
+        """ Returns a frozenset of shared country strings. """
+        return frozenset(self.atom(c) for c in countries)
@@ -0,0 +1,195 @@
+# Licensed under the MIT/X11 license
+
+# An HTTP listener for mirrorlist_server.py, so that mirrorlist and
+# metalink requests can be answered by the server directly, without
+# apache, mod_wsgi and mirrorlist_client.wsgi in between. It speaks
+# just enough HTTP/1.1 (GET and HEAD, keep-alive) for a reverse proxy
+# or load balancer in front of it. The connections are handled by an
+# asyncio event loop, the requests are answered by a pool of threads.
+# Requires python 3.6 or later.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import sys
+import threading
+from urllib.parse import parse_qsl, urlsplit
+
+import mirrorlist_protocol
+
+max_header_size = 16384
+
+reasons = {
+    200: 'OK',
+    302: 'Found',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    431: 'Request Header Fields Too Large',
+    503: 'Service Unavailable',
+}
+
+
+def parse_request_head(head):
+    """ Returns method, target, version and a dict of the headers (with
+    lower case names) of an HTTP request. Raises ValueError if the
+    request is malformed. """
+    lines = head.decode('iso-8859-1').split('\r\n')
+    method, target, version = lines[0].split(' ')
+    if not version.startswith('HTTP/1.'):
+        raise ValueError('unsupported HTTP version %s' % version)
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, value = line.split(':', 1)
+        name = name.strip().lower()
+        value = value.strip()
+        if name in headers:
+            # repeated headers are equivalent to one comma separated one
+            value = headers[name] + ', ' + value
+        headers[name] = value
+    return method, target, version, headers
+
+
+def keep_alive(version, headers):
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.0':
+        return connection == 'keep-alive'
+    return connection != 'close'
+
+
+def format_response(status, headers, body, keep, head_only=False):
+    lines = ['HTTP/1.1 %d %s' % (status, reasons.get(status, ''))]
+    for name, value in headers:
+        lines.append('%s: %s' % (name, value))
+    lines.append('Content-Length: %d' % len(body))
+    if keep:
+        lines.append('Connection: keep-alive')
+    else:
+        lines.append('Connection: close')
+    lines.append('')
+    lines.append('')
+    data = '\r\n'.join(lines).encode('iso-8859-1')
+    if head_only:
+        return data
+    return data + body
+
+
+class HTTPListener(object):
+    """ Serves HTTP on the listening socket sock from an asyncio event
+    loop in its own thread. answer(d) returns the do_mirrorlist()
+    result for a request dict; it is called by one of threads threads,
+    so up to that many requests are answered at once and the event loop
+    never waits for an answer. must_die() tells when to stop accepting
+    connections; requests in flight are finished before the thread
+    exits. """
+
+    def __init__(self, sock, answer, must_die, trust_forwarded_for=True,
+                 idle_timeout=60, threads=16):
+        self.sock = sock
+        self.answer = answer
+        self.must_die = must_die
+        self.trust_forwarded_for = trust_forwarded_for
+        self.idle_timeout = idle_timeout
+        self.threads = threads
+        self.executor = None
+        self.idle = set()
+        # a future per connection, done once the connection is closed
+        self.connections = set()
+        self.thread = None
+
+    def start(self):
+        # not a daemon thread: a draining worker waits for it
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(self.threads)
+        try:
+            loop.run_until_complete(self.serve())
+        finally:
+            loop.close()
+            self.executor.shutdown()
+
+    async def serve(self):
+        server = await asyncio.start_server(
+            self.handle_connection, sock=self.sock,
+            limit=max_header_size)
+        while not self.must_die():
+            await asyncio.sleep(0.5)
+        server.close()
+        # idle keep-alive connections are closed right away, the others
+        # once their current request has been answered
+        for writer in list(self.idle):
+            writer.close()
+        if self.connections:
+            await asyncio.wait(list(self.connections))
+
+    async def request(self, method, target, version, headers, peer):
+        if method not in ('GET', 'HEAD'):
+            return 405, [('Allow', 'GET, HEAD')], b''
+        url = urlsplit(target)
+        if url.path.endswith('/metalink'):
+            metalink = True
+        elif url.path.endswith('/mirrorlist'):
+            metalink = False
+        else:
+            return 404, [], b''
+        # like webob, the last occurrence of a parameter wins
+        query = dict(parse_qsl(url.query, keep_blank_values=True))
+        xforwardedfor = None
+        if self.trust_forwarded_for:
+            xforwardedfor = headers.get('x-forwarded-for')
+        d = mirrorlist_protocol.request_setup(
+            query, peer, xforwardedfor, metalink)
+        loop = asyncio.get_event_loop()
+        try:
+            r = await loop.run_in_executor(self.executor, self.answer, d)
+        except Exception:
+            return 503, [], b''
+        return mirrorlist_protocol.http_response(r, 'redirect' in query)
+
+    async def handle_connection(self, reader, writer):
+        closed = asyncio.get_event_loop().create_future()
+        self.connections.add(closed)
+        peer = writer.get_extra_info('peername')
+        if isinstance(peer, tuple):
+            peer = peer[0]
+        try:
+            while not self.must_die():
+                self.idle.add(writer)
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b'\r\n\r\n'), self.idle_timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break
+                except asyncio.LimitOverrunError:
+                    writer.write(format_response(431, [], b'', False))
+                    break
+                finally:
+                    self.idle.discard(writer)
+                try:
+                    method, target, version, headers = \
+                        parse_request_head(head)
+                except ValueError:
+                    writer.write(format_response(400, [], b'', False))
+                    break
+                keep = keep_alive(version, headers) and not self.must_die()
+                status, headers, body = await self.request(
+                    method, target, version, headers, peer)
+                writer.write(format_response(
+                    status, headers, body, keep, method == 'HEAD'))
+                await writer.drain()
+                if not keep:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        except Exception:
+            sys.stderr.write('HTTP connection error: %s\n' % (
+                sys.exc_info()[1],))
+            sys.stderr.flush()
+        finally:
+            writer.close()
+            self.connections.discard(closed)
+            closed.set_result(None)
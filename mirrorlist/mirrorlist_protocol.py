@@ -0,0 +1,218 @@
+# Licensed under the MIT/X11 license
+
+# The wire protocol between mirrorlist_client.wsgi and
+# mirrorlist_server.py: MirrorListRequest and MirrorListResponse
+# protobuf messages from mirrormanager.proto, each one preceded by its
+# length as a 4 byte unsigned big-endian integer. A connection can carry
+# any number of requests; the server answers them in order.
+#
+# It also holds the mapping between HTTP requests and answers and the
+# request dicts and answers of do_mirrorlist(), which is shared by
+# mirrorlist_client.wsgi and the HTTP listener of mirrorlist_server.py.
+
+import struct
+
+import mirrormanager_pb2
+
+header = struct.Struct('!I')
+
+# the returncode of the answers of an overloaded server, and how many
+# seconds HTTP clients are asked to wait before trying again
+BUSY = 503
+busy_retry_after = 5
+
+
+def recv_exactly(sock, size, eof_ok=False):
+    """ Reads exactly size bytes from sock into a preallocated buffer.
+    Returns None if the peer closed the connection before sending
+    anything and eof_ok is set. """
+    buf = bytearray(size)
+    view = memoryview(buf)
+    pos = 0
+    while pos < size:
+        received = sock.recv_into(view[pos:], size - pos)
+        if received == 0:
+            if pos == 0 and eof_ok:
+                return None
+            raise EOFError('connection closed in the middle of a message')
+        pos += received
+    return bytes(buf)
+
+
+def recv_message(sock, message_class, max_size=None):
+    """ Reads one message of type message_class from sock. Returns None
+    if the peer closed the connection between two messages. """
+    data = recv_exactly(sock, header.size, eof_ok=True)
+    if data is None:
+        return None
+    (size,) = header.unpack(data)
+    if max_size is not None and size > max_size:
+        raise ValueError('message of %d bytes is too large' % size)
+    message = message_class()
+    message.ParseFromString(recv_exactly(sock, size))
+    return message
+
+
+def send_message(sock, message):
+    data = message.SerializeToString()
+    sock.sendall(header.pack(len(data)) + data)
+
+
+def encode_request(d):
+    request = mirrormanager_pb2.MirrorListRequest()
+    for key, value in d.items():
+        if key == 'metalink':
+            request.Metalink = bool(value)
+            continue
+        param = request.Params.add()
+        param.key = key
+        param.value = value
+    return request
+
+
+def decode_request(request):
+    d = dict((param.key, param.value) for param in request.Params)
+    d['metalink'] = request.Metalink
+    return d
+
+
+def encode_response(r):
+    response = mirrormanager_pb2.MirrorListResponse()
+    response.ReturnCode = r['returncode']
+    response.ResultType = r['resulttype']
+    if r['message'] is not None:
+        response.Message = r['message']
+    results = r['results']
+    if isinstance(results, (list, tuple)):
+        # [(hostid, [url, url]), ...]
+        for (hostid, urls) in results:
+            result = response.Results.add()
+            result.key = hostid
+            result.value.extend(urls)
+    else:
+        # a metalink XML document, metalink() already returns it encoded
+        if not isinstance(results, bytes):
+            results = results.encode('utf-8')
+        response.Document = results
+    return response
+
+
+def decode_response(response):
+    """ Returns the same dict do_mirrorlist() returned on the server side,
+    except that documents are returned as UTF-8 encoded bytes. """
+    if response.HasField('Document'):
+        results = response.Document
+    else:
+        results = [
+            (result.key, list(result.value)) for result in response.Results]
+    message = None
+    if response.HasField('Message'):
+        message = response.Message
+    return dict(
+        returncode=response.ReturnCode,
+        resulttype=response.ResultType,
+        message=message,
+        results=results)
+
+
+def real_client_ip(xforwardedfor):
+    """Only the last-most entry listed is the where the client
+    connection to us came from, so that's the only one we can trust in
+    any way."""
+    return xforwardedfor.split(',')[-1].strip()
+
+
+def request_setup(request_data, remote_addr, xforwardedfor=None,
+                  metalink=False):
+    """ Builds the do_mirrorlist() request from the query parameters
+    in request_data. xforwardedfor is the X-Forwarded-For header, if
+    there is one and it is to be trusted. """
+    fields = [
+        'repo', 'arch', 'country', 'path', 'netblock', 'location',
+        'version', 'cc', 'protocol', 'time'
+    ]
+    d = {}
+    for f in fields:
+        if f in request_data:
+            d[f] = request_data[f].strip()
+            # add back '+' that were converted to ' ' by util.FieldStorage
+            if f == 'path':
+                d[f] = d[f].replace(' ', '+')
+
+    if 'ip' in request_data:
+        client_ip = request_data['ip'].strip()
+    elif xforwardedfor is not None:
+        client_ip = real_client_ip(xforwardedfor.strip())
+    else:
+        client_ip = remote_addr
+    d['client_ip'] = client_ip
+
+    # convert cc to country (for CentOS)
+    if 'cc' in d and 'country' not in d:
+        d['country'] = d['cc']
+        del d['cc']
+
+    # convert version=&repo=& to repo=<repo>-<version> (for CentOS)
+    if 'version' in d and 'repo' in d:
+        d['repo'] = "%s-%s" % (d['repo'], d['version'])
+        del d['version']
+
+    d['metalink'] = metalink
+
+    for k, v in d.items():
+        try:
+            d[k] = unicode(v, 'utf8', 'replace')
+        except:
+            pass
+    return d
+
+
+def get_first_http_url(input):
+    """ Only used for the redirect case. In the case
+    a redirect has been requested only the first URL
+    is returned starting with 'http'."""
+    for hostid, url in input:
+        for u in url:
+            if u.startswith(u'http'):
+                return u
+    return None
+
+
+def http_response(r, redirect=False):
+    """ Turns an answer of do_mirrorlist() into the HTTP status code,
+    a list of (header, value) tuples and the body. """
+    message = r['message']
+    resulttype = r['resulttype']
+    results = r['results']
+    status = 200
+    headers = []
+    if r.get('returncode') == BUSY:
+        status = BUSY
+        headers.append(('Retry-After', str(busy_retry_after)))
+
+    if resulttype == 'mirrorlist':
+        # results look like [(hostid, [url, url]), ...]
+        if redirect and status != BUSY:
+            url = None
+            if len(results) > 0:
+                url = get_first_http_url(results)
+            if url is None:
+                return 404, [], b''
+            return 302, [('Location', str(url))], b''
+
+        lines = [message]
+        lines.extend(url[0] for (hostid, url) in results)
+        lines.append('')
+        results = '\n'.join(lines)
+        content_type = "text/plain"
+    elif resulttype == 'metalink':
+        # results are an XML document
+        content_type = "application/metalink+xml"
+    else:
+        content_type = "text/plain"
+
+    if not isinstance(results, bytes):
+        # metalink documents arrive already encoded from the server
+        results = results.encode('utf-8')
+    headers.append(('Content-Type', content_type))
+    return status, headers, results
@@ -5,12 +5,17 @@
 # Licensed under the MIT/X11 license
 
 # standard library modules in alphabetical order
-from collections import defaultdict
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, OrderedDict
+import calendar
 import csv
 import datetime
+import gc
 import getopt
 import logging
 import logging.handlers
+import marshal
+import mmap
 import os
 import random
 try:
@@ -20,11 +25,12 @@ except ImportError:
 import select
 import signal
 import socket
+import struct
 try:
-    from socketserver import (StreamRequestHandler, ThreadingMixIn,
+    from socketserver import (BaseRequestHandler, ThreadingMixIn,
                               UnixStreamServer, BaseServer)
 except ImportError:
-    from SocketServer import (StreamRequestHandler, ThreadingMixIn,
+    from SocketServer import (BaseRequestHandler, ThreadingMixIn,
                               UnixStreamServer, BaseServer)
 import sys
 import time
@@ -39,13 +45,21 @@ except ImportError:
 from IPy import IP
 import geoip2.database
 import radix
-from weighted_shuffle import weighted_shuffle
+from weighted_shuffle import weighted_order
+import host_vectors
+from admission import Admission, QUEUED
+from async_log import AsyncLog
+from host_load import LoadCounter, LoadAwareWeights
+import server_stats
+from server_stats import null_clock
 import mirrormanager_pb2
+import mirrorlist_protocol
 
 # can be overridden on the command line
 pidfile = '/var/run/mirrormanager/mirrorlist_server.pid'
 socketfile = '/var/run/mirrormanager/mirrorlist_server.sock'
 cachefile = '/var/lib/mirrormanager/mirrorlist_cache.pkl'
+patchfile = '/var/lib/mirrormanager/mirrorlist_cache.patch'
 internet2_netblocks_file = '/var/lib/mirrormanager/i2_netblocks.txt'
 global_netblocks_file = '/var/lib/mirrormanager/global_netblocks.txt'
 country_continent_csv = '/usr/share/mirrormanager2/country_continent.csv'
@@ -53,7 +67,11 @@ logfile = None
 # If not at least 'minimum' mirrors are found for a country/continent,
 # mirrors from the global list are appended to the country/continent list
 minimum = int(5)
+# number of pre-forked worker processes, 0 serves from a single process
+workers = 0
 must_die = False
+reload_requested = False
+patch_requested = False
 # at a point in time when we're no longer serving content for versions
 # that don't use yum prioritymethod=fallback
 # (e.g. after Fedora 7 is past end-of-life)
@@ -62,6 +80,49 @@ must_die = False
 # for dirs which aren't repositories (such as iso/)
 # because we don't know the Version associated with that dir here.
 default_ordered_mirrorlist = False
+# number of precomputed answers (host candidates and the URLs of a
+# directory) kept per loaded cache
+answer_cache_size = 4096
+# number of directories whose file details (for metalinks) are kept
+# decoded, for the cache formats which decode them on demand, and of
+# rendered metalink files
+file_details_cache_size = 1024
+# number of directories kept decoded by the memory-mapped cache format
+directory_cache_size = 1024
+# client connections are kept open for further requests, but closed
+# after being idle for this many seconds
+connection_idle_timeout = 60
+# requests are a few short strings, anything larger is not a client
+max_request_size = 65536
+# host:port to serve mirrorlists and metalinks over HTTP on, if set
+http_address = None
+# set to False if no reverse proxy is in front of the HTTP listener
+http_trust_forwarded_for = True
+http_socket = None
+# answers per --load-window seconds a host may get per Mbit/s of its
+# bandwidth before its weight is lowered, 0 disables load-aware selection
+load_capacity = 0
+load_window = 60
+# unix socket the request statistics are served on, if set
+stats_socketfile = None
+stats = None
+stats_server = None
+# how long the last reload took, and how many there were
+cache_load_duration = None
+cache_loads = 0
+# supervisor only: the statistics slot of each worker process
+worker_slots = {}
+# requests answered at once per process, 0 for no limit; a request
+# which finds no free slot waits up to admission_wait seconds for one
+# and gets a degraded answer, without the netblock, ASN and Internet2
+# stages, or a busy answer if it still got none
+max_in_flight = 0
+admission_wait = 1.0
+in_flight = None
+# client connections served at once per process, 0 for no limit; at
+# the limit the process stops accepting, so further connections wait in
+# the listen backlog or are taken by another worker
+max_connections = 0
 
 # our own private copy of country_continents to be edited
 country_continents = {}
@@ -74,6 +135,10 @@ handler = logging.handlers.SysLogHandler(
     facility=logging.handlers.SysLogHandler.LOG_LOCAL4)
 syslogger.addHandler(handler)
 
+# the access log (-l) and the syslog messages of the requests, written by
+# a background thread once the server is running
+access_log = AsyncLog(syslogger=syslogger)
+
 # The entire in-memory structure
 database = {}
 
@@ -86,10 +151,68 @@ def read_country_continents():
     return local_country_continents
 
 
+class ClientIP(object):
+    """ The parts of IPy.IP the request path uses, for a single IPv4 or
+    IPv6 address. Parsing it with socket.inet_pton() is a lot cheaper
+    than IPy, and the normalized string radix and geoip want is built
+    once. """
+
+    __slots__ = ('_version', '_int', '_normal')
+
+    def __init__(self, version, value):
+        self._version = version
+        self._int = value
+        if version == 4:
+            self._normal = socket.inet_ntoa(struct.pack('!I', value))
+        else:
+            self._normal = ':'.join(
+                '%x' % ((value >> shift) & 0xffff)
+                for shift in range(112, -16, -16))
+
+    @classmethod
+    def parse(cls, address):
+        if ':' in address:
+            high, low = struct.unpack(
+                '!QQ', socket.inet_pton(socket.AF_INET6, address))
+            return cls(6, (high << 64) | low)
+        (value,) = struct.unpack(
+            '!I', socket.inet_pton(socket.AF_INET, address))
+        return cls(4, value)
+
+    def version(self):
+        return self._version
+
+    def int(self):
+        return self._int
+
+    def strNormal(self):
+        return self._normal
+
+    def __str__(self):
+        if self._version == 4:
+            return self._normal
+        return socket.inet_ntop(
+            socket.AF_INET6,
+            struct.pack('!QQ', self._int >> 64,
+                        self._int & 0xffffffffffffffff))
+
+
+def parse_ip(address):
+    """ Returns a ClientIP for a plain IPv4 or IPv6 address. Anything
+    else IPy accepts (abbreviated or integer addresses, prefixes) is
+    still handed to IPy. Raises ValueError if neither accepts it. """
+    try:
+        return ClientIP.parse(address)
+    except (socket.error, ValueError, TypeError):
+        return IP(address)
+
+
 def lookup_ip_asn(tree, ip):
-    """ @t is a radix tree
+    """ @t is a radix tree or a NetblockIndex
         @ip is an IPy.IP object which may be contained in an entry in l
         """
+    if isinstance(tree, NetblockIndex):
+        return tree.lookup_asn(ip.version(), ip.int())
     node = tree.search_best(ip.strNormal())
     if node is None:
         return None
@@ -113,17 +236,32 @@ def uniqueify(seq, idfun=None):
 
 ##### Metalink Support #####
 
-def metalink_header():
+# (second, text, UTF-8 bytes) of the last metalink header; its pubdate
+# only changes once a second
+last_metalink_header = (None, None, None)
+
+
+def metalink_header(encoded=False):
     # fixme add alternate format pubdate when specified
-    pubdate = datetime.datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT")
-    doc = ''
-    doc += '<?xml version="1.0" encoding="utf-8"?>\n'
-    doc += '<metalink version="3.0" xmlns="http://www.metalinker.org/"'
-    doc += ' type="dynamic"'
-    doc += ' pubdate="%s"' % pubdate
-    doc += ' generator="mirrormanager"'
-    doc += ' xmlns:mm0="http://fedorahosted.org/mirrormanager"'
-    doc += '>\n'
+    global last_metalink_header
+    now = int(time.time())
+    second, doc, data = last_metalink_header
+    if second != now:
+        pubdate = time.strftime(
+            "%a, %d %b %Y %H:%M:%S GMT", time.gmtime(now))
+        doc = ''.join([
+            '<?xml version="1.0" encoding="utf-8"?>\n',
+            '<metalink version="3.0" xmlns="http://www.metalinker.org/"',
+            ' type="dynamic"',
+            ' pubdate="%s"' % pubdate,
+            ' generator="mirrormanager"',
+            ' xmlns:mm0="http://fedorahosted.org/mirrormanager"',
+            '>\n',
+        ])
+        data = doc.encode('utf-8')
+        last_metalink_header = (now, doc, data)
+    if encoded:
+        return data
     return doc
 
 
@@ -142,53 +280,84 @@ def metalink_file_not_found(directory, file):
     return metalink_failuredoc(message)
 
 
-def metalink(cache, directory, file, hosts_and_urls):
-    preference = 100
+def indent(n):
+    return ' ' * n * 2
+
+
+def metalink_details(y, indentlevel=2):
+    parts = []
+    if y['timestamp'] is not None:
+        parts.append(indent(indentlevel+1)
+                     + '<mm0:timestamp>%s</mm0:timestamp>\n' % y['timestamp'])
+    if y['size'] is not None:
+        parts.append(indent(indentlevel+1) + '<size>%s</size>\n' % y['size'])
+    parts.append(indent(indentlevel+1) + '<verification>\n')
+    hashes = ('md5', 'sha1', 'sha256', 'sha512')
+    for h in hashes:
+        if y[h] is not None:
+            parts.append(indent(indentlevel+2)
+                         + '<hash type="%s">%s</hash>\n' % (h, y[h]))
+    parts.append(indent(indentlevel+1) + '</verification>\n')
+    return ''.join(parts)
+
+
+def metalink_file(db, directory, file):
+    """ Returns the part of the metalink for directory/file which is
+    the same for every client, from <files> to where the <resources>
+    start, as UTF-8 bytes. It is rendered once per loaded cache and kept
+    in the metalink cache. Returns None if there are no file details. """
+    key = (directory, file)
+    fragment = db['metalink_cache'].get(key)
+    if fragment is not None:
+        return fragment
     try:
-        fdc = database['file_details_cache'][directory]
+        fdc = db['file_details_cache'][directory]
         detailslist = fdc[file]
     except KeyError:
-        return ('metalink', 404, metalink_file_not_found(directory, file))
-
-    def indent(n):
-        return ' ' * n * 2
+        return None
 
-    doc = metalink_header()
-    doc += indent(1) + '<files>\n'
-    doc += indent(2) + '<file name="%s">\n' % (file)
-    y = detailslist[0]
-
-    def details(y, indentlevel=2):
-        doc = ''
-        if y['timestamp'] is not None:
-            doc += indent(indentlevel+1) \
-                + '<mm0:timestamp>%s</mm0:timestamp>\n' % y['timestamp']
-        if y['size'] is not None:
-            doc += indent(indentlevel+1) + '<size>%s</size>\n' % y['size']
-        doc += indent(indentlevel+1) + '<verification>\n'
-        hashes = ('md5', 'sha1', 'sha256', 'sha512')
-        for h in hashes:
-            if y[h] is not None:
-                doc += indent(indentlevel+2) \
-                    + '<hash type="%s">%s</hash>\n' % (h, y[h])
-        doc += indent(indentlevel+1) + '</verification>\n'
-        return doc
-
-    doc += details(y, 2)
+    parts = [
+        indent(1) + '<files>\n',
+        indent(2) + '<file name="%s">\n' % (file),
+        metalink_details(detailslist[0], 2),
+    ]
     # there can be multiple files
     if len(detailslist) > 1:
-        doc += indent(3) + '<mm0:alternates>\n'
+        parts.append(indent(3) + '<mm0:alternates>\n')
         for y in detailslist[1:]:
-            doc += indent(4) + '<mm0:alternate>\n'
-            doc += details(y,5)
-            doc += indent(4) + '</mm0:alternate>\n'
-        doc += indent(3) + '</mm0:alternates>\n'
+            parts.append(indent(4) + '<mm0:alternate>\n')
+            parts.append(metalink_details(y, 5))
+            parts.append(indent(4) + '</mm0:alternate>\n')
+        parts.append(indent(3) + '</mm0:alternates>\n')
+    fragment = ''.join(parts).encode('utf-8')
+    db['metalink_cache'].set(key, fragment)
+    return fragment
+
 
-    doc += indent(3) + '<resources maxconnections="1">\n'
+metalink_footer = (
+    indent(3) + '</resources>\n'
+    + indent(2) + '</file>\n'
+    + indent(1) + '</files>\n'
+    + '</metalink>\n')
+
+
+def metalink(cache, directory, file, hosts_and_urls):
+    """ Returns the metalink document for directory/file as UTF-8
+    bytes: the prebuilt parts with the <resources> of the hosts
+    spliced in. """
+    db = database
+    fragment = metalink_file(db, directory, file)
+    if fragment is None:
+        return ('metalink', 404, metalink_file_not_found(directory, file))
+
+    preference = 100
+    host_country_cache = db['host_country_cache']
+    parts = [indent(3) + '<resources maxconnections="1">\n']
     for (hostid, hcurls) in hosts_and_urls:
         private = ''
-        if hostid not in cache['global']:
+        if not host_vectors.contains(cache['global'], hostid):
             private = 'mm0:private="True"'
+        location = host_country_cache[hostid].upper()
         for url in hcurls:
             protocol = url.split(':')[0]
             # FIXME January 2010
@@ -197,35 +366,34 @@ def metalink(cache, directory, file, hosts_and_urls):
             # yum 3.2.20-3 as released in Fedora 8, 9, and 10.  After those
             # three are EOL (~January 2010), the extra protocol= can be
             # removed.
-            doc += indent(4) + \
-                '<url protocol="%s" type="%s" location="%s" '\
-                'preference="%s" %s>' % (
-                    protocol, protocol, database['host_country_cache'][hostid].upper(),
-                    preference, private)
-            doc += url
-            doc += '</url>\n'
+            parts.append(
+                indent(4) +
+                '<url protocol="%s" type="%s" location="%s" '
+                'preference="%s" %s>%s</url>\n' % (
+                    protocol, protocol, location, preference, private, url))
         preference = max(preference-1, 1)
-    doc += indent(3) + '</resources>\n'
-    doc += indent(2) + '</file>\n'
-    doc += indent(1) + '</files>\n'
-    doc += '</metalink>\n'
+    parts.append(metalink_footer)
+    doc = b''.join([
+        metalink_header(encoded=True),
+        fragment,
+        ''.join(parts).encode('utf-8'),
+    ])
     return ('metalink', 200, doc)
 
 
 def tree_lookup(tree, ip, field, maxResults=None):
     # Lookup up to maxResults matching prefixes from the tree
-    # returns a list of tuples (prefix, data)
+    # returns a list of tuples ((IP version, prefix size), data)
     result = []
     len_data = 0
     if ip is None:
         return result
     for node in tree.search_covering(ip.strNormal()):
-        prefix = node.prefix
         if type(node.data[field]) == list:
             len_data += len(node.data[field])
         else:
             len_data += 1
-        t = (prefix, node.data[field],)
+        t = (node.data['netblock'], node.data[field],)
         result.append(t)
         if maxResults is not None and len_data >= maxResults:
             break
@@ -235,24 +403,31 @@ def tree_lookup(tree, ip, field, maxResults=None):
 def trim_by_client_country(s, clientCountry):
     if clientCountry is None:
         return s
-    r = s.copy()
-    for hostid in s:
-        if hostid in database['host_country_allowed_cache'] and \
-               clientCountry not in database['host_country_allowed_cache'][hostid]:
-            r.remove(hostid)
-    return r
+    allowed = database['host_country_allowed_cache']
+    return host_vectors.select(
+        s, lambda hostid: hostid not in allowed
+        or clientCountry in allowed[hostid])
 
 
 def shuffle(s):
-    l = []
-    for hostid in s:
-        item = (database['host_bandwidth_cache'][hostid], hostid)
-        l.append(item)
-    newlist = weighted_shuffle(l)
-    results = []
-    for (bandwidth, hostid) in newlist:
-        results.append(hostid)
-    return results
+    host_load = database['host_load']
+    if host_load is None:
+        return weighted_order(s, database['host_bandwidth_cache'])
+    # the budget is shared by all workers, each one counts its own answers
+    weights = LoadAwareWeights(
+        database['host_bandwidth_cache'],
+        database['host_max_connections_cache'],
+        host_load, float(load_capacity) / max(workers, 1))
+    return weighted_order(s, weights)
+
+
+def new_host_load(info):
+    """ returns the LoadCounter for the hosts of the caches in info,
+    None if load-aware selection is disabled """
+    if load_capacity <= 0:
+        return None
+    hostids = list(info.get('host_bandwidth_cache', {}).keys())
+    return LoadCounter(load_window, max(hostids + [-1]) + 1)
 
 
 continents = {}
@@ -281,21 +456,12 @@ def do_global(kwargs, cache, clientCountry, header):
 
 
 def do_countrylist(kwargs, cache, clientCountry, requested_countries, header):
-
-    def collapse(d):
-        """ collapses a dict {key:set(hostids)} into a set of hostids """
-        s = set()
-        for country, hostids in d.items():
-            for hostid in hostids:
-                s.add(hostid)
-        return s
-
-    country_cache = {}
+    vectors = []
     for c in requested_countries:
         if c in cache['byCountry']:
-            country_cache[c] = cache['byCountry'][c]
+            vectors.append(cache['byCountry'][c])
             header += 'country = %s ' % c
-    s = collapse(country_cache)
+    s = host_vectors.union(vectors)
     s = trim_by_client_country(s, clientCountry)
     return (header, s)
 
@@ -332,16 +498,16 @@ def do_netblocks(kwargs, cache, header):
     hostresults = set()
     if 'netblock' not in kwargs or kwargs['netblock'] == "1":
         tree_results = tree_lookup(database['host_netblocks_tree'], kwargs['IP'], 'hosts')
-        for (prefix, hostids) in tree_results:
+        for (netblock, hostids) in tree_results:
             for hostid in hostids:
                 if hostid in cache['byHostId']:
-                    hostresults.add((prefix, hostid,))
+                    hostresults.add((netblock, hostid,))
                     header += 'Using preferred netblock '
     return (header, hostresults)
 
 
 def do_internet2(kwargs, cache, clientCountry, header):
-    hostresults = set()
+    hostresults = host_vectors.empty
     ip = kwargs['IP']
     if ip is None:
         return (header, hostresults)
@@ -370,7 +536,7 @@ def do_asn(kwargs, cache, header):
 
 
 def do_geoip(kwargs, cache, clientCountry, header):
-    hostresults = set()
+    hostresults = host_vectors.empty
     if clientCountry is not None and clientCountry in cache['byCountry']:
         hostresults = cache['byCountry'][clientCountry]
         header += 'country = %s ' % clientCountry
@@ -438,6 +604,121 @@ def trim_to_preferred_protocols(hosts_and_urls, try_protocols=None):
     return results
 
 
+class Flight(object):
+    """ A value being computed by one thread for others to wait for. """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.failed = False
+
+
+class LRUCache(object):
+    """ A bounded least recently used cache, safe to use from
+    several threads. """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        # key: Flight of the values being computed by get_or_compute()
+        self.pending = {}
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                return default
+            self.data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        """ get(key), computing and setting the value with compute() if
+        it is missing. Concurrent misses of the same key, like the burst
+        of identical requests after a release, wait for the value of the
+        first one instead of computing it again. """
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+                self.data[key] = value
+                return value
+            except KeyError:
+                pass
+            flight = self.pending.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.pending[key] = Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.failed:
+                # let this request run into the error on its own
+                return compute()
+            return flight.value
+        try:
+            value = compute()
+        except:
+            flight.failed = True
+            raise
+        else:
+            flight.value = value
+            self.set(key, value)
+        finally:
+            with self.lock:
+                del self.pending[key]
+            flight.done.set()
+        return value
+
+    def __len__(self):
+        return len(self.data)
+
+
+def cached_hosts(answer_cache, key, header, compute):
+    """ The country, continent and global stages only depend on the
+    directory, the client country and the requested countries, so their
+    trimmed host candidates are kept in the answer cache.
+    compute(header) is one of the do_* stages; what it adds to the
+    header is cached along with the hosts. """
+    def compute_result():
+        suffix, hosts = compute('')
+        return (suffix, tuple(hosts))
+    result = answer_cache.get_or_compute(key, compute_result)
+    return (header + result[0], result[1])
+
+
+def cached_urls(answer_cache, cache, dir, protocols):
+    """ returns {hostid: [url, ...]} of the directory for all its hosts,
+    trimmed to protocols unless that is None. The file asked for is left
+    out of the key, every client asks for a different one, and is
+    appended by append_file() to the few URLs answered. """
+    def compute_urls():
+        hosts_and_urls = append_path(cache['byHostId'], cache, None)
+        if protocols is not None:
+            hosts_and_urls = trim_to_preferred_protocols(
+                hosts_and_urls, protocols)
+        return dict(hosts_and_urls)
+    key = ('urls', dir, protocols)
+    return answer_cache.get_or_compute(key, compute_urls)
+
+
+def append_file(urls, file, pathIsDirectory=False):
+    """ urls of cached_urls() with file appended, like append_path()
+    does. """
+    if file is None:
+        if pathIsDirectory:
+            return [url + "/" for url in urls]
+        return urls
+    return [
+        (url if url.endswith('/') else url + "/") + file for url in urls]
+
+
 def client_ip_to_country(ip):
     clientCountry = None
     if ip is None:
@@ -447,7 +728,7 @@ def client_ip_to_country(ip):
     tree_results = tree_lookup(
         database['netblock_country_tree'], ip, 'country', maxResults=1)
     if len(tree_results) > 0:
-        (prefix, clientCountry) = tree_results[0]
+        (netblock, clientCountry) = tree_results[0]
         return clientCountry
 
     # attempt IPv6, then IPv6 6to4 as IPv4, then Teredo, then IPv4
@@ -473,10 +754,24 @@ def client_ip_to_country(ip):
     return clientCountry
 
 
-def do_mirrorlist(kwargs):
-    global logfile
+def repo_listing(repo_arch_to_directoryname):
+    """ The valid repositories for the "invalid repo or arch" error,
+    built once per loaded cache: the lines of all of them and, per
+    repository, the lines of its arches. """
+    repos = sorted(
+        i for i in repo_arch_to_directoryname.keys()
+        if i[0] is not None and i[1] is not None)
+    lines = ["# repo=%s&arch=%s\n" % i for i in repos]
+    arches = defaultdict(list)
+    for i, line in zip(repos, lines):
+        arches[i[0]].append(line)
+    return ''.join(lines), dict(
+        (repo, ''.join(repo_lines)) for repo, repo_lines in arches.items())
+
 
+def do_mirrorlist(kwargs, clock=null_clock, degraded=False):
     def return_error(kwargs, message='', returncode=200):
+        clock.answered('error')
         d = dict(
             returncode=returncode,
             message=message,
@@ -493,6 +788,8 @@ def do_mirrorlist(kwargs):
             kwargs,
             message='# either path=, or repo= and arch= must be specified')
 
+    # the answer cache belongs to the database it was filled from
+    answer_cache = database['answer_cache']
     file = None
     cache = None
     pathIsDirectory = False
@@ -537,20 +834,24 @@ def do_mirrorlist(kwargs):
                 pathIsDirectory=True
             cache = database['mirrorlist_cache'][dir]
         except KeyError:
-            repos = database['repo_arch_to_directoryname'].keys()
-            repos.sort()
             repo_information = header + "error: invalid repo or arch\n"
-            repo_information += "# following repositories are available:\n"
-            for i in repos:
-                if i[0] is not None and i[1] is not None:
-                    repo_information += "# repo=%s&arch=%s\n" % i
+            arches = database['repo_arches'].get(repo)
+            if arches is not None and (repo, arch) not in \
+                    database['repo_arch_to_directoryname']:
+                repo_information += "# did you mean:\n" + arches
+            else:
+                repo_information += \
+                    "# following repositories are available:\n" + \
+                    database['repo_listing']
             return return_error(kwargs, message=repo_information)
+    clock.lap('lookup')
 
     # set kwargs['IP'] exactly once
     try:
-        kwargs['IP'] = IP(kwargs['client_ip'])
+        kwargs['IP'] = parse_ip(kwargs['client_ip'])
     except:
         kwargs['IP'] = None
+    clock.lap('parse_ip')
 
     ordered_mirrorlist = cache.get(
         'ordered_mirrorlist', default_ordered_mirrorlist)
@@ -571,15 +872,18 @@ def do_mirrorlist(kwargs):
         requested_countries = uniqueify(
             [c.upper() for c in kwargs['country'].split(',') ])
 
-    # if they specify a country, don't use netblocks or ASN
-    if not 'country' in kwargs:
+    # if they specify a country, don't use netblocks or ASN, and neither
+    # if the server is overloaded
+    if not 'country' in kwargs and not degraded:
         header, netblock_results = do_netblocks(kwargs, cache, header)
+        clock.lap('netblocks')
         if len(netblock_results) > 0:
             if not ordered_mirrorlist:
                 done=1
 
         if not done:
             header, asn_results = do_asn(kwargs, cache, header)
+            clock.lap('asn')
             if len(asn_results) + len(netblock_results) >= 3:
                 if not ordered_mirrorlist:
                     done = 1
@@ -591,45 +895,60 @@ def do_mirrorlist(kwargs):
     else:
         print_client_country = clientCountry
 
-    if logfile and 'repo' in kwargs and 'arch' in kwargs:
+    if logfile is not None and 'repo' in kwargs and 'arch' in kwargs:
         msg = "IP: %s; DATE: %s; COUNTRY: %s; REPO: %s; ARCH: %s\n"  % (
             (kwargs['IP'] or 'None'), time.strftime("%Y-%m-%d"),
             print_client_country, kwargs['repo'], kwargs['arch'])
+        access_log.log(msg)
+    clock.lap('client_country')
 
-        logfile.write(msg)
-        logfile.flush()
-
-    if not done:
+    if not done and not degraded:
         header, internet2_results = do_internet2(
             kwargs, cache, clientCountry, header)
+        clock.lap('internet2')
         if len(internet2_results) + len(netblock_results) + len(asn_results) >= 3:
             if not ordered_mirrorlist:
                 done = 1
 
     if not done and 'country' in kwargs:
-        header, country_results  = do_country(
-            kwargs, cache, clientCountry, requested_countries, header)
+        header, country_results = cached_hosts(
+            answer_cache,
+            ('country', dir, clientCountry, tuple(requested_countries)),
+            header,
+            lambda h: do_country(
+                kwargs, cache, clientCountry, requested_countries, h))
         if len(country_results) == 0:
-            header, continent_results = do_continent(
-                kwargs, cache, clientCountry, requested_countries, header)
+            header, continent_results = cached_hosts(
+                answer_cache,
+                ('continent', dir, clientCountry, tuple(requested_countries)),
+                header,
+                lambda h: do_continent(
+                    kwargs, cache, clientCountry, requested_countries, h))
+        clock.lap('country')
         done = 1
 
     if not done:
-        header, geoip_results = do_geoip(
-            kwargs, cache, clientCountry, header)
+        header, geoip_results = cached_hosts(
+            answer_cache, ('geoip', dir, clientCountry), header,
+            lambda h: do_geoip(kwargs, cache, clientCountry, h))
+        clock.lap('geoip')
         if len(geoip_results) >= minimum:
             if not ordered_mirrorlist:
                 done = 1
 
     if not done:
-        header, continent_results = do_continent(
-            kwargs, cache, clientCountry, [], header)
+        header, continent_results = cached_hosts(
+            answer_cache, ('continent', dir, clientCountry, ()), header,
+            lambda h: do_continent(kwargs, cache, clientCountry, [], h))
+        clock.lap('continent')
         if len(geoip_results) + len(continent_results) >= minimum:
             done = 1
 
     if not done:
-        header, global_results = do_global(
-            kwargs, cache, clientCountry, header)
+        header, global_results = cached_hosts(
+            answer_cache, ('global', dir, clientCountry), header,
+            lambda h: do_global(kwargs, cache, clientCountry, h))
+        clock.lap('global')
 
     def _random_shuffle(s):
         l = list(s)
@@ -637,22 +956,22 @@ def do_mirrorlist(kwargs):
         return l
 
     def _ordered_netblocks(s):
-        def ipy_len(t):
-            (prefix, hostid) = t
-            return IP(prefix).len()
+        def netblock_size(t):
+            ((version, size), hostid) = t
+            return size
         v4_netblocks = []
         v6_netblocks = []
-        for (prefix, hostid) in s:
-            ip = IP(prefix)
-            if ip.version() == 4:
-                v4_netblocks.append((prefix, hostid))
-            elif ip.version() == 6:
-                v6_netblocks.append((prefix, hostid))
+        for t in s:
+            ((version, size), hostid) = t
+            if version == 4:
+                v4_netblocks.append(t)
+            elif version == 6:
+                v6_netblocks.append(t)
         # mix up the order, as sort will preserve same-key ordering
         random.shuffle(v4_netblocks)
-        v4_netblocks.sort(key=ipy_len)
+        v4_netblocks.sort(key=netblock_size)
         random.shuffle(v6_netblocks)
-        v6_netblocks.sort(key=ipy_len)
+        v6_netblocks.sort(key=netblock_size)
         v4_netblocks = [t[1] for t in v4_netblocks]
         v6_netblocks = [t[1] for t in v6_netblocks]
         return v6_netblocks + v4_netblocks
@@ -689,25 +1008,27 @@ def do_mirrorlist(kwargs):
         ip_str = 'Unknown IP'
     log_string = "mirrorlist: %s found its best mirror from %s" % (
         ip_str, where_string)
-    syslogger.info(log_string)
-
-    hosts_and_urls = append_path(
-        allhosts, cache, file, pathIsDirectory=pathIsDirectory)
+    access_log.syslog(log_string)
+    clock.lap('shuffle')
+    clock.answered(where_string)
 
-    protocols_trimmed = False
+    protocols = None
     if 'protocol' in kwargs and kwargs['protocol']:
-        try:
-            # Expecting a single string as value
-            # of the parameter protocol.
-            # Trying to convert it to a tuple for
-            # the protocol trim function.
-            try_protocols = (kwargs['protocol'],)
-            hosts_and_urls = trim_to_preferred_protocols(
-                    hosts_and_urls, try_protocols)
-            protocols_trimmed = True
-            header += 'protocol = %s ' % (kwargs['protocol'])
-        except:
-            pass
+        # Expecting a single string as value
+        # of the parameter protocol.
+        protocols = (kwargs['protocol'],)
+        header += 'protocol = %s ' % (kwargs['protocol'])
+    elif not ('metalink' in kwargs and kwargs['metalink']):
+        protocols = ('https', 'http', 'ftp')
+
+    urls = cached_urls(answer_cache, cache, dir, protocols)
+    hosts_and_urls = [
+        (hostid, append_file(urls[hostid], file, pathIsDirectory))
+        for hostid in allhosts if hostid in urls]
+    if database['host_load'] is not None and hosts_and_urls:
+        # clients mostly use the first mirror
+        database['host_load'].add(hosts_and_urls[0][0])
+    clock.lap('append_path')
 
     if 'time' in kwargs:
         try:
@@ -719,6 +1040,7 @@ def do_mirrorlist(kwargs):
     if 'metalink' in kwargs and kwargs['metalink']:
         (resulttype, returncode, results)=metalink(
             cache, dir, file, hosts_and_urls)
+        clock.lap('metalink')
         d = dict(
             message=None,
             resulttype=resulttype,
@@ -727,8 +1049,6 @@ def do_mirrorlist(kwargs):
         return d
 
     else:
-        if not protocols_trimmed:
-            hosts_and_urls = trim_to_preferred_protocols(hosts_and_urls)
         d = dict(
             message=header,
             resulttype='mirrorlist',
@@ -742,10 +1062,16 @@ def setup_cache_tree(cache, field):
     for k, v in cache.items():
         node = tree.add(k.strNormal())
         node.data[field] = v
+        # what ordering the netblock results needs, without parsing
+        # the prefix again on every request
+        node.data['netblock'] = (k.version(), k.len())
     return tree
 
 
 def setup_netblocks(netblocks_file, asns_wanted=None):
+    index = open_netblock_index(netblocks_file, asns_wanted)
+    if index is not None:
+        return index
     tree = radix.Radix()
     if netblocks_file is not None:
         try:
@@ -768,149 +1094,563 @@ def setup_netblocks(netblocks_file, asns_wanted=None):
     return tree
 
 
+##### Netblock index support #####
+
+# Written by mirrormanager2/lib/netblocks.py:dump_netblock_index()
+NETBLOCK_INDEX_MAGIC = b'MMNETIDX'
+NETBLOCK_INDEX_VERSION = 1
+NETBLOCK_INDEX_HEADER = struct.Struct('<8sIIII')
+
+
+def int_sequence(buf, offset, count, typecode):
+    """ returns (read-only sequence of count little-endian integers,
+    offset after them padded to 8 bytes). The integers stay in buf
+    where memoryview.cast() can map them. """
+    size = struct.calcsize('<' + typecode)
+    end = offset + size * count
+    if sys.byteorder == 'little' and hasattr(memoryview, 'cast'):
+        values = memoryview(buf)[offset:end].cast(typecode)
+    else:
+        values = struct.unpack_from('<%d%s' % (count, typecode), buf, offset)
+    return values, end + (-end % 8)
+
+
+class NetblockIndex(object):
+    """ Longest prefix matches of IP addresses against a netblocks file,
+    answered from the index mm2_build_netblock_index built of it.
+    The address space is split into sorted ranges of integers, each
+    pointing to the chain of (prefix length, ASN) pairs of the netblocks
+    which contain it, the most specific first. A lookup is a binary
+    search over the range starts.
+    If asns_wanted is given, only netblocks of those ASNs count. """
+
+    def __init__(self, buf, asns_wanted=None):
+        self.buf = buf
+        self.asns_wanted = asns_wanted
+        magic, version, n4, n6, nchains = \
+            NETBLOCK_INDEX_HEADER.unpack_from(buf, 0)
+        if magic != NETBLOCK_INDEX_MAGIC:
+            raise ValueError('not a netblock index')
+        if version != NETBLOCK_INDEX_VERSION:
+            raise ValueError('unsupported netblock index version %d' % version)
+        offset = NETBLOCK_INDEX_HEADER.size
+        self.v4_starts, offset = int_sequence(buf, offset, n4, 'I')
+        self.v4_chains, offset = int_sequence(buf, offset, n4, 'i')
+        self.v6_highs, offset = int_sequence(buf, offset, n6, 'Q')
+        self.v6_lows, offset = int_sequence(buf, offset, n6, 'Q')
+        self.v6_chains, offset = int_sequence(buf, offset, n6, 'i')
+        self.chains, offset = int_sequence(buf, offset, nchains, 'I')
+
+    def _chain(self, version, address):
+        if version == 4:
+            i = bisect_right(self.v4_starts, address) - 1
+            if i < 0:
+                return -1
+            return self.v4_chains[i]
+        high = address >> 64
+        low = address & 0xffffffffffffffff
+        first = bisect_left(self.v6_highs, high)
+        last = bisect_right(self.v6_highs, high, first)
+        i = bisect_right(self.v6_lows, low, first, last) - 1
+        if i < 0:
+            return -1
+        return self.v6_chains[i]
+
+    def covering(self, version, address):
+        """ returns [(prefix length, ASN), ...] of the netblocks which
+        contain address, the most specific first """
+        offset = self._chain(version, address)
+        if offset < 0:
+            return []
+        chains = self.chains
+        return [(chains[i], chains[i + 1])
+                for i in range(offset + 1, offset + 1 + 2 * chains[offset], 2)]
+
+    def lookup_asn(self, version, address):
+        for prefixlen, asn in self.covering(version, address):
+            if self.asns_wanted is None or asn in self.asns_wanted:
+                return asn
+        return None
+
+
+def open_netblock_index(netblocks_file, asns_wanted=None):
+    """ Maps the index of netblocks_file, if there is an up to date
+    one. Returns None otherwise; the netblocks file itself has to be
+    parsed then. """
+    if netblocks_file is None:
+        return None
+    index_file = netblocks_file + '.idx'
+    try:
+        index_mtime = os.stat(index_file).st_mtime
+    except OSError:
+        return None
+    try:
+        if os.stat(netblocks_file).st_mtime > index_mtime:
+            sys.stderr.write("ignoring %s, it is older than %s\n" % (
+                index_file, netblocks_file))
+            return None
+    except OSError:
+        pass
+    try:
+        with open(index_file, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return NetblockIndex(buf, asns_wanted)
+    except (EnvironmentError, ValueError, struct.error) as e:
+        sys.stderr.write("cannot use %s: %s\n" % (index_file, e))
+        return None
+
+
+##### Memory-mapped cache support #####
+
+# Written by mirrormanager2/lib/mirrorlist.py:dump_mmap_cache()
+MMAP_MAGIC = b'MMLCACHE'
+MMAP_VERSION = 2
+MMAP_FD_FIELDS = ('timestamp', 'size', 'sha1', 'md5', 'sha256', 'sha512')
+
+
+def unpack_string(buf, offset, fmt='<H'):
+    """ returns (string, offset after the string) """
+    (n,) = struct.unpack_from(fmt, buf, offset)
+    offset += struct.calcsize(fmt)
+    return buf[offset:offset + n].decode('utf-8'), offset + n
+
+
+class MmapStringIndex(object):
+    """ Read-only dict-like view of a sorted string index section.
+    Lookups are a binary search over the key offset table; only the
+    record which is asked for gets decoded by decode(buf, base, offset).
+    If size is set, the size most recently used records are kept
+    decoded. """
+
+    def __init__(self, buf, base, decode, size=0):
+        self.buf = buf
+        self.base = base
+        self.decode = decode
+        self.decoded = None
+        if size:
+            self.decoded = LRUCache(size)
+        (self.count,) = struct.unpack_from('<I', buf, base)
+        self.key_offsets = base + 4
+        self.record_offsets = self.key_offsets + 4 * (self.count + 1)
+        self.keys_base = self.record_offsets + 4 * self.count
+
+    def _key(self, i):
+        start, end = struct.unpack_from(
+            '<II', self.buf, self.key_offsets + 4 * i)
+        return self.buf[self.keys_base + start:self.keys_base + end]
+
+    def _find(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self._key(lo) == key:
+            return lo
+        return None
+
+    def __getitem__(self, key):
+        if self.decoded is not None:
+            value = self.decoded.get(key)
+            if value is not None:
+                return value
+        i = self._find(key)
+        if i is None:
+            raise KeyError(key)
+        (offset,) = struct.unpack_from(
+            '<I', self.buf, self.record_offsets + 4 * i)
+        value = self.decode(self.buf, self.base, self.base + offset)
+        if self.decoded is not None:
+            self.decoded.set(key, value)
+        return value
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __len__(self):
+        return self.count
+
+    def keys(self):
+        return [self._key(i).decode('utf-8') for i in range(self.count)]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+class MmapHCUrlCache(object):
+    """ Read-only dict-like view of the hcurl section: a sorted array
+    of hcurl ids and an offset table into the url blob. """
+
+    def __init__(self, buf, base):
+        self.buf = buf
+        (self.count,) = struct.unpack_from('<I', buf, base)
+        self.ids = base + 4
+        self.offsets = self.ids + 4 * self.count
+        self.blob = self.offsets + 4 * (self.count + 1)
+
+    def _find(self, hcurl_id):
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            (value,) = struct.unpack_from('<i', self.buf, self.ids + 4 * mid)
+            if value < hcurl_id:
+                lo = mid + 1
+            elif value > hcurl_id:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def __getitem__(self, hcurl_id):
+        i = self._find(hcurl_id)
+        if i is None:
+            raise KeyError(hcurl_id)
+        start, end = struct.unpack_from('<II', self.buf, self.offsets + 4 * i)
+        return self.buf[self.blob + start:self.blob + end].decode('utf-8')
+
+    def __contains__(self, hcurl_id):
+        return self._find(hcurl_id) is not None
+
+    def __len__(self):
+        return self.count
+
+
+def mmap_country_map(buf, offset):
+    (n,) = struct.unpack_from('<I', buf, offset)
+    offset += 4
+    result = {}
+    for i in range(n):
+        country, offset = unpack_string(buf, offset, fmt='<B')
+        result[country], offset = host_vectors.unpack_vector(buf, offset)
+    return result
+
+
+def mmap_hostid_map(buf, offset):
+    (n,) = struct.unpack_from('<I', buf, offset)
+    offset += 4
+    result = {}
+    for i in range(n):
+        (hostid,) = struct.unpack_from('<i', buf, offset)
+        result[hostid], offset = host_vectors.unpack_vector(
+            buf, offset + 4)
+    return result
+
+
+def mmap_directory(buf, base, offset):
+    """ decodes one mirrorlist_cache entry into the same compact
+    structure compact_directories() turns the other formats into """
+    flags, g, bycountry, byi2, byhostid = struct.unpack_from(
+        '<B4I', buf, offset)
+    c = {
+        'ordered_mirrorlist': bool(flags & 1),
+        'global': host_vectors.unpack_vector(buf, base + g)[0],
+        'byCountry': mmap_country_map(buf, base + bycountry),
+        'byCountryInternet2': mmap_country_map(buf, base + byi2),
+        'byHostId': mmap_hostid_map(buf, base + byhostid),
+    }
+    if flags & 2:
+        c['subpath'] = unpack_string(
+            buf, offset + struct.calcsize('<B4I'))[0]
+    return c
+
+
+def mmap_file_details(buf, base, offset):
+    (nfiles,) = struct.unpack_from('<I', buf, offset)
+    offset += 4
+    result = {}
+    for i in range(nfiles):
+        filename, offset = unpack_string(buf, offset)
+        (ndetails,) = struct.unpack_from('<I', buf, offset)
+        offset += 4
+        detailslist = []
+        for j in range(ndetails):
+            mask, timestamp, size = struct.unpack_from('<Bqq', buf, offset)
+            offset += struct.calcsize('<Bqq')
+            details = dict((field, None) for field in MMAP_FD_FIELDS)
+            if mask & 1:
+                details['timestamp'] = timestamp
+            if mask & 2:
+                details['size'] = size
+            for bit, field in enumerate(MMAP_FD_FIELDS[2:], 2):
+                if mask & (1 << bit):
+                    details[field], offset = unpack_string(buf, offset)
+            detailslist.append(details)
+        result[filename] = detailslist
+    return result
+
+
+def read_mmap_cache(f):
+    """ Maps the cache file written by dump_mmap_cache() and returns
+    views on it. Only the small 'meta' section is unmarshalled, the
+    directory, hcurl and file details sections are queried in place.
+    The most recently used directories are kept decoded.
+    The mapping is shared with every other process which maps the same
+    file and stays valid until the last view of it is gone. """
+    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, nsections, timestamp = struct.unpack_from(
+        '<8sIIq', buf, 0)
+    if magic != MMAP_MAGIC:
+        raise ValueError('not a memory-mapped mirrorlist cache')
+    if version != MMAP_VERSION:
+        raise ValueError('unsupported cache version %d' % version)
+    sections = {}
+    offset = struct.calcsize('<8sIIq')
+    for i in range(nsections):
+        name, start, length = struct.unpack_from('<8sQQ', buf, offset)
+        sections[name.rstrip(b'\0')] = start
+        if name.rstrip(b'\0') == b'meta':
+            meta = buf[start:start + length]
+        offset += struct.calcsize('<8sQQ')
+
+    info = marshal.loads(meta)
+    info['time'] = cache_time(timestamp)
+    info['repo_redirect'] = info.pop('repo_redirect_cache')
+    for key in ('host_netblock_cache', 'netblock_country_cache'):
+        info[key] = dict((IP(k), v) for k, v in info[key].items())
+    info['mirrorlist_cache'] = MmapStringIndex(
+        buf, sections[b'dirs'], mmap_directory, directory_cache_size)
+    info['hcurl_cache'] = MmapHCUrlCache(buf, sections[b'hcurls'])
+    info['file_details_cache'] = LazyFileDetails(
+        MmapStringIndex(buf, sections[b'files'], mmap_file_details),
+        None, file_details_cache_size)
+    return info
+
+
+def compact_directories(directories, interner):
+    """ Converts mirrorlist_cache entries into their compact form, see
+    host_vectors.py. """
+    return dict(
+        (d, interner.directory(c)) for d, c in directories.items())
+
+
+def compact_host_countries(host_countries, interner):
+    return dict(
+        (hostid, interner.countries(countries))
+        for hostid, countries in host_countries.items())
+
+
+def compact_caches(info):
+    interner = host_vectors.Interner()
+    # the mmap cache decodes directories into that form by itself
+    if isinstance(info.get('mirrorlist_cache'), dict):
+        info['mirrorlist_cache'] = compact_directories(
+            info['mirrorlist_cache'], interner)
+    if 'host_country_allowed_cache' in info:
+        info['host_country_allowed_cache'] = compact_host_countries(
+            info['host_country_allowed_cache'], interner)
+
+
+def convert_map(items):
+    return dict((item.key, item.value) for item in items)
+
+
+def convert_list_map(items):
+    result = {}
+    for item in items:
+        result.setdefault(item.key, []).extend(item.value)
+    return result
+
+
+def convert_netblock_map(items):
+    return dict((IP(item.key), item.value) for item in items)
+
+
+def convert_netblock_list_map(items):
+    result = {}
+    for item in items:
+        result.setdefault(IP(item.key), []).extend(item.value)
+    return result
+
+
+def convert_repo_arch(items):
+    result = {}
+    for item in items:
+        parts = item.key.split('+')
+        result[(parts[0], parts[1])] = item.value
+    return result
+
+
+class LazyFileDetails(object):
+    """ Read-only dict-like view of file_details_cache which decodes the
+    details of a directory only when a metalink asks for them. records
+    maps the directories to what decode() turns into their
+    {filename: [details]} (if decode is None, records does that by
+    itself); the most recently used directories are kept decoded. """
+
+    def __init__(self, records, decode, size):
+        self.records = records
+        self.decode = decode
+        self.decoded = LRUCache(size)
+
+    def __getitem__(self, directory):
+        files = self.decoded.get(directory)
+        if files is None:
+            files = self.records[directory]
+            if self.decode is not None:
+                files = self.decode(files)
+            self.decoded.set(directory, files)
+        return files
+
+    def __contains__(self, directory):
+        return directory in self.records
+
+    def get(self, directory, default=None):
+        try:
+            return self[directory]
+        except KeyError:
+            return default
+
+    def __len__(self):
+        return len(self.records)
+
+    def keys(self):
+        return self.records.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+def convert_file_details(blobs):
+    """ {filename: [details]} of the serialized FileDetailsCache entries
+    of one directory """
+    files = {}
+    for blob in blobs:
+        item = mirrormanager_pb2.FileDetailsCacheDirectoryType()
+        item.ParseFromString(blob)
+        for file_details in item.FileDetailsCacheFiles:
+            files[file_details.filename] = [
+                {
+                    'timestamp': value.TimeStamp,
+                    'size': value.Size,
+                    'sha1': value.SHA1,
+                    'md5': value.MD5,
+                    'sha256': value.SHA256,
+                    'sha512': value.SHA512,
+                }
+                for value in file_details.FileDetails]
+    return files
+
+
+def index_file_details(items):
+    """ The FileDetailsCache entries are kept serialized, which takes a
+    fraction of the memory of the parsed messages, until a metalink for
+    their directory is requested. """
+    records = {}
+    for item in items:
+        records.setdefault(item.directory, []).append(
+            item.SerializeToString())
+    return LazyFileDetails(
+        records, convert_file_details, file_details_cache_size)
+
+
+def convert_mirrorlist(items):
+    result = {}
+    for item in items:
+        mc = result.setdefault(item.directory, {})
+        mc['subpath'] = item.Subpath
+        mc['ordered_mirrorlist'] = item.OrderedMirrorList
+        mc['global'] = set(item.Global)
+        mc['byCountry'] = dict(
+            (country.key, set(country.value)) for country in item.ByCountry)
+        mc['byCountryInternet2'] = dict(
+            (country.key, set(country.value))
+            for country in item.ByCountryInternet2)
+        mc['byHostId'] = dict(
+            (hostid.key, list(hostid.value)) for hostid in item.ByHostId)
+    return result
+
+
+# (cache, field of the MirrorList message, conversion), in the order of
+# the message; the trees built from a cache can start as soon as it is
+# converted
+PROTOBUF_SECTIONS = [
+    ('asn_host_cache', 'HostAsnCache', convert_list_map),
+    ('netblock_country_cache', 'NetblockCountryCache', convert_netblock_map),
+    ('location_cache', 'LocationCache', convert_list_map),
+    ('hcurl_cache', 'HCUrlCache', convert_map),
+    ('file_details_cache', 'FileDetailsCache', index_file_details),
+    ('disabled_repositories', 'DisabledRepositoryCache', convert_map),
+    ('country_continent_redirect_cache', 'CountryContinentRedirectCache',
+     convert_map),
+    ('repo_redirect', 'RepositoryRedirectCache', convert_map),
+    ('repo_arch_to_directoryname', 'RepoArchToDirectoryName',
+     convert_repo_arch),
+    ('host_max_connections_cache', 'HostMaxConnectionCache', convert_map),
+    ('host_country_cache', 'HostCountryCache', convert_map),
+    ('host_bandwidth_cache', 'HostBandwidthCache', convert_map),
+    ('host_netblock_cache', 'HostNetblockCache', convert_netblock_list_map),
+    ('mirrorlist_cache', 'MirrorListCache', convert_mirrorlist),
+]
+
+
+def read_protobuf_cache(mirrorlist, info, timings):
+    """ Transforms the protobuf input into the same format as the pickle
+    input, one section after the other. Every section is cleared from
+    the message once it is converted, to keep only one copy of it in
+    memory. """
+    # written with time.mktime(), which fromtimestamp() undoes: this is
+    # the naive UTC datetime of the refresh again
+    info['time'] = datetime.datetime.fromtimestamp(mirrorlist.Time)
+    for cache, field, convert in PROTOBUF_SECTIONS:
+        start = time.time()
+        info[cache] = convert(getattr(mirrorlist, field))
+        mirrorlist.ClearField(field)
+        timings[cache] = time.time() - start
+
+
+def timed(timings, name, build, *args):
+    """ build(*args), with the seconds it took in timings[name] """
+    start = time.time()
+    value = build(*args)
+    timings[name] = time.time() - start
+    return value
+
+
 def read_caches():
     info = {}
+    timings = OrderedDict()
 
     data = {}
 
     mirrorlist = mirrormanager_pb2.MirrorList()
     protobuf = False
+    mmapped = False
 
+    start = time.time()
     f = open(cachefile, 'rb')
-    try:
-        data = pickle.load(f)
-    except pickle.UnpicklingError:
-        # If it is not a pickle, then it probably is the
-        # protobuf based format.
+    if f.read(len(MMAP_MAGIC)) == MMAP_MAGIC:
+        info = read_mmap_cache(f)
+        mmapped = True
+    else:
         f.seek(0)
-        mirrorlist.ParseFromString(f.read())
-        protobuf = True
-        del(data)
-        pass
+        try:
+            data = pickle.load(f)
+        except pickle.UnpicklingError:
+            # If it is not a pickle, then it probably is the
+            # protobuf based format.
+            f.seek(0)
+            mirrorlist.ParseFromString(f.read())
+            protobuf = True
+            del(data)
+            pass
     f.close()
+    timings['read'] = time.time() - start
 
     if protobuf:
-        # This transforms the protobuf input back to the
-        # same format as the pickle input.
-
-        info['time'] = datetime.datetime.fromtimestamp(mirrorlist.Time)
-
-        tmp = {}
-        for i, item in enumerate(mirrorlist.HostAsnCache):
-            if item.key not in tmp.keys():
-                tmp[item.key] = []
-            for v, value in enumerate(item.value):
-                tmp[item.key].append(value)
-        info['asn_host_cache'] = tmp
-
-        tmp = {}
-        for i, item in enumerate(mirrorlist.NetblockCountryCache):
-            tmp[
-                IP(item.key)] = item.value
-        info['netblock_country_cache'] = tmp
-
-        tmp = {}
-        for i, item in enumerate(mirrorlist.LocationCache):
-            if item.key not in tmp.keys():
-                tmp[item.key] = []
-            for v, value in enumerate(item.value):
-                tmp[item.key].append(value)
-        info['location_cache'] = tmp
-
-        tmp = {}
-        for i, item in enumerate(mirrorlist.HCUrlCache):
-            tmp[item.key] = item.value
-        info['hcurl_cache'] = tmp
-
-        tmp = {}
-        for i, item in enumerate(mirrorlist.FileDetailsCache):
-            if item.directory not in tmp.keys():
-                tmp[item.directory] = {}
-            fdcf = item.FileDetailsCacheFiles
-            for fd, file_details in enumerate(fdcf):
-                tmp[item.directory][file_details.filename] = []
-                details_list = file_details.FileDetails
-                for v, value in enumerate(details_list):
-                    fd = {}
-                    fd['timestamp'] = value.TimeStamp
-                    fd['size'] = value.Size
-                    fd['sha1'] = value.SHA1
-                    fd['md5'] = value.MD5
-                    fd['sha256'] = value.SHA256
-                    fd['sha512'] = value.SHA512
-                    tmp[item.directory][file_details.filename].append(fd)
-        info['file_details_cache'] = tmp
-
-        tmp = {}
-        for i, item in enumerate(mirrorlist.DisabledRepositoryCache):
-            tmp[item.key] = item.value
-        info['disabled_repositories'] = tmp
-        tmp = {}
-        for i, item in enumerate(mirrorlist.CountryContinentRedirectCache):
-            tmp[item.key] = item.value
-        info['country_continent_redirect_cache'] = tmp
-        tmp = {}
-        for i, item in enumerate(mirrorlist.RepositoryRedirectCache):
-            tmp[item.key] = item.value
-        info['repo_redirect'] = tmp
-
-        tmp = {}
-        for i, item in enumerate(mirrorlist.RepoArchToDirectoryName):
-            tmp[
-                (item.key.split('+')[0], item.key.split('+')[1])
-            ] = item.value
-        info['repo_arch_to_directoryname'] = tmp
-
-        tmp = {}
-        for i, item in enumerate(mirrorlist.HostMaxConnectionCache):
-            tmp[item.key] = item.value
-        info['host_max_connections_cache'] = tmp
-        tmp = {}
-        for i, item in enumerate(mirrorlist.HostCountryCache):
-            tmp[item.key] = item.value
-        info['host_country_cache'] = tmp
-        tmp = {}
-        for i, item in enumerate(mirrorlist.HostBandwidthCache):
-            tmp[item.key] = item.value
-        info['host_bandwidth_cache'] = tmp
-
-        tmp = {}
-        for i, item in enumerate(mirrorlist.HostNetblockCache):
-            if IP(item.key) not in tmp.keys():
-                tmp[IP(item.key)] = []
-            for v, value in enumerate(item.value):
-                tmp[IP(item.key)].append(value)
-        info['host_netblock_cache'] = tmp
-
-        tmp = {}
-        for i, item in enumerate(mirrorlist.MirrorListCache):
-            if item.directory not in tmp.keys():
-                tmp[item.directory] = {}
-            mc = tmp[item.directory]
-            mc['subpath'] = item.Subpath
-            mc['ordered_mirrorlist'] = item.OrderedMirrorList
-            mc['global'] = set()
-            for v, value in enumerate(item.Global):
-                mc['global'].add(value)
-            mc['byCountry'] = {}
-            for c, country in enumerate(item.ByCountry):
-                mc['byCountry'][country.key] = set()
-                for v, value in enumerate(country.value):
-                    mc['byCountry'][country.key].add(value)
-            mc['byCountryInternet2'] = {}
-            for c, country in enumerate(item.ByCountryInternet2):
-                mc['byCountryInternet2'][country.key] = set()
-                for v, value in enumerate(country.value):
-                    mc['byCountryInternet2'][country.key].add(value)
-            mc['byHostId'] = {}
-            for i, id in enumerate(item.ByHostId):
-                mc['byHostId'][id.key] = []
-                for h, hcurl in enumerate(id.value):
-                    mc['byHostId'][id.key].append(hcurl)
-        info['mirrorlist_cache'] = tmp
-        mirrorlist.Clear()
-
-    else:
+        read_protobuf_cache(mirrorlist, info, timings)
+    elif not mmapped:
         if 'mirrorlist_cache' in data:
             info['mirrorlist_cache'] = data['mirrorlist_cache']
         if 'host_netblock_cache' in data:
@@ -933,6 +1673,8 @@ def read_caches():
         if 'host_country_cache' in data:
             info['host_country_cache'] = data['host_country_cache']
         if 'file_details_cache' in data:
+            # unlike the protobuf and memory-mapped caches, the pickle
+            # has all the file details decoded already
             info['file_details_cache'] = data['file_details_cache']
         if 'hcurl_cache' in data:
             info['hcurl_cache'] = data['hcurl_cache']
@@ -948,19 +1690,190 @@ def read_caches():
         if 'time' in data:
             info['time'] = data['time']
 
-    setup_continents(info)
-
-    info['internet2_tree'] = setup_netblocks(internet2_netblocks_file)
-    info['global_tree']    = setup_netblocks(global_netblocks_file, info['asn_host_cache'])
+    for cache in ('asn_host_cache', 'host_netblock_cache',
+                  'netblock_country_cache'):
+        info.setdefault(cache, {})
+    # the trees are built one after the other: the interpreter lock
+    # would keep threads from building them any faster
+    info['internet2_tree'] = timed(
+        timings, 'internet2_tree', setup_netblocks, internet2_netblocks_file)
+    info['global_tree'] = timed(
+        timings, 'global_tree', setup_netblocks, global_netblocks_file,
+        info['asn_host_cache'])
     # host_netblocks_tree key is a netblock, value is a list of host IDs
-    info['host_netblocks_tree'] = setup_cache_tree(info['host_netblock_cache'], 'hosts')
-    # netblock_country_tree key is a netblock, value is a single country string
-    info['netblock_country_tree'] = setup_cache_tree(
+    info['host_netblocks_tree'] = timed(
+        timings, 'host_netblocks_tree', setup_cache_tree,
+        info['host_netblock_cache'], 'hosts')
+    # netblock_country_tree key is a netblock, value is a single country
+    # string
+    info['netblock_country_tree'] = timed(
+        timings, 'netblock_country_tree', setup_cache_tree,
         info['netblock_country_cache'], 'country')
 
+    start = time.time()
+    compact_caches(info)
+    setup_continents(info)
+    timings['compact'] = time.time() - start
+
+    info['load_timings'] = timings
     return info
 
 
+##### Cache patches #####
+
+# must match mirrormanager2/lib/mirrorlist.py
+PATCH_VERSION = 2
+
+
+class PatchedCache(object):
+    """ Read-only dict-like view of a cache which can not be copied
+    cheaply (the memory-mapped ones) with the entries changed by one or
+    more patches on top of it. """
+
+    def __init__(self, base, updated, removed):
+        self.base = base
+        self.updated = updated
+        self.removed = removed
+
+    def __getitem__(self, key):
+        if key in self.updated:
+            return self.updated[key]
+        if key in self.removed:
+            raise KeyError(key)
+        return self.base[key]
+
+    def __contains__(self, key):
+        if key in self.updated:
+            return True
+        if key in self.removed:
+            return False
+        return key in self.base
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = set(self.base.keys())
+        keys.difference_update(self.removed)
+        keys.update(self.updated)
+        return list(keys)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+
+def patch_cache(cache, updated, removed):
+    """ Returns a new version of cache with the entries in updated
+    added or replaced and the keys in removed deleted. cache itself is
+    not modified, requests in flight may still be using it. """
+    if isinstance(cache, dict):
+        cache = dict(cache)
+        for key in removed:
+            cache.pop(key, None)
+        cache.update(updated)
+        return cache
+    if isinstance(cache, PatchedCache):
+        new_updated = dict(cache.updated)
+        new_removed = set(cache.removed)
+        for key in removed:
+            new_updated.pop(key, None)
+            new_removed.add(key)
+        new_removed.difference_update(updated)
+        new_updated.update(updated)
+        return PatchedCache(cache.base, new_updated, new_removed)
+    return PatchedCache(cache, dict(updated), set(removed))
+
+
+def cache_timestamp(t):
+    # the cache formats keep the creation time with different precision;
+    # t is in UTC, like datetime.utcnow() of the refresh
+    return calendar.timegm(t.utctimetuple())
+
+
+def cache_time(timestamp):
+    """ The creation time of the caches, as the naive UTC datetime the
+    pickle holds, of cache_timestamp(). """
+    return datetime.datetime(1970, 1, 1) + \
+        datetime.timedelta(seconds=timestamp)
+
+
+def apply_patch(*args, **kwargs):
+    """ Applies the patch written by mm2_refresh_mirrorlist_cache --delta
+    to the loaded caches. The patch only applies to the cache it was
+    computed against; otherwise the whole cache has to be reloaded. """
+    global database
+    sys.stderr.write("apply_patch...")
+    sys.stderr.flush()
+    try:
+        with open(patchfile, 'rb') as f:
+            patch = marshal.load(f)
+    except Exception as e:
+        sys.stderr.write("cannot read %s: %s\n" % (patchfile, e))
+        sys.stderr.flush()
+        return False
+    old_database = database
+    if not isinstance(patch, dict) or \
+            patch.get('patch_version') != PATCH_VERSION or \
+            'time' not in old_database or \
+            patch['base_time'] != cache_timestamp(old_database['time']):
+        sys.stderr.write(
+            "%s does not apply to the loaded cache, it has to be "
+            "reloaded (SIGHUP).\n" % patchfile)
+        sys.stderr.flush()
+        return False
+
+    new_database = dict(old_database)
+    changes = patch['changes']
+    interner = host_vectors.Interner()
+    for key, (updated, removed) in changes.items():
+        if key == 'repo_redirect_cache':
+            name = 'repo_redirect'
+        else:
+            name = key
+        if key == 'mirrorlist_cache':
+            updated = compact_directories(updated, interner)
+        elif key == 'host_country_allowed_cache':
+            updated = compact_host_countries(updated, interner)
+        elif key in ('host_netblock_cache', 'netblock_country_cache'):
+            updated = dict((IP(k), v) for k, v in updated.items())
+            removed = [IP(k) for k in removed]
+        new_database[name] = patch_cache(
+            old_database.get(name, {}), updated, removed)
+    if 'host_netblock_cache' in changes:
+        new_database['host_netblocks_tree'] = setup_cache_tree(
+            new_database['host_netblock_cache'], 'hosts')
+    if 'netblock_country_cache' in changes:
+        new_database['netblock_country_tree'] = setup_cache_tree(
+            new_database['netblock_country_cache'], 'country')
+    if 'asn_host_cache' in changes:
+        new_database['global_tree'] = setup_netblocks(
+            global_netblocks_file, new_database['asn_host_cache'])
+    if 'country_continent_redirect_cache' in changes:
+        setup_continents(new_database)
+    if 'repo_arch_to_directoryname' in changes:
+        new_database['repo_listing'], new_database['repo_arches'] = \
+            repo_listing(new_database['repo_arch_to_directoryname'])
+    if 'host_bandwidth_cache' in changes and \
+            new_database['host_load'] is not None:
+        # new hosts need counters, the counts so far are kept
+        new_database['host_load'].grow(
+            max(list(new_database['host_bandwidth_cache'].keys()) + [-1]) + 1)
+    new_database['time'] = cache_time(patch['time'])
+    new_database['answer_cache'] = LRUCache(answer_cache_size)
+    new_database['metalink_cache'] = LRUCache(file_details_cache_size)
+    # Update the entire in-memory structure at once
+    database = new_database
+    sys.stderr.write("done.\n")
+    sys.stderr.flush()
+    return True
+
+
 def errordoc(metalink, message):
     if metalink:
         doc = metalink_failuredoc(message)
@@ -969,72 +1882,186 @@ def errordoc(metalink, message):
     return doc
 
 
-class MirrorlistHandler(StreamRequestHandler):
+def mirrorlist_answer(d, clock=null_clock, degraded=False):
+    """ do_mirrorlist(), turning exceptions into an error answer. """
+    try:
+        return do_mirrorlist(d, clock, degraded)
+    except Exception as e:
+        clock.answered('error')
+        message=u'# Bad Request %s\n# %s' % (e, d)
+        exception_msg = traceback.format_exc()
+        sys.stderr.write(message+'\n')
+        sys.stderr.write(exception_msg)
+        sys.stderr.flush()
+        r = dict(
+            message=message,
+            resulttype='mirrorlist',
+            results=[],
+            returncode=400)
+        if d['metalink']:
+            r['resulttype'] = 'metalink'
+            r['results'] = errordoc(d['metalink'], message)
+        return r
+
+
+def busy_answer(d):
+    """ The answer for the requests turned away by admission control. """
+    message = u'# server busy, please try again later'
+    r = dict(
+        message=message,
+        resulttype='mirrorlist',
+        results=[],
+        returncode=mirrorlist_protocol.BUSY)
+    if d.get('metalink'):
+        r['resulttype'] = 'metalink'
+        r['results'] = metalink_failuredoc(message)
+    return r
+
+
+def admitted_answer(d, clock=null_clock):
+    """ mirrorlist_answer() within the --max-in-flight limit. """
+    if in_flight is None:
+        return mirrorlist_answer(d, clock)
+    admitted = in_flight.enter()
+    if admitted is None:
+        clock.answered('busy')
+        return busy_answer(d)
+    try:
+        return mirrorlist_answer(d, clock, degraded=admitted == QUEUED)
+    finally:
+        in_flight.leave()
+
+
+def wait_for_request(connection):
+    """ Waits for the next request on a persistent connection. Returns
+    False if the connection has been idle for connection_idle_timeout
+    seconds or if the server is shutting down and nothing is pending. """
+    idle = 0
+    while True:
+        if must_die:
+            timeout = 0
+        else:
+            timeout = 1
+        try:
+            rlist, wlist, xlist = select.select(
+                [connection], [], [], timeout)
+        except select.error:
+            # interrupted by a signal
+            continue
+        if rlist:
+            return True
+        idle += 1
+        if must_die or idle >= connection_idle_timeout:
+            return False
+
+
+class MirrorlistHandler(BaseRequestHandler):
     def handle(self):
         random.seed()
-        try:
-            # read size of incoming pickle
-            readlen = 0
-            size = ''
-            while readlen < 10:
-                size += self.rfile.read(10 - readlen).decode()
-                readlen = len(size)
-            size = int(size)
-            print(size)
-
-            # read the pickle
-            readlen = 0
-            p = b''
-            while readlen < size:
-                p += self.rfile.read(size - readlen)
-                readlen = len(p)
-            d = pickle.loads(p)
-            self.connection.shutdown(socket.SHUT_RD)
-        except:
-            raise
+        # the client may send several requests on the same connection
+        # without waiting for the answers, they are answered in order
+        while wait_for_request(self.request):
+            clock = request_clock()
+            try:
+                request = mirrorlist_protocol.recv_message(
+                    self.request, mirrormanager_pb2.MirrorListRequest,
+                    max_size=max_request_size)
+            except Exception as e:
+                sys.stderr.write('Invalid request: %s\n' % e)
+                sys.stderr.flush()
+                return
+            if request is None:
+                # the client closed the connection
+                return
+            clock.lap('read')
+            d = mirrorlist_protocol.decode_request(request)
+            clock.lap('decode')
+            r = admitted_answer(d, clock)
+            message = mirrorlist_protocol.encode_response(r)
+            clock.lap('encode')
 
-        try:
             try:
-                r = do_mirrorlist(d)
-            except:
-                raise
-            message = r['message']
-            results = r['results']
-            resulttype = r['resulttype']
-            returncode = r['returncode']
-        except Exception as e:
-            message=u'# Bad Request %s\n# %s' % (e, d)
-            exception_msg = traceback.format_exc(e)
-            sys.stderr.write(message+'\n')
-            sys.stderr.write(exception_msg)
-            sys.stderr.flush()
-            returncode = 400
-            results = []
-            resulttype = 'mirrorlist'
-            if d['metalink']:
-                resulttype = 'metalink'
-                results = errordoc(d['metalink'], message)
+                mirrorlist_protocol.send_message(self.request, message)
+            except socket.error:
+                return
+            clock.lap('send')
+            clock.done()
+
+
+def http_answer(d):
+    """ admitted_answer() for the threads of the HTTP listener. """
+    clock = request_clock()
+    r = admitted_answer(d, clock)
+    clock.done()
+    return r
 
+
+##### Request statistics #####
+
+def request_clock():
+    if stats is None:
+        return null_clock
+    return stats.clock()
+
+
+def render_stats():
+    metrics = [
+        ('mirrorlist_cache_loads_total', 'counter',
+         'Number of times the caches were loaded.', cache_loads),
+    ]
+    if cache_load_duration is not None:
+        metrics.append((
+            'mirrorlist_cache_load_duration_seconds', 'gauge',
+            'How long the last load of the caches took.',
+            cache_load_duration))
+    if 'load_timings' in database:
+        metrics.append((
+            'mirrorlist_cache_section_load_seconds', 'gauge',
+            'How long loading the sections of the caches took.',
+            dict(('section="%s"' % name, seconds)
+                 for name, seconds in database['load_timings'].items())))
+    if 'time' in database:
+        metrics.append((
+            'mirrorlist_cache_age_seconds', 'gauge',
+            'Age of the loaded mirrorlist cache.',
+            time.time() - cache_timestamp(database['time'])))
+    return stats.render(metrics)
+
+
+class StatsHandler(BaseRequestHandler):
+    def handle(self):
         try:
-            p = pickle.dumps({
-                'message':message,
-                'resulttype':resulttype,
-                'results':results,
-                'returncode':returncode})
-            self.connection.sendall(str(len(p)).encode().zfill(10))
-
-            self.connection.sendall(p)
-            self.connection.shutdown(socket.SHUT_WR)
-        except:
+            self.request.sendall(render_stats().encode('ascii'))
+        except socket.error:
             pass
 
 
+def start_stats_listener():
+    """ Serves the statistics on the stats socket from a thread of the
+    main process: every connection gets them in the Prometheus text
+    format. With workers the supervisor serves them, adding up the
+    statistics of all workers. """
+    global stats_server
+    try:
+        os.unlink(stats_socketfile)
+    except OSError:
+        pass
+    stats_server = UnixStreamServer(stats_socketfile, StatsHandler)
+    thread = threading.Thread(target=stats_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+def reopen_logfile():
+    try:
+        access_log.reopen()
+    except (IOError, OSError) as e:
+        sys.stderr.write("cannot reopen %s: %s\n" % (logfile, e))
+        sys.stderr.flush()
+
+
 def sighup_handler(signum, frame):
-    global logfile
-    if logfile is not None:
-        name = logfile.name
-        logfile.close()
-        logfile = open(name, 'a')
+    reopen_logfile()
 
     # put this in a separate thread so it doesn't block clients
     thread = threading.Thread(target=load_databases_and_caches)
@@ -1048,6 +2075,17 @@ def sighup_handler(signum, frame):
         pass
 
 
+def sigusr1_handler(signum, frame):
+    # put this in a separate thread so it doesn't block clients
+    thread = threading.Thread(target=apply_patch)
+    thread.daemon = False
+    try:
+        thread.start()
+    except KeyError:
+        # see sighup_handler()
+        pass
+
+
 def sigterm_handler(signum, frame):
     global must_die
     signal.signal(signal.SIGHUP, signal.SIG_IGN)
@@ -1056,8 +2094,243 @@ def sigterm_handler(signum, frame):
         must_die = True
 
 
+##### Pre-fork mode #####
+
+def supervisor_sighup_handler(signum, frame):
+    # the reload happens in the supervisor loop, before the new
+    # generation of workers is forked
+    global reload_requested
+    reopen_logfile()
+    reload_requested = True
+
+
+def supervisor_sigusr1_handler(signum, frame):
+    global patch_requested
+    patch_requested = True
+
+
+def run_worker(ss):
+    """ Serves requests on the inherited listening socket until SIGTERM,
+    then waits for the requests in flight and exits. Never returns. """
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, sigterm_handler)
+    if stats_server is not None:
+        # served by the supervisor
+        stats_server.socket.close()
+    access_log.after_fork()
+    status = 0
+    try:
+        start_http_listener()
+        while not must_die:
+            ss.handle_request()
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread() and \
+                    not thread.daemon:
+                thread.join()
+    except:
+        traceback.print_exc()
+        status = 1
+    access_log.close()
+    os._exit(status)
+
+
+def free_stats_slot():
+    """ The statistics slot for a new worker. Slot 0 is the supervisor's,
+    there are two for each worker so the old generation of workers can
+    finish while the new one starts. """
+    used = set(worker_slots.values())
+    for slot in range(1, 2 * workers + 1):
+        if slot not in used:
+            return slot
+    # several generations at once, share a slot
+    return 1
+
+
+def start_worker(ss):
+    slot = free_stats_slot()
+    pid = os.fork()
+    if pid == 0:
+        if stats is not None:
+            stats.use_slot(slot)
+        run_worker(ss)
+    worker_slots[pid] = slot
+    return pid
+
+
+class WorkerPool(object):
+    """ The worker processes of the supervisor: the current generation,
+    which is kept at its size, and the old ones finishing their requests
+    in flight. start() forks a worker and returns its pid. """
+
+    def __init__(self, start):
+        self.start = start
+        self.current = set()
+        self.retiring = set()
+
+    def spawn(self, count):
+        for i in range(count):
+            self.current.add(self.start())
+
+    def roll(self, count):
+        """ Starts a new generation of count workers. Returns the pids of
+        the old ones, which have to be told to finish. """
+        self.retiring |= self.current
+        self.current = set()
+        self.spawn(count)
+        return set(self.retiring)
+
+    def exited(self, pid, respawn=True):
+        """ Forgets the worker pid. Returns True if it was one of the
+        current generation and has been replaced. """
+        self.retiring.discard(pid)
+        if pid not in self.current:
+            return False
+        self.current.remove(pid)
+        if respawn:
+            self.current.add(self.start())
+        return respawn
+
+    def all(self):
+        return self.current | self.retiring
+
+
+def requested_action():
+    """ What the signals received since the last call ask the
+    supervisor to do: 'reload', 'patch' or None. """
+    global reload_requested
+    global patch_requested
+    if reload_requested:
+        reload_requested = False
+        # the reload makes a pending patch pointless
+        patch_requested = False
+        return 'reload'
+    if patch_requested:
+        patch_requested = False
+        return 'patch'
+    return None
+
+
+def terminate_workers(pids):
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+
+def run_supervisor(ss):
+    """ The supervisor only loads the caches and manages the workers.
+    All workers accept() on the same listening socket, so the kernel
+    spreads the connections across them, and they share the loaded
+    caches copy-on-write. On SIGHUP the caches are reloaded (on SIGUSR1
+    a patch is applied), a new generation of workers is started and
+    the old generation finishes its requests in flight before
+    exiting. """
+    # several workers wake up for one connection, the ones
+    # which lose the race must not block in accept()
+    ss.socket.setblocking(False)
+    ss.timeout = 0.5
+    if hasattr(gc, 'freeze'):
+        # keep the garbage collector from touching (and thereby
+        # copying) the pages of the loaded caches in the workers
+        gc.freeze()
+    pool = WorkerPool(lambda: start_worker(ss))
+    pool.spawn(workers)
+
+    while not must_die:
+        action = requested_action()
+        if action == 'reload':
+            load_databases_and_caches()
+            new_generation = True
+        elif action == 'patch':
+            # the workers only see the patched caches once they are
+            # replaced, just like on a reload
+            new_generation = apply_patch()
+        else:
+            new_generation = False
+        if new_generation:
+            if hasattr(gc, 'freeze'):
+                gc.freeze()
+            terminate_workers(pool.roll(workers))
+        time.sleep(1)
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                break
+            if pid == 0:
+                break
+            worker_slots.pop(pid, None)
+            if pool.exited(pid, respawn=not must_die):
+                sys.stderr.write(
+                    "worker %d died with status %d, restarted\n" % (
+                        pid, status))
+                sys.stderr.flush()
+
+    terminate_workers(pool.all())
+    for pid in pool.all():
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+
+##### HTTP listener #####
+
+def create_http_socket(address):
+    """ Binds the listening socket for address ('host:port' or
+    '[v6 address]:port'). It is created before forking, so all the
+    workers accept() on it. """
+    host, port = address.rsplit(':', 1)
+    host = host.strip('[]')
+    family, socktype, proto, canonname, sockaddr = socket.getaddrinfo(
+        host or None, int(port), socket.AF_UNSPEC, socket.SOCK_STREAM, 0,
+        socket.AI_PASSIVE)[0]
+    sock = socket.socket(family, socktype, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(sockaddr)
+    sock.listen(ThreadingUnixStreamServer.request_queue_size)
+    sock.setblocking(False)
+    return sock
+
+
+def start_http_listener():
+    if http_socket is None:
+        return
+    # asyncio is not available on python 2, only import it when needed
+    import mirrorlist_http
+    mirrorlist_http.HTTPListener(
+        http_socket, http_answer, lambda: must_die,
+        trust_forwarded_for=http_trust_forwarded_for,
+        idle_timeout=connection_idle_timeout).start()
+
+
 class ThreadingUnixStreamServer(ThreadingMixIn, UnixStreamServer):
     request_queue_size = 300
+    # an Admission bounding the connections served at once, if set
+    connections = None
+
+    def get_request(self):
+        if self.connections is not None and \
+                self.connections.enter() is None:
+            # leave the connection in the backlog, the socket errors
+            # are ignored by the caller
+            raise socket.error('too many connections')
+        try:
+            return UnixStreamServer.get_request(self)
+        except:
+            if self.connections is not None:
+                self.connections.leave()
+            raise
+
+    def shutdown_request(self, request):
+        try:
+            UnixStreamServer.shutdown_request(self, request)
+        finally:
+            if self.connections is not None:
+                self.connections.leave()
+
     def finish_request(self, request, client_address):
         BaseServer.finish_request(self, request, client_address)
 
@@ -1068,14 +2341,30 @@ def parse_args():
     global internet2_netblocks_file
     global global_netblocks_file
     global logfile
+    global access_log
     global pidfile
     global minimum
     global country_continent_csv
+    global workers
+    global answer_cache_size
+    global file_details_cache_size
+    global directory_cache_size
+    global http_address
+    global http_trust_forwarded_for
+    global patchfile
+    global load_capacity
+    global load_window
+    global stats_socketfile
+    global max_in_flight
+    global max_connections
     opts, args = getopt.getopt(
-        sys.argv[1:], "c:i:g:p:s:dl:m:",
+        sys.argv[1:], "c:i:g:p:s:dl:m:w:",
         [
             "cache", "internet2_netblocks", "global_netblocks",
-            "pidfile", "socket", "log=", "minimum=", "cccsv="
+            "pidfile", "socket", "log=", "minimum=", "cccsv=", "workers=",
+            "answer-cache=", "file-details-cache=", "directory-cache=", "http=", "http-noreverseproxy", "patch=",
+            "load-capacity=", "load-window=", "stats-socket=",
+            "max-in-flight=", "max-connections="
         ]
     )
     for option, argument in opts:
@@ -1093,11 +2382,36 @@ def parse_args():
             country_continent_csv = argument
         if option in ("-l", "--log"):
             try:
-                logfile = open(argument, 'a')
+                access_log = AsyncLog(argument, syslogger)
+                logfile = argument
             except:
                 logfile = None
         if option in ("-m", "--minimum"):
             minimum = int(argument)
+        if option in ("-w", "--workers"):
+            workers = int(argument)
+        if option == "--answer-cache":
+            answer_cache_size = int(argument)
+        if option == "--file-details-cache":
+            file_details_cache_size = int(argument)
+        if option == "--directory-cache":
+            directory_cache_size = int(argument)
+        if option == "--http":
+            http_address = argument
+        if option == "--http-noreverseproxy":
+            http_trust_forwarded_for = False
+        if option == "--patch":
+            patchfile = argument
+        if option == "--load-capacity":
+            load_capacity = float(argument)
+        if option == "--load-window":
+            load_window = int(argument)
+        if option == "--stats-socket":
+            stats_socketfile = argument
+        if option == "--max-in-flight":
+            max_in_flight = int(argument)
+        if option == "--max-connections":
+            max_connections = int(argument)
 
     sys.stderr.write("Minimum mirrors is set to %d\n" % (minimum))
     sys.stderr.flush()
@@ -1113,43 +2427,27 @@ def open_geoip_databases():
 
 
 def convert_6to4_v4(ip):
-    all_6to4 = IP('2002::/16')
-    if ip.version() != 6 or ip not in all_6to4:
+    # 2002::/16, the IPv4 address follows the prefix
+    if ip.version() != 6 or ip.int() >> 112 != 0x2002:
         return None
-    parts=ip.strNormal().split(':')
-
-    ab = int(parts[1],16)
-    a = (ab >> 8) & 0xFF
-    b = ab & 0xFF
-    cd = int(parts[2],16)
-    c = (cd >> 8) & 0xFF
-    d = cd & 0xFF
-
-    v4addr = '%d.%d.%d.%d' % (a,b,c,d)
-    return IP(v4addr)
+    return ClientIP(4, (ip.int() >> 80) & 0xFFFFFFFF)
 
 
 def convert_teredo_v4(ip):
-    teredo_std = IP('2001::/32')
-    teredo_xp  = IP('3FFE:831F::/32')
-    if ip.version() != 6 or (ip not in teredo_std and ip not in teredo_xp):
+    # 2001::/32 and 3FFE:831F::/32, the last 32 bits are the inverted
+    # IPv4 address
+    if ip.version() != 6 or \
+            ip.int() >> 96 not in (0x20010000, 0x3FFE831F):
         return None
-    parts=ip.strNormal().split(':')
-
-    ab = int(parts[6],16)
-    a = ((ab >> 8) & 0xFF) ^ 0xFF
-    b = (ab & 0xFF) ^ 0xFF
-    cd = int(parts[7],16)
-    c = ((cd >> 8) & 0xFF) ^ 0xFF
-    d = (cd & 0xFF) ^ 0xFF
-
-    v4addr = '%d.%d.%d.%d' % (a,b,c,d)
-    return IP(v4addr)
+    return ClientIP(4, (ip.int() & 0xFFFFFFFF) ^ 0xFFFFFFFF)
 
 
 def load_databases_and_caches(*args, **kwargs):
     global database
     global country_continents
+    global cache_load_duration
+    global cache_loads
+    start = time.time()
 
     new_database = {
         'geoip': None,
@@ -1175,16 +2473,26 @@ def load_databases_and_caches(*args, **kwargs):
         'host_netblocks_tree': radix.Radix(),
         'netblock_country_tree': radix.Radix(),
         'location_cache': {},
-        'netblock_country_cache': {}
+        'netblock_country_cache': {},
+        'answer_cache': LRUCache(answer_cache_size),
+        'metalink_cache': LRUCache(file_details_cache_size),
         }
     sys.stderr.write("load_databases_and_caches...")
     sys.stderr.flush()
     new_database.update(open_geoip_databases())
     new_database.update(read_caches())
+    new_database['host_load'] = new_host_load(new_database)
+    new_database['repo_listing'], new_database['repo_arches'] = \
+        repo_listing(new_database['repo_arch_to_directoryname'])
     sys.stderr.write("done.\n")
+    sys.stderr.write("load timings: %s\n" % ', '.join(
+        '%s %.2fs' % (name, seconds)
+        for name, seconds in new_database['load_timings'].items()))
     sys.stderr.flush()
     # Update the entire in-memory structure at once
     database = new_database
+    cache_load_duration = time.time() - start
+    cache_loads += 1
 
 
 def remove_pidfile(pidfile):
@@ -1240,9 +2548,12 @@ def manage_pidfile(pidfile):
 
 
 def main():
-    global logfile
     global pidfile
+    global http_socket
+    global stats
+    global in_flight
     signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
     parse_args()
     manage_pidfile(pidfile)
 
@@ -1253,10 +2564,30 @@ def main():
         pass
 
     load_databases_and_caches()
-    signal.signal(signal.SIGHUP, sighup_handler)
-    # restart interrupted syscalls like select
-    signal.siginterrupt(signal.SIGHUP, False)
     ss = ThreadingUnixStreamServer(socketfile, MirrorlistHandler)
+    if max_connections > 0:
+        ss.connections = Admission(max_connections, 0.5)
+    if max_in_flight > 0:
+        in_flight = Admission(max_in_flight, admission_wait)
+    if http_address is not None:
+        http_socket = create_http_socket(http_address)
+    if stats_socketfile is not None:
+        stats = server_stats.Stats(2 * workers + 1)
+        start_stats_listener()
+
+    if workers > 0:
+        signal.signal(signal.SIGHUP, supervisor_sighup_handler)
+        signal.signal(signal.SIGUSR1, supervisor_sigusr1_handler)
+        signal.signal(signal.SIGTERM, sigterm_handler)
+        run_supervisor(ss)
+    else:
+        signal.signal(signal.SIGHUP, sighup_handler)
+        signal.signal(signal.SIGUSR1, sigusr1_handler)
+        # restart interrupted syscalls like select
+        signal.siginterrupt(signal.SIGHUP, False)
+        signal.siginterrupt(signal.SIGUSR1, False)
+        access_log.start()
+        start_http_listener()
 
     while not must_die:
         try:
@@ -1268,13 +2599,17 @@ def main():
         os.unlink(socketfile)
     except:
         pass
-
-    if logfile is not None:
+    if stats_socketfile is not None:
         try:
-            logfile.close()
+            os.unlink(stats_socketfile)
         except:
             pass
 
+    try:
+        access_log.close()
+    except:
+        pass
+
     remove_pidfile(pidfile)
     return 0
 
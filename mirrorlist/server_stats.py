@@ -0,0 +1,172 @@
+# Licensed under the MIT/X11 license
+
+# Request statistics of mirrorlist_server.py: how long the stages of a
+# request take, as histograms, and which stage found the mirrors.
+#
+# The numbers live in an anonymous shared memory mapping created before
+# the workers are forked. Every process adds to its own slot of it and
+# the supervisor sums up the slots when it is asked for the statistics,
+# so no locks are needed between processes. The threads of a process
+# share its slot without locking; an update lost to a race now and then
+# does not matter for these statistics.
+
+from bisect import bisect_left
+import ctypes
+import mmap
+import time
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# the stages of a request, in the order they run
+STAGES = (
+    # protobuf socket only: reading and decoding the request
+    'read', 'decode',
+    # do_mirrorlist()
+    'lookup', 'parse_ip', 'netblocks', 'asn', 'client_country',
+    'internet2', 'country', 'geoip', 'continent', 'global', 'shuffle',
+    'append_path', 'metalink',
+    # protobuf socket only: encoding and sending the answer
+    'encode', 'send',
+    'total',
+)
+
+# where_string of do_mirrorlist(), 'None' if no mirror was found at all,
+# 'error' for the requests answered with an error, 'busy' for the ones
+# turned away by admission control
+SOURCES = (
+    'location', 'netblocks', 'asn', 'I2', 'country', 'geoip', 'continent',
+    'global', 'None', 'error', 'busy',
+)
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0,
+)
+
+# per stage: the buckets, the one for slower requests and the sum
+HISTOGRAM_SIZE = len(BUCKETS) + 2
+STAGE_OFFSETS = dict(
+    (stage, i * HISTOGRAM_SIZE) for i, stage in enumerate(STAGES))
+SOURCE_OFFSETS = dict(
+    (source, len(STAGES) * HISTOGRAM_SIZE + i)
+    for i, source in enumerate(SOURCES))
+SLOT_SIZE = len(STAGES) * HISTOGRAM_SIZE + len(SOURCES)
+
+
+class Stats(object):
+    """ Statistics shared by up to slots processes. """
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.shm = mmap.mmap(-1, slots * SLOT_SIZE * ctypes.sizeof(
+            ctypes.c_double))
+        self.cells = (ctypes.c_double * (slots * SLOT_SIZE)).from_buffer(
+            self.shm)
+        self.base = 0
+
+    def use_slot(self, slot):
+        """ Makes this process add to the given slot. """
+        self.base = slot * SLOT_SIZE
+
+    def observe(self, stage, seconds):
+        offset = self.base + STAGE_OFFSETS[stage]
+        cells = self.cells
+        cells[offset + bisect_left(BUCKETS, seconds)] += 1
+        cells[offset + HISTOGRAM_SIZE - 1] += seconds
+
+    def count(self, source):
+        offset = SOURCE_OFFSETS.get(source)
+        if offset is not None:
+            self.cells[self.base + offset] += 1
+
+    def clock(self):
+        return Clock(self)
+
+    def totals(self):
+        """ The cells of all slots added up. """
+        cells = self.cells
+        totals = [0.0] * SLOT_SIZE
+        for base in range(0, self.slots * SLOT_SIZE, SLOT_SIZE):
+            for i in range(SLOT_SIZE):
+                totals[i] += cells[base + i]
+        return totals
+
+    def render(self, metrics=()):
+        """ The statistics in the Prometheus text format. metrics are
+        further (name, type, help, value) samples to include; value can
+        also be a dict of {labels: value}. """
+        totals = self.totals()
+        lines = [
+            '# HELP mirrorlist_stage_seconds Time spent in the stages of '
+            'a request.',
+            '# TYPE mirrorlist_stage_seconds histogram',
+        ]
+        for stage in STAGES:
+            offset = STAGE_OFFSETS[stage]
+            cumulative = 0
+            for i, le in enumerate(BUCKETS + ('+Inf',)):
+                cumulative += int(totals[offset + i])
+                lines.append(
+                    'mirrorlist_stage_seconds_bucket{stage="%s",le="%s"} %d'
+                    % (stage, le, cumulative))
+            lines.append('mirrorlist_stage_seconds_sum{stage="%s"} %r' % (
+                stage, totals[offset + HISTOGRAM_SIZE - 1]))
+            lines.append('mirrorlist_stage_seconds_count{stage="%s"} %d' % (
+                stage, cumulative))
+        lines.extend([
+            '# HELP mirrorlist_answers_total Answers by the stage which '
+            'found the first mirror.',
+            '# TYPE mirrorlist_answers_total counter',
+        ])
+        for source in SOURCES:
+            lines.append('mirrorlist_answers_total{source="%s"} %d' % (
+                source, totals[SOURCE_OFFSETS[source]]))
+        for name, metric_type, help, value in metrics:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            if isinstance(value, dict):
+                for labels, v in sorted(value.items()):
+                    lines.append('%s{%s} %r' % (name, labels, v))
+            else:
+                lines.append('%s %r' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+
+class Clock(object):
+    """ Times the stages of one request: lap(stage) accounts the time
+    since the previous lap to stage, done() the time since the start to
+    the total. """
+
+    __slots__ = ('stats', 'start', 'last')
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.start = self.last = timer()
+
+    def lap(self, stage):
+        now = timer()
+        self.stats.observe(stage, now - self.last)
+        self.last = now
+
+    def answered(self, source):
+        self.stats.count(source)
+
+    def done(self):
+        self.stats.observe('total', timer() - self.start)
+
+
+class NullClock(object):
+    """ The Clock used if statistics are disabled. """
+
+    def lap(self, stage):
+        pass
+
+    def answered(self, source):
+        pass
+
+    def done(self):
+        pass
+
+
+null_clock = NullClock()
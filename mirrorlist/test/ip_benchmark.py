@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#
+# Licensed under the MIT/X11 license
+
+# Microbenchmark of the IP address handling a mirrorlist request does:
+# parsing the client address, the normalized string the radix trees and
+# geoip are queried with, the 6to4/Teredo conversions of IPv6 clients
+# and ordering the preferred netblock results. "before" is what
+# mirrorlist_server.py did with IPy, "after" what it does now.
+#
+# usage: ip_benchmark.py [requests]
+
+from __future__ import print_function
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from IPy import IP
+import mirrorlist_server
+
+requests = 20000
+if len(sys.argv) > 1:
+    requests = int(sys.argv[1])
+
+random.seed(0)
+clients = []
+for i in range(requests):
+    kind = random.random()
+    if kind < 0.6:
+        clients.append('%d.%d.%d.%d' % tuple(
+            random.randint(1, 254) for j in range(4)))
+    elif kind < 0.9:
+        clients.append('2a01:%x:%x::%x' % tuple(
+            random.randint(0, 0xffff) for j in range(3)))
+    else:
+        clients.append('2002:%x:%x::1' % tuple(
+            random.randint(0, 0xffff) for j in range(2)))
+
+# what do_netblocks() found for a client with preferred netblocks
+prefixes = ['10.0.0.0/8', '10.1.0.0/16', '2001:db8::/32']
+netblocks = [
+    ((p.version(), p.len()), hostid)
+    for hostid, p in enumerate(IP(prefix) for prefix in prefixes)]
+
+
+def before_convert_6to4_v4(ip):
+    all_6to4 = IP('2002::/16')
+    if ip.version() != 6 or ip not in all_6to4:
+        return None
+    parts = ip.strNormal().split(':')
+    ab = int(parts[1], 16)
+    cd = int(parts[2], 16)
+    return IP('%d.%d.%d.%d' % (
+        (ab >> 8) & 0xFF, ab & 0xFF, (cd >> 8) & 0xFF, cd & 0xFF))
+
+
+def before_convert_teredo_v4(ip):
+    teredo_std = IP('2001::/32')
+    teredo_xp = IP('3FFE:831F::/32')
+    if ip.version() != 6 or (ip not in teredo_std and ip not in teredo_xp):
+        return None
+    parts = ip.strNormal().split(':')
+    ab = int(parts[6], 16)
+    cd = int(parts[7], 16)
+    return IP('%d.%d.%d.%d' % (
+        ((ab >> 8) & 0xFF) ^ 0xFF, (ab & 0xFF) ^ 0xFF,
+        ((cd >> 8) & 0xFF) ^ 0xFF, (cd & 0xFF) ^ 0xFF))
+
+
+def before_ordered_netblocks(s):
+    s = [(prefixes[hostid], hostid) for (netblock, hostid) in s]
+    v4 = []
+    v6 = []
+    for (prefix, hostid) in s:
+        ip = IP(prefix)
+        if ip.version() == 4:
+            v4.append((prefix, hostid))
+        elif ip.version() == 6:
+            v6.append((prefix, hostid))
+    v4.sort(key=lambda t: IP(t[0]).len())
+    v6.sort(key=lambda t: IP(t[0]).len())
+    return [t[1] for t in v6] + [t[1] for t in v4]
+
+
+def after_ordered_netblocks(s):
+    v4 = []
+    v6 = []
+    for t in s:
+        ((version, size), hostid) = t
+        if version == 4:
+            v4.append(t)
+        elif version == 6:
+            v6.append(t)
+    v4.sort(key=lambda t: t[0][1])
+    v6.sort(key=lambda t: t[0][1])
+    return [t[1] for t in v6] + [t[1] for t in v4]
+
+
+def request(client, parse, convert_6to4_v4, convert_teredo_v4,
+            ordered_netblocks):
+    ip = parse(client)
+    # host netblocks, ASN, internet2 and netblock country lookups
+    for i in range(4):
+        ip.strNormal()
+    if ip.version() == 6:
+        for scheme in (convert_6to4_v4, convert_teredo_v4):
+            result = scheme(ip)
+            if result is not None:
+                ip = result
+                break
+    ip.strNormal()
+    ordered_netblocks(netblocks)
+
+
+def before():
+    for client in clients:
+        request(client, IP, before_convert_6to4_v4, before_convert_teredo_v4,
+                before_ordered_netblocks)
+
+
+def after():
+    for client in clients:
+        request(client, mirrorlist_server.parse_ip,
+                mirrorlist_server.convert_6to4_v4,
+                mirrorlist_server.convert_teredo_v4,
+                after_ordered_netblocks)
+
+
+for name, f in (('before (IPy)', before), ('after', after)):
+    seconds = min(timeit.repeat(f, number=1, repeat=3))
+    print("%-14s %8.2f us per request" % (name, seconds / requests * 1e6))
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+#
+# Licensed under the MIT/X11 license
+
+# Replays mirrorlist requests and reports throughput, latency percentiles
+# and, when calling do_mirrorlist() in-process, garbage collections and
+# allocated memory blocks.
+#
+# The requests are taken from a mirrorlist_server.py access log (-l), or
+# made up from the repositories of the cache. The cache can be a real
+# one or a synthetic one written with --write-cache, so the benchmark
+# runs without any database:
+#
+#   replay_benchmark.py --write-cache /tmp/synthetic.pkl
+#   replay_benchmark.py --cache /tmp/synthetic.pkl --requests 20000
+#   replay_benchmark.py --socket /var/run/mirrormanager/mirrorlist_server.sock \
+#       --log /var/log/mirrormanager/mirrorlist.log --clients 8
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import gc
+import os
+import random
+import re
+import socket
+import sys
+import threading
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mirrorlist_protocol
+import mirrormanager_pb2
+
+timer = getattr(time, 'perf_counter', time.time)
+
+LOG_LINE = re.compile(
+    r'^IP: (?P<ip>[^;]*); DATE: [^;]*; COUNTRY: [^;]*; '
+    r'REPO: (?P<repo>[^;]*); ARCH: (?P<arch>.*)$')
+
+COUNTRIES = [
+    'US', 'CA', 'BR', 'DE', 'FR', 'GB', 'NL', 'CZ', 'SE', 'IT', 'JP', 'CN',
+    'IN', 'AU', 'ZA']
+
+
+def read_log(path):
+    """ The requests of the access log lines of mirrorlist_server.py. """
+    requests = []
+    with open(path) as f:
+        for line in f:
+            m = LOG_LINE.match(line.strip())
+            if m is None:
+                continue
+            requests.append({
+                'repo': m.group('repo'),
+                'arch': m.group('arch'),
+                'client_ip': m.group('ip'),
+                'metalink': False,
+            })
+    return requests
+
+
+def random_ip(rng):
+    if rng.random() < 0.8:
+        return '%d.%d.%d.%d' % tuple(rng.randint(1, 254) for i in range(4))
+    return '2a01:%x:%x::%x' % tuple(rng.randint(0, 0xffff) for i in range(3))
+
+
+def synthetic_requests(repos, count, seed=0, metalinks=0.1):
+    """ count requests for random (repo, arch) pairs of repos from random
+    clients, a share of them for metalinks. """
+    rng = random.Random(seed)
+    repos = sorted(repos)
+    requests = []
+    for i in range(count):
+        repo, arch = rng.choice(repos)
+        d = {
+            'repo': repo,
+            'arch': arch,
+            'client_ip': random_ip(rng),
+            'metalink': rng.random() < metalinks,
+        }
+        if rng.random() < 0.05:
+            d['country'] = rng.choice(COUNTRIES)
+        requests.append(d)
+    return requests
+
+
+def synthetic_cache(hosts=300, releases=20, seed=0):
+    """ A mirrorlist cache in the format mm2_refresh_mirrorlist_cache
+    writes, with hosts mirrors spread over the countries and releases
+    releases of four architectures. """
+    from IPy import IP
+
+    rng = random.Random(seed)
+    hostids = list(range(1, hosts + 1))
+    host_country = dict((h, rng.choice(COUNTRIES)) for h in hostids)
+    hcurl_cache = {}
+    host_urls = {}
+    for h in hostids:
+        host_urls[h] = []
+        for protocol in rng.sample(['http', 'https', 'ftp', 'rsync'], 2):
+            hcurl_id = len(hcurl_cache) + 1
+            hcurl_cache[hcurl_id] = '%s://mirror%d.example.org/pub' % (
+                protocol, h)
+            host_urls[h].append(hcurl_id)
+
+    mirrorlist_cache = {}
+    repo_arch_to_directoryname = {}
+    file_details_cache = {}
+    for release in range(100 - releases, 100):
+        for arch in ['x86_64', 'aarch64', 'ppc64le', 's390x']:
+            for repo, path in [
+                    ('fedora-%d', 'fedora/linux/releases/%d/Everything/%s/os'),
+                    ('updates-released-f%d',
+                     'fedora/linux/updates/%d/Everything/%s')]:
+                directory = 'pub/' + path % (release, arch)
+                selected = rng.sample(hostids, rng.randint(1, hosts // 2))
+                entry = {
+                    'global': set(),
+                    'byCountry': {},
+                    'byCountryInternet2': {},
+                    'byHostId': {},
+                    'ordered_mirrorlist': False,
+                    'subpath': path % (release, arch),
+                }
+                for h in selected:
+                    if rng.random() < 0.9:
+                        entry['global'].add(h)
+                        entry['byCountry'].setdefault(
+                            host_country[h], set()).add(h)
+                    entry['byHostId'][h] = list(host_urls[h])
+                mirrorlist_cache[directory] = entry
+                mirrorlist_cache[directory + '/repodata'] = entry
+                repo_arch_to_directoryname[(repo % release, arch)] = \
+                    directory
+                file_details_cache[directory + '/repodata'] = {
+                    'repomd.xml': [dict(
+                        timestamp=1500000000 + release, size=4000,
+                        sha1='1' * 40, md5='2' * 32, sha256='3' * 64,
+                        sha512='4' * 128)]}
+
+    host_netblock_cache = {}
+    for h in rng.sample(hostids, hosts // 10):
+        host_netblock_cache[IP('10.%d.0.0/16' % (h % 256))] = [h]
+    netblock_country_cache = dict(
+        (IP('172.%d.0.0/16' % (16 + i)), COUNTRIES[i])
+        for i in range(len(COUNTRIES)))
+    return {
+        'mirrorlist_cache': mirrorlist_cache,
+        'host_netblock_cache': host_netblock_cache,
+        'host_country_allowed_cache': {},
+        'host_bandwidth_cache': dict(
+            (h, rng.choice([10, 100, 1000, 10000])) for h in hostids),
+        'host_country_cache': host_country,
+        'host_max_connections_cache': dict(
+            (h, rng.randint(1, 10)) for h in hostids),
+        'asn_host_cache': {},
+        'repo_arch_to_directoryname': repo_arch_to_directoryname,
+        'repo_redirect_cache': {},
+        'country_continent_redirect_cache': {},
+        'disabled_repositories': {},
+        'file_details_cache': file_details_cache,
+        'hcurl_cache': hcurl_cache,
+        'location_cache': {},
+        'netblock_country_cache': netblock_country_cache,
+        'time': datetime.datetime.utcnow(),
+    }
+
+
+class SocketTarget(object):
+    """ Sends the requests to a running mirrorlist_server.py, one
+    connection per client. """
+
+    def __init__(self, socketfile):
+        self.socketfile = socketfile
+        self.local = threading.local()
+
+    def __call__(self, d):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.connect(self.socketfile)
+            self.local.connection = connection
+        mirrorlist_protocol.send_message(
+            connection, mirrorlist_protocol.encode_request(d))
+        response = mirrorlist_protocol.recv_message(
+            connection, mirrormanager_pb2.MirrorListResponse)
+        if response is None:
+            self.local.connection = None
+            raise EOFError('connection closed by the server')
+        return mirrorlist_protocol.decode_response(response)
+
+
+class InProcessTarget(object):
+    """ Calls do_mirrorlist() of mirrorlist_server.py directly. """
+
+    def __init__(self, cachefile, global_netblocks, internet2_netblocks):
+        import mirrorlist_server
+        self.server = mirrorlist_server
+        mirrorlist_server.cachefile = cachefile
+        mirrorlist_server.country_continent_csv = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), '..', '..',
+            'utility', 'country_continent.csv')
+        mirrorlist_server.global_netblocks_file = global_netblocks
+        mirrorlist_server.internet2_netblocks_file = internet2_netblocks
+        # measure the answers, not syslog
+        mirrorlist_server.access_log.syslogger = None
+        mirrorlist_server.load_databases_and_caches()
+
+    def repos(self):
+        return list(
+            self.server.database['repo_arch_to_directoryname'].keys())
+
+    def __call__(self, d):
+        return self.server.mirrorlist_answer(dict(d))
+
+
+def client(target, requests, latencies, errors):
+    for d in requests:
+        start = timer()
+        try:
+            target(d)
+        except Exception:
+            errors.append(sys.exc_info()[1])
+            continue
+        latencies.append(timer() - start)
+
+
+def percentile(values, p):
+    """ values has to be sorted. """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def gc_collections():
+    if not hasattr(gc, 'get_stats'):
+        return None
+    return sum(generation['collections'] for generation in gc.get_stats())
+
+
+def allocated_blocks():
+    if not hasattr(sys, 'getallocatedblocks'):
+        return None
+    return sys.getallocatedblocks()
+
+
+def replay(target, requests, clients=1, allocations=False):
+    """ Replays the requests, spread over clients threads. Returns a
+    dict of the results, with allocations also the garbage collections
+    and the allocated blocks of this process. """
+    shares = [requests[i::clients] for i in range(clients)]
+    latencies = [[] for i in range(clients)]
+    errors = []
+    threads = [
+        threading.Thread(
+            target=client, args=(target, shares[i], latencies[i], errors))
+        for i in range(clients)]
+    collections = blocks = None
+    if allocations:
+        collections = gc_collections()
+        blocks = allocated_blocks()
+    start = timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = timer() - start
+    result = {
+        'requests': len(requests),
+        'errors': len(errors),
+        'seconds': seconds,
+        'latencies': sorted(sum(latencies, [])),
+    }
+    if collections is not None:
+        result['gc_collections'] = gc_collections() - collections
+    if blocks is not None:
+        result['allocated_blocks'] = allocated_blocks() - blocks
+    return result
+
+
+def report(result):
+    latencies = result['latencies']
+    print("requests:   %d (%d errors)" % (
+        result['requests'], result['errors']))
+    print("throughput: %.1f requests/s" % (
+        result['requests'] / result['seconds']))
+    for p in (50, 90, 99):
+        print("p%d:        %8.1f us" % (p, percentile(latencies, p) * 1e6))
+    if latencies:
+        print("max:        %8.1f us" % (latencies[-1] * 1e6))
+    if 'gc_collections' in result:
+        print("gc collections: %d" % result['gc_collections'])
+    if 'allocated_blocks' in result:
+        print("allocated blocks (net): %+d" % result['allocated_blocks'])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Replay mirrorlist requests and measure the answers.')
+    parser.add_argument(
+        '--socket', help='replay against the server on this socket')
+    parser.add_argument(
+        '--cache', help='call do_mirrorlist() in-process with this cache, '
+        'with --socket: make up requests for its repositories')
+    parser.add_argument(
+        '--global-netblocks', default='/nonexistent',
+        help='global netblocks file for the in-process server')
+    parser.add_argument(
+        '--internet2-netblocks', default='/nonexistent',
+        help='internet2 netblocks file for the in-process server')
+    parser.add_argument(
+        '--log', help='replay the requests of this access log')
+    parser.add_argument(
+        '--requests', type=int, default=10000,
+        help='number of requests (the log is repeated or cut to it)')
+    parser.add_argument(
+        '--clients', type=int, default=1, help='concurrent clients')
+    parser.add_argument(
+        '--warmup', type=int, default=1000,
+        help='requests sent before measuring')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--write-cache', metavar='FILE',
+        help='write a synthetic cache to FILE and exit')
+    parser.add_argument(
+        '--hosts', type=int, default=300,
+        help='number of mirrors in the synthetic cache')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.write_cache:
+        with open(args.write_cache, 'wb') as f:
+            pickle.dump(synthetic_cache(args.hosts, seed=args.seed), f, 2)
+        return 0
+
+    if args.socket:
+        target = SocketTarget(args.socket)
+    elif args.cache:
+        target = InProcessTarget(
+            args.cache, args.global_netblocks, args.internet2_netblocks)
+    else:
+        print("either --socket or --cache is needed", file=sys.stderr)
+        return 1
+
+    if args.log:
+        requests = read_log(args.log)
+        if not requests:
+            print("no requests in %s" % args.log, file=sys.stderr)
+            return 1
+        requests = (requests * (args.requests // len(requests) + 1))[
+            :args.requests]
+    elif args.socket:
+        if not args.cache:
+            print("--log or --cache is needed with --socket",
+                  file=sys.stderr)
+            return 1
+        # requests for the repositories of the (pickled) cache the
+        # server was started with
+        with open(args.cache, 'rb') as f:
+            repos = pickle.load(f)['repo_arch_to_directoryname'].keys()
+        requests = synthetic_requests(repos, args.requests, args.seed)
+    else:
+        requests = synthetic_requests(
+            target.repos(), args.requests, args.seed)
+
+    allocations = isinstance(target, InProcessTarget)
+    replay(target, requests[:args.warmup], args.clients)
+    report(replay(target, requests, args.clients, allocations))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,59 +4,46 @@
 #  by Matt Domsch <Matt_Domsch@dell.com>
 # Licensed under the MIT/X11 license
 
-import socket, os
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
+import socket, os, sys
 import datetime
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mirrorlist_protocol
+import mirrormanager_pb2
+
 socketfile = '/var/run/mirrormanager/mirrorlist_server.sock'
+# number of requests sent on a connection before reading the answers
+pipeline = 1
 
 pid = os.getpid()
 connectTime = None
+connection = None
 
 
-def do_mirrorlist(d):
-    try:
-        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+def do_mirrorlist(requests):
+    global connection
+    global connectTime
+    if connection is None:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         start = datetime.datetime.utcnow()
-        s.connect(socketfile)
+        connection.connect(socketfile)
         end = datetime.datetime.utcnow()
-    except:
-        raise
-
-    global connectTime
-    connectTime = (end - start)
-    p = pickle.dumps(d)
-    size = len(p)
-    #print("writing size %s to server" % size)
-    s.sendall(str(size).encode().zfill(10))
-
-    # write the pickle
-    #print("writing the pickle")
-    s.sendall(p)
-    s.shutdown(socket.SHUT_WR)
-    del p
-
-    #print("reading result pickle size back")
-    readlen = 0
-    resultsize = b''
-    while readlen < 10:
-        resultsize += s.recv(10 - readlen)
-        readlen = len(resultsize)
-    resultsize = int(resultsize)
-
-    #print("reading %s bytes of the results list" % resultsize)
-    readlen = 0
-    p = b''
-    while readlen < resultsize:
-        p += s.recv(resultsize - readlen)
-        readlen = len(p)
-
-    s.shutdown(socket.SHUT_RD)
-    results = pickle.loads(p)
-    del p
+        connectTime = (end - start)
+
+    for d in requests:
+        mirrorlist_protocol.send_message(
+            connection, mirrorlist_protocol.encode_request(d))
+
+    results = []
+    for d in requests:
+        response = mirrorlist_protocol.recv_message(
+            connection, mirrormanager_pb2.MirrorListResponse)
+        if response is None:
+            # the server closed the connection, reconnect next time
+            connection.close()
+            connection = None
+            raise EOFError('connection closed by the server')
+        results.append(mirrorlist_protocol.decode_response(response))
 
     return results
 
@@ -64,23 +51,24 @@ def do_mirrorlist(d):
 # This takes 0.120-0.126 seconds, so should be done before any requests
 import random
 
-while True:
-    client_ip = "%s.%s.%s.%s" % (random.randint(0,255), random.randint(0,255), random.randint(0,255), random.randint(0,255))
-
-    d = {'repo':'fedora-28',
-         'arch':'x86_64',
-         'metalink':False}
+if len(sys.argv) > 1:
+    pipeline = int(sys.argv[1])
 
-    for k, v in list(d.items()):
-        try:
-            d[k] = str(v, 'utf8', 'replace')
-        except:
-            pass
+while True:
+    requests = []
+    for i in range(pipeline):
+        d = {'repo':'fedora-28',
+             'arch':'x86_64',
+             'metalink':False}
 
-    client_ip = "%s.%s.%s.%s" % (random.randint(0,255), random.randint(0,255), random.randint(0,255), random.randint(0,255))
-    d['client_ip'] = client_ip
+        client_ip = "%s.%s.%s.%s" % (random.randint(0,255), random.randint(0,255), random.randint(0,255), random.randint(0,255))
+        d['client_ip'] = client_ip
+        requests.append(d)
 
     start = datetime.datetime.utcnow()
-    result = do_mirrorlist(d)
+    try:
+        result = do_mirrorlist(requests)
+    except EOFError:
+        continue
     end = datetime.datetime.utcnow()
     print("[%s]   connect: %s  total: %s" % (pid, connectTime, (end-start)))
@@ -3,73 +3,34 @@
 # Licensed under the MIT/X11 license
 
 from __future__ import print_function
-from functools import total_ordering
 
 import random
-import bisect
+from operator import itemgetter
 
 
-@total_ordering
-class WeightedListItem:
-    def __init__(self, weight, data, start=0):
-        self.data = data
-        self.start = start
-        self.weight = weight
+# Picking an item with a probability proportional to its weight, removing
+# it and repeating with the remaining items (what this module used to do,
+# in O(n^2)) gives the same distribution as drawing an exponentially
+# distributed key with rate=weight for every item and sorting by the keys
+# (Efraimidis & Spirakis), which is O(n log n).
 
-        if type(weight) != int:
-            self.weight = 1
-        elif weight < 1:
-            self.weight = 1
 
-    def __contains__(self, val):
-        return (val >= self.start and val < (self.start + self.weight))
+def clamp_weight(weight):
+    if type(weight) != int or weight < 1:
+        return 1
+    return weight
 
-    def __eq__(self, other):
-        if other.start in self:
-            return false
-        return (self.start == other.start)
 
-    def __ne__(self, other):
-        return not (self.start == other.start)
-
-    def __lt__(self, other):
-        if other.start in self:
-            return False
-        return ((self.start, self.weight) < (other.start, other.weight))
-
-    def __repr__(self):
-        return "(%s, %s)" % (self.start, self.weight)
-
-
-class WeightedList(list):
-    def _assign(self):
-        start = 0
-        for item in self.__iter__():
-            item.start = start
-            start += item.weight
-
-    def _max(self):
-        value = 0
-        self._assign()
-        len = self.__len__()
-        if len > 0:
-            item = self.__getitem__(len-1)
-            value = item.start + item.weight
-        return value
-
-    def additem(self, weight, data):
-        a = WeightedListItem(weight, data)
-        list.append(self, a)
-
-    def choose(self):
-        length = self.__len__()
-        if length == 0:
-            return None
-        if length == 1:
-            return 0
-        r = random.randrange(0, self._max())
-        li = WeightedListItem(1, None, start=r)
-        return bisect.bisect_left(self, li)
+def weighted_order(items, weights):
+    """
+    prerequisite: invoke random.seed() before calling this function.
+    input: an iterable of items and a dict (or anything indexable)
+           mapping every item to its weight
+    output: a list of the items after being shuffled based on the weight
+    """
+    expovariate = random.expovariate
+    return sorted(
+        items, key=lambda item: expovariate(clamp_weight(weights[item])))
 
 
 def weighted_shuffle(l):
@@ -79,18 +40,13 @@ def weighted_shuffle(l):
            where weight is an int, and data can be anything
     output: a list of these tuples after being shuffled based on the weight
     """
-    wl = WeightedList()
+    expovariate = random.expovariate
+    keyed = []
     for (weight, data) in l:
-        wl.additem(weight, data)
-
-    returnlist = []
-    while len(wl) > 0:
-        a = wl.choose()
-        if a is not None:
-            item = wl[a]
-            returnlist.append((item.weight, item.data))
-            del wl[a]
-    return returnlist
+        weight = clamp_weight(weight)
+        keyed.append((expovariate(weight), weight, data))
+    keyed.sort(key=itemgetter(0))
+    return [(weight, data) for (key, weight, data) in keyed]
 
 
 def unit_test():
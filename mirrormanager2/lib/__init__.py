@@ -1123,12 +1123,17 @@ def uploaded_config(session, host, config):
     return message
 
 
-def query_directories(session):
+def query_directories(session, host_ids=None, yield_per=None):
     ''' Return the list of Directory, Host, HostCategoryUrl and Site
     information required by `refresh_mirrorlist_cache` to build the pickle
-    file.
+    file, ordered by directory name and host.
 
     :arg session: the session with which to connect to the database.
+    :kwarg host_ids: if set, only return the rows of the hosts with these
+        identifiers.
+    :kwarg yield_per: if set, return an iterator fetching the rows from a
+        server-side cursor this many at a time instead of the list of all
+        of them.
 
     '''
     query = session.query(
@@ -1163,6 +1168,9 @@ def query_directories(session):
         model.HostCategoryUrl.private == False
     )
 
+    if host_ids is not None:
+        query = query.filter(model.Host.id.in_(list(host_ids)))
+
     q1 = query.filter(
         model.HostCategoryDir.host_category_id == model.HostCategory.id
     ).filter(
@@ -1182,9 +1190,211 @@ def query_directories(session):
         'hostid'
     )
 
+    if yield_per is not None:
+        return iter(q.yield_per(yield_per))
     return q.all()
 
 
+def get_file_detail_columns(session, yield_per=None, directories=None):
+    ''' Return the (directory name, filename, timestamp, sha1, md5, sha256,
+    sha512, size) of every FileDetail, ordered by directory name, filename
+    and newest first.
+
+    :arg session: the session with which to connect to the database.
+    :kwarg yield_per: if set, return an iterator fetching the rows from a
+        server-side cursor this many at a time instead of the list of all
+        of them.
+    :kwarg directories: if set, only return the FileDetails of the
+        directories with these names.
+
+    '''
+    query = session.query(
+        model.Directory.name,
+        model.FileDetail.filename,
+        model.FileDetail.timestamp,
+        model.FileDetail.sha1,
+        model.FileDetail.md5,
+        model.FileDetail.sha256,
+        model.FileDetail.sha512,
+        model.FileDetail.size,
+    ).filter(
+        model.FileDetail.directory_id == model.Directory.id
+    ).order_by(
+        model.Directory.name,
+        model.FileDetail.filename,
+        model.FileDetail.timestamp.desc(),
+        model.FileDetail.id
+    )
+
+    if directories is not None:
+        query = query.filter(model.Directory.name.in_(list(directories)))
+
+    if yield_per is not None:
+        return iter(query.yield_per(yield_per))
+    return query.all()
+
+
+def get_file_detail_states(session):
+    ''' Return the (directory name, number of FileDetails, highest
+    FileDetail id) of every directory with FileDetails. FileDetails are
+    only ever added or deleted, so the FileDetails of a directory are
+    unchanged as long as these are.
+
+    :arg session: the session with which to connect to the database.
+
+    '''
+    query = session.query(
+        model.Directory.name,
+        sqlalchemy.func.count(model.FileDetail.id),
+        sqlalchemy.func.max(model.FileDetail.id),
+    ).filter(
+        model.FileDetail.directory_id == model.Directory.id
+    ).group_by(
+        model.Directory.name
+    )
+
+    return query.all()
+
+
+def get_host_states(session):
+    ''' Return, for every Host, the columns of the Host and its Site which
+    decide whether and how it appears in the mirrorlist cache, together
+    with the time of its last crawl and check-in.
+
+    :arg session: the session with which to connect to the database.
+
+    '''
+    query = session.query(
+        model.Host.id,
+        model.Host.last_crawled,
+        model.Host.last_checked_in,
+        model.Host.country,
+        model.Host.private,
+        model.Host.internet2,
+        model.Host.internet2_clients,
+        model.Host.user_active,
+        model.Host.admin_active,
+        model.Site.private,
+        model.Site.user_active,
+        model.Site.admin_active,
+    ).filter(
+        model.Host.site_id == model.Site.id
+    ).order_by(
+        model.Host.id
+    )
+
+    return query.all()
+
+
+def get_host_category_states(session):
+    ''' Return the HostCategory and HostCategoryUrl information of every
+    Host, as (host_id, host_category_id, category_id, always_up2date,
+    host_category_url_id, private) rows. The last two are None for a
+    HostCategory without url.
+
+    :arg session: the session with which to connect to the database.
+
+    '''
+    query = session.query(
+        model.HostCategory.host_id,
+        model.HostCategory.id,
+        model.HostCategory.category_id,
+        model.HostCategory.always_up2date,
+        model.HostCategoryUrl.id,
+        model.HostCategoryUrl.private,
+    ).outerjoin(
+        model.HostCategoryUrl,
+        model.HostCategoryUrl.host_category_id == model.HostCategory.id
+    ).order_by(
+        model.HostCategory.host_id,
+        model.HostCategory.id,
+        model.HostCategoryUrl.id
+    )
+
+    return query.all()
+
+
+def get_host_cache_columns(session):
+    ''' Return, for every Host, the columns which go into the host caches
+    of the mirrorlist, as (id, country, bandwidth_int, max_connections,
+    asn, asn_clients, admin_active, user_active, site_user_active) rows.
+
+    :arg session: the session with which to connect to the database.
+
+    '''
+    query = session.query(
+        model.Host.id,
+        model.Host.country,
+        model.Host.bandwidth_int,
+        model.Host.max_connections,
+        model.Host.asn,
+        model.Host.asn_clients,
+        model.Host.admin_active,
+        model.Host.user_active,
+        model.Site.user_active,
+    ).outerjoin(
+        model.Site,
+        model.Host.site_id == model.Site.id
+    ).order_by(
+        model.Host.id
+    )
+
+    return query.all()
+
+
+def get_host_netblock_columns(session):
+    ''' Return the (host_id, netblock) of every HostNetblock, ordered by
+    Host and netblock.
+
+    :arg session: the session with which to connect to the database.
+
+    '''
+    query = session.query(
+        model.HostNetblock.host_id,
+        model.HostNetblock.netblock,
+    ).order_by(
+        model.HostNetblock.host_id,
+        model.HostNetblock.netblock
+    )
+
+    return query.all()
+
+
+def get_host_country_allowed_columns(session):
+    ''' Return the (host_id, country) of every HostCountryAllowed, ordered
+    by Host.
+
+    :arg session: the session with which to connect to the database.
+
+    '''
+    query = session.query(
+        model.HostCountryAllowed.host_id,
+        model.HostCountryAllowed.country,
+    ).order_by(
+        model.HostCountryAllowed.host_id,
+        model.HostCountryAllowed.id
+    )
+
+    return query.all()
+
+
+def get_host_peer_asn_columns(session):
+    ''' Return the (host_id, asn) of every HostPeerAsn, ordered by Host.
+
+    :arg session: the session with which to connect to the database.
+
+    '''
+    query = session.query(
+        model.HostPeerAsn.host_id,
+        model.HostPeerAsn.asn,
+    ).order_by(
+        model.HostPeerAsn.host_id,
+        model.HostPeerAsn.id
+    )
+
+    return query.all()
+
+
 def get_directory_exclusive_host(session):
     ''' Return the list of Directory that are exclusive for some hosts.
 
@@ -21,22 +21,23 @@
 
 from __future__ import print_function
 
+import calendar
 import datetime
 import time
 import os
 import hashlib
+import marshal
+import struct
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
-from operator import itemgetter
 
 from IPy import IP
-import pprint
-import dns.resolver
 
 import mirrormanager2.lib
+import mirrormanager2.lib.netblock_dns
 import mirrormanager2.lib.mirrormanager_pb2 as mm_pb2
 
 
@@ -56,6 +57,16 @@ global_caches = dict(
 
 data = dict()
 
+# seconds a refresh waits for the host names given as netblocks to be
+# resolved
+DNS_DEADLINE = 60
+
+# rows of query_directories() and get_file_detail_columns() fetched
+# from the database at a time
+DIRECTORY_ROWS_PER_FETCH = 10000
+FILE_DETAIL_ROWS_PER_FETCH = 10000
+
+
 def parent_dir(path):
     return os.path.dirname(path)
 
@@ -72,19 +83,91 @@ def add_host_to_set(s, hostid):
     s.add(hostid)
 
 
-def shrink(mc):
-    pp = pprint.PrettyPrinter()
+class SubcacheInterner(object):
+    ''' Makes equal subcaches of the mirrorlist_cache entries the same
+    object, down to the host sets in them, so they are stored once in
+    memory and in the pickle.
+
+    Sets are replaced by frozensets and lists by tuples, so nothing can
+    change a subcache which is shared behind the back of the others.
+    Dicts are replaced by new dicts, in the order of their keys, of
+    their interned values and must not be modified either; entries to
+    update are copied first, see copy_directory_entry(). All of them are
+    built in sorted order, so equal caches are pickled the same way. '''
+
+    def __init__(self):
+        self.seen = {}
+        # the number of sets, lists and dicts interned
+        self.objects = 0
+        # id() of the values passed to known(): their shared instance
+        self.known_ids = {}
+
+    def intern(self, value):
+        if isinstance(value, dict):
+            value = dict(
+                (k, self.intern(v)) for k, v in sorted(value.items()))
+            # the values are interned, equal ones are the same object
+            key = (dict, tuple((k, id(v)) for k, v in value.items()))
+        elif isinstance(value, (set, frozenset)):
+            value = frozenset(sorted(value))
+            key = (frozenset, value)
+        elif isinstance(value, (list, tuple)):
+            value = tuple(value)
+            key = (tuple, value)
+        else:
+            return value
+        self.objects += 1
+        return self.seen.setdefault(key, value)
+
+    def known(self, value):
+        ''' Make value, interned before (by any interner), available to
+        be shared by the values interned next, without copying it.
+        Return the instance which is shared, or None if value is not in
+        its interned form. '''
+        if id(value) in self.known_ids:
+            # already shared in the source
+            return self.known_ids[id(value)]
+        if isinstance(value, dict):
+            values = []
+            for k, v in sorted(value.items()):
+                v = self.known(v)
+                if v is None:
+                    return None
+                values.append((k, id(v)))
+            key = (dict, tuple(values))
+        elif isinstance(value, frozenset):
+            key = (frozenset, value)
+        elif isinstance(value, tuple):
+            key = (tuple, value)
+        else:
+            return None
+        shared = self.known_ids[id(value)] = self.seen.setdefault(key, value)
+        return shared
+
+    def report(self):
+        ''' How many of the interned objects were shared. '''
+        unique = len(self.seen)
+        shared = self.objects - unique
+        return '%d of %d sets, lists and dicts shared (%.1f%%)' % (
+            shared, self.objects,
+            100.0 * shared / self.objects if self.objects else 0)
+
+
+def shrink_entry(entry, interner):
+    ''' Replace the subcaches of one mirrorlist_cache entry by equal ones
+    seen before by interner. '''
     subcaches = ('global', 'byCountry', 'byHostId', 'byCountryInternet2')
-    matches = {}
+    for subcache in subcaches:
+        entry[subcache] = interner.intern(entry[subcache])
+
+
+def shrink(mc):
+    ''' Share the equal subcaches of the mirrorlist_cache entries in mc.
+    Return how many of them were shared. '''
+    interner = SubcacheInterner()
     for d in mc:
-        for subcache in subcaches:
-            c = mc[d][subcache]
-            s = hashlib.sha1(pp.pformat(c).encode('utf-8')).hexdigest()
-            if s in matches:
-                mc[d][subcache] = matches[s]
-            else:
-                matches[s] = c
-    return mc
+        shrink_entry(mc[d], interner)
+    return interner.report()
 
 
 def query_directory_exclusive_host(session):
@@ -98,11 +181,9 @@ def query_directory_exclusive_host(session):
     return cache
 
 
-def populate_directory_cache(session):
-    global global_caches
-    result = mirrormanager2.lib.query_directories(session)
-
-    directory_exclusive_hosts = query_directory_exclusive_host(session)
+def directory_cache_context(session):
+    ''' Collect everything, besides the rows of query_directories(),
+    needed to turn a directory into a mirrorlist_cache entry. '''
 
     def setup_directory_repo_cache(session):
         cache = {}
@@ -111,169 +192,228 @@ def populate_directory_cache(session):
                 append_value_to_cache(cache, r.directory.id, r)
         return cache
 
-    def setup_version_ordered_mirrorlist_cache(session):
-        cache = {}
-        for v in mirrormanager2.lib.get_versions(session):
-            cache[v.id] = v.ordered_mirrorlist
-        return cache
-
     def setup_category_topdir_cache(session):
         cache = {}
         for c in mirrormanager2.lib.get_categories(session):
             cache[c.id] = len(c.topdir.name) + 1  # include trailing /
         return cache
 
-    directory_repo_cache = setup_directory_repo_cache(session)
-    cat_dirs = mirrormanager2.lib.get_category_directory(session)
     directory_category_cache = {}
-    for catdir in cat_dirs:
+    for catdir in mirrormanager2.lib.get_category_directory(session):
         append_value_to_cache(
             directory_category_cache, catdir.directory_id, catdir.category_id)
-    version_ordered_mirrorlist_cache = setup_version_ordered_mirrorlist_cache(
-        session)
-    category_topdir_cache = setup_category_topdir_cache(session)
-
-    cache = {}
-    for (directory_id, directoryname, hostid, country, hcurl,
-            siteprivate, hostprivate, i2, i2_clients) in result:
-        if directoryname in directory_exclusive_hosts and \
-                hostid not in directory_exclusive_hosts[directoryname]:
-            continue
 
-        if directoryname not in cache:
-            cache[directoryname] = {
-                'global': set(),
-                'byCountry': {},
-                'byHostId': {},
-                'ordered_mirrorlist': True,
-                'byCountryInternet2': {}
-            }
-
-            repos = directory_repo_cache.get(directory_id)
-
-            if repos:
-                for repo in repos:
-                    if repo is not None \
-                            and repo.arch is not None \
-                            and repo.prefix:
-                        global_caches['repo_arch_to_directoryname'][
-                            (repo.prefix, repo.arch.name)] = directoryname
-                        # WARNING - this is a query # fixme use cache
-                        cache[directoryname][
-                            'ordered_mirrorlist'
-                        ] = repo.version.ordered_mirrorlist
-
-            numcats = len(directory_category_cache.get(directory_id, []))
-            if numcats == 0:
-                # no category, so we can't know a mirror host's URLs.
-                # nothing to add.
-                continue
-            elif numcats >= 1:
-                # any of them will do, so just look at the first one
-                category_id = directory_category_cache[directory_id][0]
-
-            cache[directoryname]['subpath'] = directoryname[
-                category_topdir_cache[category_id]:]
-            del repos
+    return dict(
+        exclusive_hosts=query_directory_exclusive_host(session),
+        directory_repos=setup_directory_repo_cache(session),
+        directory_categories=directory_category_cache,
+        category_topdirs=setup_category_topdir_cache(session),
+    )
+
+
+def structure_state(context):
+    ''' A digest of the directory, category and repository layout in
+    context. The mirrorlist_cache can only be updated incrementally while
+    it stays the same. '''
+    items = []
+    for directory_id, repos in sorted(context['directory_repos'].items()):
+        for r in repos:
+            items.append((
+                directory_id, r.id, r.prefix, r.arch.name,
+                r.version.ordered_mirrorlist))
+    items.append(sorted(
+        (d, sorted(c)) for d, c in context['directory_categories'].items()))
+    items.append(sorted(context['category_topdirs'].items()))
+    items.append(sorted(
+        (d, sorted(h)) for d, h in context['exclusive_hosts'].items()))
+    return hashlib.sha1(repr(items).encode('utf-8')).hexdigest()
+
+
+def add_directory_row(cache, context, row):
+    ''' Add one row of query_directories() to the mirrorlist cache. '''
+    (directory_id, directoryname, hostid, country, hcurl,
+        siteprivate, hostprivate, i2, i2_clients) = row
+    directory_exclusive_hosts = context['exclusive_hosts']
+    if directoryname in directory_exclusive_hosts and \
+            hostid not in directory_exclusive_hosts[directoryname]:
+        return
+
+    if directoryname not in cache:
+        cache[directoryname] = {
+            'global': set(),
+            'byCountry': {},
+            'byHostId': {},
+            'ordered_mirrorlist': True,
+            'byCountryInternet2': {}
+        }
+
+        repos = context['directory_repos'].get(directory_id)
+
+        if repos:
+            for repo in repos:
+                if repo is not None \
+                        and repo.arch is not None \
+                        and repo.prefix:
+                    global_caches['repo_arch_to_directoryname'][
+                        (repo.prefix, repo.arch.name)] = directoryname
+                    # WARNING - this is a query # fixme use cache
+                    cache[directoryname][
+                        'ordered_mirrorlist'
+                    ] = repo.version.ordered_mirrorlist
+
+        categories = context['directory_categories'].get(directory_id, [])
+        if len(categories) == 0:
+            # no category, so we can't know a mirror host's URLs.
+            # nothing to add.
+            return
+        # any of them will do, so just look at the first one
+        category_id = categories[0]
+
+        cache[directoryname]['subpath'] = directoryname[
+            context['category_topdirs'][category_id]:]
+
+    if country is not None:
+        country = country.upper()
+
+    if not siteprivate and not hostprivate:
+        add_host_to_set(cache[directoryname]['global'], hostid)
 
         if country is not None:
-            country = country.upper()
+            if country not in cache[directoryname]['byCountry']:
+                cache[directoryname]['byCountry'][country] = set()
+            add_host_to_set(
+                cache[directoryname]['byCountry'][country], hostid)
 
-        if not siteprivate and not hostprivate:
-            add_host_to_set(cache[directoryname]['global'], hostid)
+    if country is not None and i2 and \
+            ((not siteprivate and not hostprivate) or i2_clients):
+        if country not in cache[directoryname]['byCountryInternet2']:
+            cache[directoryname]['byCountryInternet2'][country] = set()
+        add_host_to_set(
+            cache[directoryname]['byCountryInternet2'][country], hostid)
 
-            if country is not None:
-                if country not in cache[directoryname]['byCountry']:
-                    cache[directoryname]['byCountry'][country] = set()
-                add_host_to_set(
-                    cache[directoryname]['byCountry'][country], hostid)
+    append_value_to_cache(cache[directoryname]['byHostId'], hostid, hcurl)
 
-        if country is not None and i2 and \
-                ((not siteprivate and not hostprivate) or i2_clients):
-            if country not in cache[directoryname]['byCountryInternet2']:
-                cache[directoryname]['byCountryInternet2'][country] = set()
-            add_host_to_set(
-                cache[directoryname]['byCountryInternet2'][country], hostid)
 
-        append_value_to_cache(cache[directoryname]['byHostId'], hostid, hcurl)
+def populate_directory_cache(session, context=None):
+    ''' Build the mirrorlist_cache. Return how many of its subcaches
+    were shared, see shrink(). '''
+    global global_caches
+    if context is None:
+        context = directory_cache_context(session)
 
-    global_caches['mirrorlist_cache'] = shrink(cache)
+    # the rows are streamed in directory order, so every directory is
+    # complete, and shrunk, as soon as the next one starts; the rows are
+    # never all held in memory at once
+    cache = {}
+    interner = SubcacheInterner()
+    current = None
+    for row in mirrormanager2.lib.query_directories(
+            session, yield_per=DIRECTORY_ROWS_PER_FETCH):
+        dname = row[1]
+        if dname != current:
+            if current in cache:
+                shrink_entry(cache[current], interner)
+            current = dname
+        add_directory_row(cache, context, row)
+    if current in cache:
+        shrink_entry(cache[current], interner)
+    drop_directories_without_hosts(cache, list(cache))
+
+    global_caches['mirrorlist_cache'] = cache
+    return interner.report()
+
+
+def drop_directories_without_hosts(cache, dnames):
+    ''' Remove the entries of the directories in dnames which no host
+    carries (which have no category, or lost their last host) from the
+    mirrorlist cache, together with the repositories pointing at them.
+    The full and the incremental refresh both leave them out. '''
+    dropped = set(
+        dname for dname in dnames
+        if dname in cache and not cache[dname]['byHostId'])
+    if not dropped:
+        return
+    for dname in dropped:
+        del cache[dname]
+    repo_arch_to_directoryname = global_caches['repo_arch_to_directoryname']
+    for key, dname in list(repo_arch_to_directoryname.items()):
+        if dname in dropped:
+            del repo_arch_to_directoryname[key]
+
+
+def parse_netblock(netblock):
+    ''' Returns the IP of netblock, or None if it is a host name. '''
+    try:
+        return IP(netblock)
+    except ValueError:
+        # probably a string
+        return None
 
 
-def name_to_ips(name):
+def name_to_ips(addresses):
     result = []
-    recordtypes = ('A', 'AAAA')
-    for r in recordtypes:
+    for address in addresses:
         try:
-            records = dns.resolver.query(name, r)
-            for rdata in records:
-                try:
-                    ip = IP(str(rdata))
-                    result.append(ip)
-                except:
-                    continue
-        except:
+            result.append(IP(address))
+        except ValueError:
             continue
     return result
 
 
-def populate_netblock_cache(cache, host):
-    if host.is_active() and len(host.netblocks) > 0:
-        for n in list(host.netblocks):
-            try:
-                ip = IP(n.netblock)
-                ips = [ip]
-            except ValueError:
-                # probably a string
-                ips = name_to_ips(n.netblock)
+def populate_netblock_cache(cache, hostid, netblocks, resolved):
+    ''' resolved holds the addresses of the netblocks which are host
+    names, see netblock_dns.resolve_names(). '''
+    for netblock in netblocks:
+        ip = parse_netblock(netblock)
+        if ip is not None:
+            ips = [ip]
+        else:
+            ips = name_to_ips(resolved.get(netblock, []))
 
-            for ip in ips:
-                append_value_to_cache(cache, ip, host.id)
+        for ip in ips:
+            append_value_to_cache(cache, ip, hostid)
     return cache
 
 
-def populate_host_country_allowed_cache(cache, host):
-    if host.is_active() and len(host.countries_allowed) > 0:
-        cache[host.id] = [
-            c.country.upper()
-            for c in list(host.countries_allowed)
-        ]
+def populate_host_country_allowed_cache(cache, hostid, countries):
+    if len(countries) > 0:
+        cache[hostid] = [c.upper() for c in countries]
     return cache
 
 
-def populate_host_max_connections_cache(cache, host):
-    cache[host.id] = host.max_connections
+def populate_host_max_connections_cache(cache, hostid, max_connections):
+    cache[hostid] = max_connections
     return cache
 
 
-def populate_host_bandwidth_cache(cache, host):
+def populate_host_bandwidth_cache(cache, hostid, bandwidth):
     try:
-        i = int(host.bandwidth_int)
+        i = int(bandwidth)
         if i < 1:
             i = 1
         elif i > 100000:
             i = 100000  # max bandwidth 100Gb
-        cache[host.id] = i
+        cache[hostid] = i
     except:
-        cache[host.id] = 1
+        cache[hostid] = 1
 
     return cache
 
 
-def populate_host_country_cache(cache, host):
-    cache[host.id] = host.country
+def populate_host_country_cache(cache, hostid, country):
+    cache[hostid] = country
     return cache
 
 
-def populate_host_asn_cache(cache, host):
-    if not host.asn_clients:
+def populate_host_asn_cache(cache, hostid, asn, asn_clients, peer_asns):
+    if not asn_clients:
         return cache
 
-    if host.asn is not None:
-        append_value_to_cache(cache, host.asn, host.id)
+    if asn is not None:
+        append_value_to_cache(cache, asn, hostid)
 
-    for peer_asn in list(host.peer_asns):
-        append_value_to_cache(cache, peer_asn.asn, host.id)
+    for peer_asn in peer_asns:
+        append_value_to_cache(cache, peer_asn, hostid)
     return cache
 
 
@@ -299,30 +439,34 @@ def disabled_repository_cache(session):
     return cache
 
 
-def file_details_cache(session):
-    # cache{directoryname}{filename}[{details}]
+def file_details_cache(session, max_file_details=None, directories=None):
+    ''' cache{directoryname}{filename}[{details}], the details of each
+    file newest first, at most max_file_details of them if set. Only
+    the directories in directories are looked at, if set. '''
     cache = {}
-    # materialize this select to avoid making hundreds of thousands of queries
-    for d in mirrormanager2.lib.get_directories(session):
-        if len(d.fileDetails) > 0:
-            cache[d.name] = {}
-            for fd in list(d.fileDetails):
-                details = dict(
-                    timestamp=fd.timestamp,
-                    sha1=fd.sha1,
-                    md5=fd.md5,
-                    sha256=fd.sha256,
-                    sha512=fd.sha512,
-                    size=fd.size)
-                append_value_to_cache(cache[d.name], fd.filename, details)
-
-    for dir in cache.keys():
-        for file in cache[dir].keys():
-            if len(cache[dir][file]) > 1:
-                cache[dir][file] = sorted(
-                    cache[dir][file],
-                    key=itemgetter('timestamp'),
-                    reverse=True)
+    current = None
+    # a single query ordered the way the cache is built, streamed
+    # without loading any ORM objects
+    for (directoryname, filename, timestamp, sha1, md5, sha256, sha512,
+            size) in mirrormanager2.lib.get_file_detail_columns(
+                session, yield_per=FILE_DETAIL_ROWS_PER_FETCH,
+                directories=directories):
+        if directoryname != current:
+            files = cache[directoryname] = {}
+            current = directoryname
+        details = files.get(filename)
+        if details is None:
+            details = files[filename] = []
+        elif max_file_details is not None and \
+                len(details) >= max_file_details:
+            continue
+        details.append(dict(
+            timestamp=timestamp,
+            sha1=sha1,
+            md5=md5,
+            sha256=sha256,
+            sha512=sha512,
+            size=size))
 
     return cache
 
@@ -356,7 +500,19 @@ def netblock_country_cache(session):
     return cache
 
 
-def populate_host_caches(session):
+def values_by_host(rows):
+    ''' Turn (host_id, value) rows into {host_id: [value, ...]}. '''
+    cache = {}
+    for hostid, value in rows:
+        append_value_to_cache(cache, hostid, value)
+    return cache
+
+
+def populate_host_caches(session, dns_cache_file=None,
+                         dns_deadline=DNS_DEADLINE):
+    ''' Populate the host caches. The host names given as netblocks are
+    resolved within dns_deadline seconds; their answers are kept in
+    dns_cache_file, if set, see netblock_dns.resolve_names(). '''
     n = dict()
     ca = dict()
     b = dict()
@@ -364,13 +520,34 @@ def populate_host_caches(session):
     a = dict()
     mc = dict()
 
-    for host in list(mirrormanager2.lib.get_hosts(session)):
-        n = populate_netblock_cache(n, host)
-        ca = populate_host_country_allowed_cache(ca, host)
-        b = populate_host_bandwidth_cache(b, host)
-        cc = populate_host_country_cache(cc, host)
-        a = populate_host_asn_cache(a, host)
-        mc = populate_host_max_connections_cache(mc, host)
+    # a few queries for all hosts instead of loading the relations of
+    # every host on its own
+    netblocks = values_by_host(
+        mirrormanager2.lib.get_host_netblock_columns(session))
+    countries_allowed = values_by_host(
+        mirrormanager2.lib.get_host_country_allowed_columns(session))
+    peer_asns = values_by_host(
+        mirrormanager2.lib.get_host_peer_asn_columns(session))
+    # resolve all the host names given as netblocks at once
+    resolved = mirrormanager2.lib.netblock_dns.resolve_names(
+        [netblock for host_netblocks in netblocks.values()
+         for netblock in host_netblocks if parse_netblock(netblock) is None],
+        cache_file=dns_cache_file, deadline=dns_deadline)
+
+    for (hostid, country, bandwidth, max_connections, asn, asn_clients,
+            admin_active, user_active, site_user_active) in \
+            mirrormanager2.lib.get_host_cache_columns(session):
+        # Host.is_active()
+        if admin_active and user_active and site_user_active:
+            n = populate_netblock_cache(
+                n, hostid, netblocks.get(hostid, []), resolved)
+            ca = populate_host_country_allowed_cache(
+                ca, hostid, countries_allowed.get(hostid, []))
+        b = populate_host_bandwidth_cache(b, hostid, bandwidth)
+        cc = populate_host_country_cache(cc, hostid, country)
+        a = populate_host_asn_cache(
+            a, hostid, asn, asn_clients, peer_asns.get(hostid, []))
+        mc = populate_host_max_connections_cache(mc, hostid, max_connections)
 
     global global_caches
     global_caches['host_netblock_cache'] = n
@@ -381,11 +558,40 @@ def populate_host_caches(session):
     global_caches['host_max_connections_cache'] = mc
 
 
-def populate_all_caches(session):
-    global data
-    populate_host_caches(session)
-    populate_directory_cache(session)
-    data = {
+def host_state_cache(session):
+    ''' Everything about every host which goes into its rows of
+    query_directories(), including the time of its last crawl and
+    check-in (which is when its HostCategoryDirs change). A host whose
+    state is unchanged has the same rows as before. '''
+    cache = {}
+    for row in mirrormanager2.lib.get_host_states(session):
+        cache[row[0]] = [tuple(row[1:])]
+    for row in mirrormanager2.lib.get_host_category_states(session):
+        if row[0] in cache:
+            cache[row[0]].append(tuple(row[1:]))
+    return dict((hostid, tuple(state)) for hostid, state in cache.items())
+
+
+def file_detail_state(session, max_file_details=None):
+    ''' What the file_details_cache was built from: max_file_details and
+    {directoryname: (number of FileDetails, highest FileDetail id)}. '''
+    return (max_file_details, dict(
+        (row[0], tuple(row[1:]))
+        for row in mirrormanager2.lib.get_file_detail_states(session)))
+
+
+def cache_data(session, context, max_file_details=None, file_details=None,
+               file_state=None):
+    ''' Collect the caches populated by populate_host_caches() and
+    populate_directory_cache() together with all the others. The
+    file_details_cache is built unless it is given, together with the
+    file_detail_state() it was built from. '''
+    if file_details is None:
+        # before the FileDetails are read: anything added meanwhile is
+        # picked up by the next incremental refresh
+        file_state = file_detail_state(session, max_file_details)
+        file_details = file_details_cache(session, max_file_details)
+    return {
         'mirrorlist_cache': global_caches['mirrorlist_cache'],
         'host_netblock_cache': global_caches['host_netblock_cache'],
         'host_country_allowed_cache': global_caches['host_country_allowed_cache'],
@@ -398,22 +604,427 @@ def populate_all_caches(session):
         'repo_redirect_cache': repository_redirect_cache(session),
         'country_continent_redirect_cache': country_continent_redirect_cache(session),
         'disabled_repositories': disabled_repository_cache(session),
-        'file_details_cache': file_details_cache(session),
+        'file_details_cache': file_details,
         'hcurl_cache': hcurl_cache(session),
         'location_cache': location_cache(session),
         'netblock_country_cache': netblock_country_cache(session),
         'time': datetime.datetime.utcnow(),
+        # only used by populate_changed_caches()
+        'host_state': host_state_cache(session),
+        'structure_state': structure_state(context),
+        'file_detail_state': file_state,
+    }
+
+
+def populate_all_caches(session, dns_cache_file=None,
+                        dns_deadline=DNS_DEADLINE, max_file_details=None):
+    ''' Build all the caches. Return how many of the mirrorlist_cache
+    subcaches were shared, see shrink(). '''
+    global data
+    global_caches['repo_arch_to_directoryname'] = {}
+    context = directory_cache_context(session)
+    populate_host_caches(session, dns_cache_file, dns_deadline)
+    report = populate_directory_cache(session, context)
+    data = cache_data(session, context, max_file_details)
+    return report
+
+
+# Caches which are not part of a patch
+PATCH_SKIPPED = (
+    'time', 'host_state', 'structure_state', 'file_detail_state')
+PATCH_VERSION = 2
+
+
+def copy_directory_entry(entry, without=frozenset()):
+    ''' Copy a mirrorlist_cache entry, which may share its sets and
+    dicts with other entries (see shrink()), leaving out the hosts in
+    without. '''
+    copy = dict(entry)
+    copy['global'] = set(entry['global']) - without
+    for key in ('byCountry', 'byCountryInternet2'):
+        copy[key] = {}
+        for country, hosts in entry[key].items():
+            hosts = set(hosts) - without
+            if hosts:
+                copy[key][country] = hosts
+    copy['byHostId'] = dict(
+        (hostid, list(hcurls))
+        for hostid, hcurls in entry['byHostId'].items()
+        if hostid not in without)
+    return copy
+
+
+def diff_cache(old, new, keys=None):
+    ''' Return the (updated, removed) entries between two versions of a
+    cache dict, only looking at the entries of keys if set. '''
+    if keys is None:
+        keys = list(new) + [key for key in old if key not in new]
+    else:
+        keys = sorted(keys)
+    updated = {}
+    removed = []
+    for key in keys:
+        if key not in new:
+            if key in old:
+                removed.append(key)
+            continue
+        value = new[key]
+        if key not in old or (old[key] is not value and old[key] != value):
+            updated[key] = value
+    return (updated, removed)
+
+
+def populate_changed_caches(session, previous, dns_cache_file=None,
+                            dns_deadline=DNS_DEADLINE,
+                            max_file_details=None):
+    ''' Update the caches of a previous run (as loaded from the pickle
+    written by dump_caches()) instead of rebuilding them. Only the
+    mirrorlist_cache entries of the directories carried by hosts which
+    have been crawled, checked in or edited since then are rebuilt, and
+    only the file_details_cache entries of the directories whose
+    FileDetails were added or deleted. The host caches come from a few
+    queries over all hosts and are rebuilt every time.
+
+    Return the patch with the changes against previous (see
+    dump_patch()), or None if the directory, category or repository
+    layout changed, in which case populate_all_caches() is needed.
+
+    The host names given as netblocks are resolved as in
+    populate_host_caches(). '''
+    global data
+    if 'host_state' not in previous or 'structure_state' not in previous \
+            or 'file_detail_state' not in previous:
+        return None
+    context = directory_cache_context(session)
+    if structure_state(context) != previous['structure_state']:
+        return None
+
+    old_state = previous['host_state']
+    new_state = host_state_cache(session)
+    changed = set(
+        hostid for hostid in set(old_state) | set(new_state)
+        if old_state.get(hostid) != new_state.get(hostid))
+
+    old_cache = previous['mirrorlist_cache']
+    global_caches['repo_arch_to_directoryname'] = dict(
+        previous['repo_arch_to_directoryname'])
+    touched = {}
+    if changed:
+        for dname, entry in old_cache.items():
+            if not changed.isdisjoint(entry['byHostId']):
+                touched[dname] = copy_directory_entry(entry, changed)
+        for row in mirrormanager2.lib.query_directories(
+                session, host_ids=changed):
+            dname = row[1]
+            if dname not in touched and dname in old_cache:
+                touched[dname] = copy_directory_entry(old_cache[dname])
+            add_directory_row(touched, context, row)
+
+    # the rebuilt entries share their subcaches with the others
+    interner = SubcacheInterner()
+    for dname, entry in old_cache.items():
+        if dname not in touched:
+            for subcache in ('global', 'byCountry', 'byHostId',
+                             'byCountryInternet2'):
+                interner.known(entry[subcache])
+    for entry in touched.values():
+        shrink_entry(entry, interner)
+    cache = dict(old_cache)
+    cache.update(touched)
+    drop_directories_without_hosts(cache, touched)
+    global_caches['mirrorlist_cache'] = cache
+
+    file_state = file_detail_state(session, max_file_details)
+    old_files = previous['file_details_cache']
+    if previous['file_detail_state'][0] != max_file_details:
+        changed_files = set(old_files) | set(file_state[1])
+    else:
+        old_file_state = previous['file_detail_state'][1]
+        changed_files = set(
+            dname for dname in set(old_file_state) | set(file_state[1])
+            if old_file_state.get(dname) != file_state[1].get(dname))
+    files = dict(old_files)
+    for dname in changed_files:
+        files.pop(dname, None)
+    if changed_files:
+        files.update(file_details_cache(
+            session, max_file_details, directories=changed_files))
+
+    populate_host_caches(session, dns_cache_file, dns_deadline)
+    data = cache_data(
+        session, context, max_file_details, files, file_state)
+
+    # only the rebuilt entries of the large caches can differ
+    only = {
+        'mirrorlist_cache': touched,
+        'file_details_cache': changed_files,
+    }
+    changes = {}
+    for key in data:
+        if key in PATCH_SKIPPED:
+            continue
+        updated, removed = diff_cache(
+            previous.get(key, {}), data[key], only.get(key))
+        if updated or removed:
+            changes[key] = (updated, removed)
+    return {
+        'patch_version': PATCH_VERSION,
+        'base_time': previous['time'],
+        'time': data['time'],
+        'changes': changes,
     }
 
 
-def dump_caches(session, filename="", protobuf_file=""):
+def dump_patch(filename, patch):
+    ''' Write a patch returned by populate_changed_caches(), which
+    mirrorlist_server.py applies to the cache it has loaded when it
+    receives SIGUSR1. Like the 'meta' section of the memory-mapped
+    cache, it is written with marshal, the times as timestamps and the
+    netblocks as strings. '''
+    changes = {}
+    for key, (updated, removed) in patch['changes'].items():
+        if key in ('host_netblock_cache', 'netblock_country_cache'):
+            updated = dict(
+                (ip.strNormal(), value) for ip, value in updated.items())
+            removed = [ip.strNormal() for ip in removed]
+        changes[key] = (updated, list(removed))
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        marshal.dump({
+            'patch_version': patch['patch_version'],
+            'base_time': cache_timestamp(patch['base_time']),
+            'time': cache_timestamp(patch['time']),
+            'changes': changes,
+        }, f, 2)
+    os.rename(tmp, filename)
+
+
+def cache_timestamp(t):
+    ''' The creation time of the caches as written to the patches and
+    the memory-mapped cache, in seconds since the epoch. t is in UTC, as
+    set by cache_data(). '''
+    return calendar.timegm(t.utctimetuple())
+
+
+# The memory-mapped cache format. mirrorlist_server.py has the
+# matching reader; both sides have to agree on these values.
+MMAP_MAGIC = b'MMLCACHE'
+MMAP_VERSION = 2
+
+# Bits of the presence mask in front of every file detail record.
+MMAP_FD_FIELDS = ('timestamp', 'size', 'sha1', 'md5', 'sha256', 'sha512')
+
+
+def pack_int_array(values):
+    ''' Pack a sequence of integers as a count followed by the values.
+    Sets are stored sorted, lists and tuples keep their order. '''
+    if not isinstance(values, (list, tuple)):
+        values = sorted(values)
+    return struct.pack('<I%di' % len(values), len(values), *values)
+
+
+def pack_string(value, fmt='<H'):
+    ''' Pack a string as its length followed by the UTF-8 bytes. '''
+    value = value.encode('utf-8')
+    return struct.pack(fmt, len(value)) + value
+
+
+def pack_string_index(entries):
+    ''' Pack a sorted string index section.
+
+    The section starts with the number of entries, followed by the offset
+    table of the keys, the offset table of the records and the key blob.
+    The records follow after that. All offsets are relative to the start
+    of the section, so the reader can look up a key with a binary search
+    without decoding anything else.
+
+    :arg entries: a list of (key, record) tuples. record is either the
+        packed record or a tuple (shared_blobs, build) where build is
+        called with the section offsets of the shared blobs and returns
+        the packed record.
+    '''
+    entries = sorted(
+        (key.encode('utf-8'), record) for key, record in entries)
+    count = len(entries)
+    keys = b''.join(key for key, record in entries)
+    key_offsets = [0]
+    for key, record in entries:
+        key_offsets.append(key_offsets[-1] + len(key))
+
+    header_size = 4 + 4 * (count + 1) + 4 * count
+    body = bytearray()
+    blob_offsets = {}
+    record_offsets = []
+    base = header_size + len(keys)
+    for key, record in entries:
+        if isinstance(record, tuple):
+            shared, build = record
+            offsets = []
+            for blob in shared:
+                # identical subcaches are only stored once
+                if blob not in blob_offsets:
+                    blob_offsets[blob] = base + len(body)
+                    body += blob
+                offsets.append(blob_offsets[blob])
+            record = build(offsets)
+        record_offsets.append(base + len(body))
+        body += record
+
+    return b''.join([
+        struct.pack('<I', count),
+        struct.pack('<%dI' % (count + 1), *key_offsets),
+        struct.pack('<%dI' % count, *record_offsets),
+        keys,
+        bytes(body),
+    ])
+
+
+def pack_country_map(countries):
+    ''' Pack a {country: set(hostid)} subcache. '''
+    result = [struct.pack('<I', len(countries))]
+    for country in sorted(countries):
+        result.append(pack_string(country, fmt='<B'))
+        result.append(pack_int_array(countries[country]))
+    return b''.join(result)
+
+
+def pack_hostid_map(hostids):
+    ''' Pack a {hostid: [hcurl id]} subcache. '''
+    result = [struct.pack('<I', len(hostids))]
+    for hostid in sorted(hostids):
+        result.append(struct.pack('<i', hostid))
+        result.append(pack_int_array(hostids[hostid]))
+    return b''.join(result)
+
+
+def pack_mirrorlist_cache(mirrorlist_cache):
+    ''' Pack the mirrorlist_cache as a directory index. Every directory
+    record references its (deduplicated) subcaches by offset. '''
+    entries = []
+    for directory, c in mirrorlist_cache.items():
+        shared = (
+            pack_int_array(c['global']),
+            pack_country_map(c['byCountry']),
+            pack_country_map(c['byCountryInternet2']),
+            pack_hostid_map(c['byHostId']),
+        )
+        flags = 0
+        if c.get('ordered_mirrorlist'):
+            flags |= 1
+        subpath = c.get('subpath')
+        if subpath is not None:
+            flags |= 2
+        else:
+            subpath = ''
+
+        def build(offsets, flags=flags, subpath=subpath):
+            return struct.pack('<B4I', flags, *offsets) + pack_string(subpath)
+        entries.append((directory, (shared, build)))
+    return pack_string_index(entries)
+
+
+def pack_hcurl_cache(hcurl_cache):
+    ''' Pack the hcurl_cache as a sorted id array and a string table. '''
+    ids = sorted(hcurl_cache)
+    urls = [hcurl_cache[i].encode('utf-8') for i in ids]
+    offsets = [0]
+    for url in urls:
+        offsets.append(offsets[-1] + len(url))
+    return b''.join([
+        struct.pack('<I', len(ids)),
+        struct.pack('<%di' % len(ids), *ids),
+        struct.pack('<%dI' % (len(ids) + 1), *offsets),
+        b''.join(urls),
+    ])
+
+
+def pack_file_details(files):
+    ''' Pack the {filename: [{details}]} entries of one directory. '''
+    result = [struct.pack('<I', len(files))]
+    for filename in sorted(files):
+        result.append(pack_string(filename))
+        result.append(struct.pack('<I', len(files[filename])))
+        for details in files[filename]:
+            mask = 0
+            for bit, field in enumerate(MMAP_FD_FIELDS):
+                if details.get(field) is not None:
+                    mask |= 1 << bit
+            result.append(struct.pack(
+                '<Bqq', mask,
+                details.get('timestamp') or 0, details.get('size') or 0))
+            for field in MMAP_FD_FIELDS[2:]:
+                if details.get(field) is not None:
+                    result.append(pack_string(details[field]))
+    return b''.join(result)
+
+
+def dump_mmap_cache(filename):
+    ''' Write the previously collected information in a layout which
+    mirrorlist_server.py can mmap() and query in place.
+
+    The directory, hcurl and file details caches are stored as offset
+    tables, everything else is small and stored with marshal (which,
+    unlike pickle, cannot run code when loaded) in the 'meta' section.
+    The file is written to a temporary file and renamed in place, so
+    running servers keep their current mapping intact.
+    '''
+    meta = {}
+    for key in (
+            'host_country_allowed_cache', 'host_bandwidth_cache',
+            'host_country_cache', 'host_max_connections_cache',
+            'asn_host_cache', 'repo_arch_to_directoryname',
+            'repo_redirect_cache', 'country_continent_redirect_cache',
+            'disabled_repositories', 'location_cache'):
+        # marshal only takes the plain types
+        meta[key] = dict(data[key])
+    # do not require IPy to read the cache
+    for key in ('host_netblock_cache', 'netblock_country_cache'):
+        meta[key] = dict(
+            (ip.strNormal(), value) for ip, value in data[key].items())
+
+    sections = [
+        # version 2 can still be read by python 2
+        (b'meta', marshal.dumps(meta, 2)),
+        (b'dirs', pack_mirrorlist_cache(data['mirrorlist_cache'])),
+        (b'hcurls', pack_hcurl_cache(data['hcurl_cache'])),
+        (b'files', pack_string_index(
+            (directory, pack_file_details(files))
+            for directory, files in data['file_details_cache'].items())),
+    ]
+
+    header = struct.pack(
+        '<8sIIq', MMAP_MAGIC, MMAP_VERSION, len(sections),
+        cache_timestamp(data['time']))
+    offset = len(header) + struct.calcsize('<8sQQ') * len(sections)
+    table = []
+    for name, section in sections:
+        table.append(struct.pack('<8sQQ', name, offset, len(section)))
+        offset += len(section)
+
+    tmpfile = filename + '.tmp'
+    with open(tmpfile, 'wb') as f:
+        f.write(header)
+        f.write(b''.join(table))
+        for name, section in sections:
+            f.write(section)
+    os.rename(tmpfile, filename)
+
+
+def dump_caches(session, filename="", protobuf_file="", mmap_file=""):
     ''' This function writes the previously collected
     information (via populate_all_caches()) to a file.
-    The output format can be a Python pickle or Protobuf.
+    The output format can be a Python pickle, Protobuf or the
+    memory-mapped format read by mirrorlist_server.py.
     The reason to also offer Protobuf is to be independent
     of Python's pickle format which does not always work
     with different versions of Python and used libraries.'''
 
+    if mmap_file != "":
+        try:
+            dump_mmap_cache(mmap_file)
+        except Exception as err:
+            print('Error writing %s: %s' % (mmap_file, err))
+
     if filename != "":
         try:
             f = open(filename, 'wb')
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Generated by the protocol buffer compiler.  DO NOT EDIT!
+# source: mirrormanager.proto
+"""Generated protocol buffer code."""
+from google.protobuf.internal import builder as _builder
+from google.protobuf import descriptor as _descriptor
+from google.protobuf import descriptor_pool as _descriptor_pool
+from google.protobuf import symbol_database as _symbol_database
+# @@protoc_insertion_point(imports)
+
+_sym_db = _symbol_database.Default()
+
+
+
+
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x13mirrormanager.proto\x12\rmirrormanager\"m\n\x0f\x46ileDetailsType\x12\x11\n\tTimeStamp\x18\x01 \x02(\x04\x12\x0c\n\x04Size\x18\x02 \x02(\x04\x12\x0c\n\x04SHA1\x18\x03 \x01(\t\x12\x0b\n\x03MD5\x18\x04 \x01(\t\x12\x0e\n\x06SHA256\x18\x05 \x01(\t\x12\x0e\n\x06SHA512\x18\x06 \x01(\t\"b\n\x19\x46ileDetailsCacheFilesType\x12\x10\n\x08\x66ilename\x18\x01 \x02(\t\x12\x33\n\x0b\x46ileDetails\x18\x02 \x03(\x0b\x32\x1e.mirrormanager.FileDetailsType\"{\n\x1d\x46ileDetailsCacheDirectoryType\x12\x11\n\tdirectory\x18\x01 \x02(\t\x12G\n\x15\x46ileDetailsCacheFiles\x18\x02 \x03(\x0b\x32(.mirrormanager.FileDetailsCacheFilesType\"\x91\x02\n\x13MirrorListCacheType\x12\x11\n\tdirectory\x18\x01 \x02(\t\x12\x0e\n\x06Global\x18\x02 \x03(\x03\x12\x0f\n\x07Subpath\x18\x03 \x01(\t\x12\x36\n\tByCountry\x18\x04 \x03(\x0b\x32#.mirrormanager.StringRepeatedIntMap\x12?\n\x12\x42yCountryInternet2\x18\x05 \x03(\x0b\x32#.mirrormanager.StringRepeatedIntMap\x12\x32\n\x08\x42yHostId\x18\x06 \x03(\x0b\x32 .mirrormanager.IntRepeatedIntMap\x12\x19\n\x11OrderedMirrorList\x18\x07 \x01(\x08\"-\n\x0fStringStringMap\x12\x0b\n\x03key\x18\x01 \x02(\t\x12\r\n\x05value\x18\x02 \x02(\t\"2\n\x14StringRepeatedIntMap\x12\x0b\n\x03key\x18\x01 \x02(\t\x12\r\n\x05value\x18\x02 \x03(\x03\"2\n\x14IntRepeatedStringMap\x12\x0b\n\x03key\x18\x01 \x02(\x03\x12\r\n\x05value\x18\x02 \x03(\t\"*\n\x0cIntStringMap\x12\x0b\n\x03key\x18\x01 \x02(\x03\x12\r\n\x05value\x18\x02 \x02(\t\"\'\n\tIntIntMap\x12\x0b\n\x03key\x18\x01 \x02(\x03\x12\r\n\x05value\x18\x02 \x02(\x03\"/\n\x11IntRepeatedIntMap\x12\x0b\n\x03key\x18\x01 \x02(\x03\x12\r\n\x05value\x18\x02 \x03(\x03\"+\n\rStringBoolMap\x12\x0b\n\x03key\x18\x01 \x02(\t\x12\r\n\x05value\x18\x02 \x02(\x08\"\xb7\x07\n\nMirrorList\x12\x0c\n\x04Time\x18\x01 \x02(\x04\x12<\n\x14NetblockCountryCache\x18\x02 \x03(\x0b\x32\x1e.mirrormanager.StringStringMap\x12:\n\rLocationCache\x18\x03 \x03(\x0b\x32#.mirrormanager.StringRepeatedIntMap\x12/\n\nHCUrlCache\x18\x04 \x03(\x0b\x32\x1b.mirrormanager.IntStringMap\x12\x46\n\x10\x46ileDetailsCache\x18\x05 \x03(\x0b\x32,.mirrormanager.FileDetailsCacheDirectoryType\x12=\n\x17\x44isabledRepositoryCache\x18\x06 \x03(\x0b\x32\x1c.mirrormanager.StringBoolMap\x12\x45\n\x1d\x43ountryContinentRedirectCache\x18\x07 \x03(\x0b\x32\x1e.mirrormanager.StringStringMap\x12?\n\x17RepositoryRedirectCache\x18\x08 \x03(\x0b\x32\x1e.mirrormanager.StringStringMap\x12?\n\x17RepoArchToDirectoryName\x18\t \x03(\x0b\x32\x1e.mirrormanager.StringStringMap\x12\x36\n\x0cHostAsnCache\x18\n \x03(\x0b\x32 .mirrormanager.IntRepeatedIntMap\x12\x38\n\x16HostMaxConnectionCache\x18\x0b \x03(\x0b\x32\x18.mirrormanager.IntIntMap\x12\x35\n\x10HostCountryCache\x18\x0c \x03(\x0b\x32\x1b.mirrormanager.IntStringMap\x12\x34\n\x12HostBandwidthCache\x18\r \x03(\x0b\x32\x18.mirrormanager.IntIntMap\x12\x44\n\x17HostCountryAllowedCache\x18\x0e \x03(\x0b\x32#.mirrormanager.IntRepeatedStringMap\x12>\n\x11HostNetblockCache\x18\x0f \x03(\x0b\x32#.mirrormanager.StringRepeatedIntMap\x12;\n\x0fMirrorListCache\x18\x10 \x03(\x0b\x32\".mirrormanager.MirrorListCacheType\"U\n\x11MirrorListRequest\x12.\n\x06Params\x18\x01 \x03(\x0b\x32\x1e.mirrormanager.StringStringMap\x12\x10\n\x08Metalink\x18\x02 \x01(\x08\"\x95\x01\n\x12MirrorListResponse\x12\x12\n\nReturnCode\x18\x01 \x02(\x05\x12\x12\n\nResultType\x18\x02 \x02(\t\x12\x0f\n\x07Message\x18\x03 \x01(\t\x12\x34\n\x07Results\x18\x04 \x03(\x0b\x32#.mirrormanager.IntRepeatedStringMap\x12\x10\n\x08\x44ocument\x18\x05 \x01(\x0c')
+
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'mirrormanager_pb2', globals())
+if _descriptor._USE_C_DESCRIPTORS == False:
+
+  DESCRIPTOR._options = None
+  _FILEDETAILSTYPE._serialized_start=38
+  _FILEDETAILSTYPE._serialized_end=147
+  _FILEDETAILSCACHEFILESTYPE._serialized_start=149
+  _FILEDETAILSCACHEFILESTYPE._serialized_end=247
+  _FILEDETAILSCACHEDIRECTORYTYPE._serialized_start=249
+  _FILEDETAILSCACHEDIRECTORYTYPE._serialized_end=372
+  _MIRRORLISTCACHETYPE._serialized_start=375
+  _MIRRORLISTCACHETYPE._serialized_end=648
+  _STRINGSTRINGMAP._serialized_start=650
+  _STRINGSTRINGMAP._serialized_end=695
+  _STRINGREPEATEDINTMAP._serialized_start=697
+  _STRINGREPEATEDINTMAP._serialized_end=747
+  _INTREPEATEDSTRINGMAP._serialized_start=749
+  _INTREPEATEDSTRINGMAP._serialized_end=799
+  _INTSTRINGMAP._serialized_start=801
+  _INTSTRINGMAP._serialized_end=843
+  _INTINTMAP._serialized_start=845
+  _INTINTMAP._serialized_end=884
+  _INTREPEATEDINTMAP._serialized_start=886
+  _INTREPEATEDINTMAP._serialized_end=933
+  _STRINGBOOLMAP._serialized_start=935
+  _STRINGBOOLMAP._serialized_end=978
+  _MIRRORLIST._serialized_start=981
+  _MIRRORLIST._serialized_end=1932
+  _MIRRORLISTREQUEST._serialized_start=1934
+  _MIRRORLISTREQUEST._serialized_end=2019
+  _MIRRORLISTRESPONSE._serialized_start=2022
+  _MIRRORLISTRESPONSE._serialized_end=2171
+# @@protoc_insertion_point(module_scope)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2026  The MirrorManager2 authors
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions
+# of the GNU General Public License v.2, or (at your option) any later
+# version.  This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.  You
+# should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+'''
+MirrorManager2 resolution of the host names given as netblocks.
+
+Hosts may give host names instead of netblocks; the mirrorlist cache
+needs their addresses. All of them are resolved up front by a bounded
+number of threads, within a deadline for the whole refresh, so a few
+slow name servers cannot stall it. The answers are kept in a file until
+their TTL runs out, and a name which cannot be resolved in time keeps
+the addresses of its last answer. The names which could not be resolved
+are printed at the end.
+'''
+
+from __future__ import print_function
+
+import json
+import os
+import threading
+import time
+
+import dns.exception
+import dns.resolver
+
+
+DNS_RECORD_TYPES = ('A', 'AAAA')
+# seconds a name without addresses is remembered
+NEGATIVE_TTL = 300
+# bounds for the TTLs of the answers, in seconds
+MIN_TTL = 60
+MAX_TTL = 86400
+
+
+class ResolveError(Exception):
+    ''' The name could not be resolved, as opposed to having no
+    addresses. '''
+    pass
+
+
+def resolve_name(name, lifetime=5.0):
+    ''' Returns the addresses of name, as strings, and the number of
+    seconds they are valid. Raises ResolveError if the name servers did
+    not answer within lifetime seconds per record type. '''
+    resolver = dns.resolver.Resolver()
+    # dnspython < 2.0 only has query()
+    resolve = getattr(resolver, 'resolve', None) or resolver.query
+    addresses = []
+    ttl = None
+    for record_type in DNS_RECORD_TYPES:
+        try:
+            answer = resolve(name, record_type, lifetime=lifetime)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            continue
+        except dns.exception.DNSException as err:
+            raise ResolveError('%s %s: %s' % (name, record_type, err))
+        addresses.extend(str(rdata) for rdata in answer)
+        if ttl is None or answer.rrset.ttl < ttl:
+            ttl = answer.rrset.ttl
+    if ttl is None:
+        return addresses, NEGATIVE_TTL
+    return addresses, min(max(ttl, MIN_TTL), MAX_TTL)
+
+
+def load_cache(path):
+    ''' Returns {name: (expires, [address, ...])} from the file at path,
+    or nothing if there is none or it cannot be read. '''
+    if path is None:
+        return {}
+    try:
+        with open(path) as stream:
+            entries = json.load(stream)
+    except (IOError, OSError, ValueError):
+        return {}
+    return dict(
+        (name, (expires, addresses))
+        for name, (expires, addresses) in entries.items())
+
+
+def save_cache(path, entries):
+    ''' Writes the entries of load_cache() to the file at path. '''
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as stream:
+        json.dump(entries, stream)
+    os.rename(tmp, path)
+
+
+def resolve_names(names, cache_file=None, workers=16, deadline=60.0,
+                  lifetime=5.0, resolve=resolve_name, now=None):
+    ''' Returns {name: [address, ...]} for the given host names.
+
+    :arg names: the names to resolve.
+    :kwarg cache_file: the file the answers are kept in between runs.
+    :kwarg workers: the number of names resolved at once.
+    :kwarg deadline: the seconds after which no more answers are waited
+        for; the names without one get the addresses of their last answer,
+        if any.
+    :kwarg lifetime: the seconds each lookup of a name may take.
+
+    '''
+    if now is None:
+        now = time.time()
+    cached = load_cache(cache_file)
+    results = {}
+    pending = []
+    for name in set(names):
+        if name in cached and cached[name][0] > now:
+            results[name] = cached[name][1]
+        else:
+            pending.append(name)
+
+    answers = {}
+    failed = set()
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                name = pending.pop()
+            try:
+                addresses, ttl = resolve(name, lifetime=lifetime)
+            except Exception:
+                with lock:
+                    failed.add(name)
+                continue
+            with lock:
+                answers[name] = (now + ttl, addresses)
+
+    todo = list(pending)
+    threads = []
+    for i in range(min(workers, len(pending))):
+        thread = threading.Thread(target=work)
+        # the threads which are still waiting for an answer at the
+        # deadline are left behind
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    end = time.time() + deadline
+    for thread in threads:
+        thread.join(max(0, end - time.time()))
+    with lock:
+        # the names nobody started on are not resolved anymore
+        del pending[:]
+        done = dict(answers)
+        errors = set(failed)
+
+    entries = {}
+    for name in results:
+        entries[name] = cached[name]
+    for name in todo:
+        if name in done:
+            entries[name] = done[name]
+        elif name in cached:
+            # keep the last answer, it is retried with the next run
+            entries[name] = cached[name]
+        else:
+            results[name] = []
+            continue
+        results[name] = entries[name][1]
+    if cache_file is not None:
+        try:
+            save_cache(cache_file, entries)
+        except (IOError, OSError) as err:
+            print('Error writing %s: %s' % (cache_file, err))
+
+    timed_out = set(todo) - set(done) - errors
+    if errors:
+        print('Cannot resolve %d host names, keeping their last answers, '
+              'if any: %s' % (len(errors), ', '.join(sorted(errors))))
+    if timed_out:
+        print('No answer within %s seconds for %d host names, keeping '
+              'their last answers, if any: %s' % (
+                  deadline, len(timed_out), ', '.join(sorted(timed_out))))
+    return results
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2026  The MirrorManager2 authors
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions
+# of the GNU General Public License v.2, or (at your option) any later
+# version.  This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.  You
+# should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+
+'''
+MirrorManager2 netblock index.
+
+The global and internet2 netblocks files written by
+mm2_get_global_netblocks and mm2_get_internet2_netblocks list one
+"prefix ASN" pair per line. mirrorlist_server.py used to parse them into
+radix trees on every start and reload. The index built here holds the
+same information as sorted integer ranges which the server maps into
+memory and searches in place.
+'''
+
+import os
+import socket
+import struct
+
+
+# The netblock index format. mirrorlist_server.py has the matching
+# reader; both sides have to agree on these values.
+NETBLOCK_INDEX_MAGIC = b'MMNETIDX'
+NETBLOCK_INDEX_VERSION = 1
+
+# magic, version, number of IPv4 ranges, number of IPv6 ranges,
+# number of integers in the chain table
+NETBLOCK_INDEX_HEADER = struct.Struct('<8sIIII')
+
+ADDRESS_BITS = {4: 32, 6: 128}
+
+
+def parse_prefix(prefix):
+    ''' Returns (IP version, first address, prefix length) of a prefix
+    like 10.1.0.0/16 or 2001:db8::/32. Host bits are cleared.
+    Raises ValueError for anything else. '''
+    address, prefixlen = prefix.split('/')
+    prefixlen = int(prefixlen)
+    try:
+        if ':' in address:
+            version = 6
+            packed = socket.inet_pton(socket.AF_INET6, address)
+            start = 0
+            for hi_lo in struct.unpack('!QQ', packed):
+                start = (start << 64) | hi_lo
+        else:
+            version = 4
+            # inet_aton() accepts the abbreviated forms the BGP dumps
+            # contain (like 10.1/16) the same way the radix trees did
+            packed = socket.inet_aton(address)
+            (start,) = struct.unpack('!I', packed)
+    except (socket.error, struct.error):
+        raise ValueError('invalid prefix %s' % prefix)
+    bits = ADDRESS_BITS[version]
+    if prefixlen < 0 or prefixlen > bits:
+        raise ValueError('invalid prefix %s' % prefix)
+    host_bits = bits - prefixlen
+    start = (start >> host_bits) << host_bits
+    return version, start, prefixlen
+
+
+def read_netblocks(netblocks_file):
+    ''' Returns {IP version: [(start, end, prefix length, ASN)]} for the
+    lines of a netblocks file, skipping the ones mirrorlist_server.py
+    has always skipped: malformed lines and default routes. '''
+    netblocks = {4: [], 6: []}
+    with open(netblocks_file, 'r') as f:
+        for line in f:
+            try:
+                prefix, asn = line.split()[:2]
+                version, start, prefixlen = parse_prefix(prefix)
+                asn = int(asn)
+            except ValueError:
+                continue
+            if prefixlen == 0 or asn < 0:
+                continue
+            end = start | ((1 << (ADDRESS_BITS[version] - prefixlen)) - 1)
+            netblocks[version].append((start, end, prefixlen, asn))
+    return netblocks
+
+
+def flatten_netblocks(netblocks, limit):
+    ''' Turns a list of nested (start, end, prefix length, ASN) netblocks
+    into a sorted list of (start, chain) ranges which cover the address
+    space up to limit. chain lists the (prefix length, ASN) pairs of all
+    netblocks containing the range, the most specific one first; a range
+    ends where the next one starts.
+
+    Prefixes are either nested or disjoint, so the netblocks containing
+    the current position are a stack. For the same prefix listed twice
+    the later line comes first in the chain, like it replaced the earlier
+    one in the radix tree.
+    '''
+    ranges = []
+    stack = []
+
+    def mark(position):
+        if position > limit:
+            return
+        chain = tuple(
+            (prefixlen, asn) for (end, prefixlen, asn) in reversed(stack))
+        if ranges and ranges[-1][0] == position:
+            ranges[-1] = (position, chain)
+        elif not ranges or ranges[-1][1] != chain:
+            ranges.append((position, chain))
+
+    for start, end, prefixlen, asn in sorted(
+            netblocks, key=lambda n: (n[0], n[2])):
+        while stack and stack[-1][0] < start:
+            mark(stack.pop()[0] + 1)
+        stack.append((end, prefixlen, asn))
+        mark(start)
+    while stack:
+        mark(stack.pop()[0] + 1)
+    return ranges
+
+
+def pad(data):
+    ''' Pads a section to a multiple of 8 bytes. '''
+    return data + b'\0' * (-len(data) % 8)
+
+
+def pack_netblock_index(netblocks):
+    ''' Pack {IP version: [netblock]} as returned by read_netblocks().
+
+    After the header follow the IPv4 ranges (an array of start addresses
+    and an array of chain offsets), the IPv6 ranges (arrays of the upper
+    and lower 64 bits of the start addresses and of the chain offsets)
+    and the chain table. A chain is its number of (prefix length, ASN)
+    pairs followed by the pairs, as unsigned integers since ASNs use all
+    32 bits; ranges without any netblock have the chain offset -1. Every
+    section is aligned to 8 bytes.
+    '''
+    chains = []
+    chain_offsets = {(): -1}
+
+    def chain_offset(chain):
+        if chain not in chain_offsets:
+            chain_offsets[chain] = len(chains)
+            chains.append(len(chain))
+            for prefixlen, asn in chain:
+                chains.extend((prefixlen, asn))
+        return chain_offsets[chain]
+
+    v4 = flatten_netblocks(netblocks.get(4, []), (1 << 32) - 1)
+    v6 = flatten_netblocks(netblocks.get(6, []), (1 << 128) - 1)
+    v4_chains = [chain_offset(chain) for start, chain in v4]
+    v6_chains = [chain_offset(chain) for start, chain in v6]
+    mask = (1 << 64) - 1
+
+    return b''.join([
+        NETBLOCK_INDEX_HEADER.pack(
+            NETBLOCK_INDEX_MAGIC, NETBLOCK_INDEX_VERSION,
+            len(v4), len(v6), len(chains)),
+        pad(struct.pack('<%dI' % len(v4), *[start for start, c in v4])),
+        pad(struct.pack('<%di' % len(v4), *v4_chains)),
+        struct.pack('<%dQ' % len(v6), *[start >> 64 for start, c in v6]),
+        struct.pack('<%dQ' % len(v6), *[start & mask for start, c in v6]),
+        pad(struct.pack('<%di' % len(v6), *v6_chains)),
+        struct.pack('<%dI' % len(chains), *chains),
+    ])
+
+
+def dump_netblock_index(netblocks_file, index_file):
+    ''' Build the index of a netblocks file. The index is written to a
+    temporary file and renamed in place, so running servers keep their
+    current mapping intact. '''
+    data = pack_netblock_index(read_netblocks(netblocks_file))
+    tmpfile = index_file + '.tmp'
+    with open(tmpfile, 'wb') as f:
+        f.write(data)
+    os.rename(tmpfile, index_file)
@@ -65,6 +65,7 @@ setup(
         'utility/mm2_move-to-archive',
         'utility/mm2_propagation',
         'utility/mm2_refresh_mirrorlist_cache',
+        'utility/mm2_build_netblock_index',
         'utility/mm2_update-EC2-netblocks',
         'utility/mm2_update-master-directory-list',
         'utility/mm2_umdl2',
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+'''
+mirrormanager2 tests for the admission control of the mirrorlist server.
+'''
+
+import os
+import sys
+import threading
+import unittest
+
+FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(FOLDER, '..', 'mirrorlist'))
+
+import admission
+
+
+class AdmissionTests(unittest.TestCase):
+    """ Admission tests. """
+
+    def test_limit(self):
+        """ Test that at most limit callers are let in at once. """
+        gate = admission.Admission(2, 0)
+        self.assertEqual(gate.enter(), admission.ADMITTED)
+        self.assertEqual(gate.enter(), admission.ADMITTED)
+        self.assertEqual(gate.enter(), None)
+        gate.leave()
+        self.assertEqual(gate.enter(), admission.ADMITTED)
+        self.assertEqual(gate.active, 2)
+
+    def test_queued(self):
+        """ Test that waiting callers are let in as others leave. """
+        gate = admission.Admission(1, 5)
+        self.assertEqual(gate.enter(), admission.ADMITTED)
+        leaver = threading.Timer(0.1, gate.leave)
+        leaver.start()
+        self.assertEqual(gate.enter(), admission.QUEUED)
+        leaver.join()
+        self.assertEqual(gate.active, 1)
+        # a caller's own wait overrides the default
+        self.assertEqual(gate.enter(0.01), None)
+
+
+if __name__ == '__main__':
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(AdmissionTests)
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+'''
+mirrormanager2 tests for the access logging of the mirrorlist server.
+'''
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(FOLDER, '..', 'mirrorlist'))
+
+import async_log
+
+
+class ListHandler(logging.Handler):
+    """ Collects the messages logged through it. """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class AsyncLogTests(unittest.TestCase):
+    """ AsyncLog tests. """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='mm2_async_log')
+        self.logfile = os.path.join(self.path, 'mirrorlist.log')
+        self.handler = ListHandler()
+        self.syslogger = logging.getLogger('mm2_async_log_test')
+        self.syslogger.propagate = False
+        self.syslogger.setLevel(logging.INFO)
+        self.syslogger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.syslogger.removeHandler(self.handler)
+        shutil.rmtree(self.path)
+
+    def read(self, path=None):
+        with open(path or self.logfile) as f:
+            return f.read()
+
+    def test_batches(self):
+        """ Test that the writer thread writes all messages. """
+        log = async_log.AsyncLog(
+            self.logfile, self.syslogger, interval=60, batch=10)
+        log.start()
+        for i in range(25):
+            log.log('line %d\n' % i)
+            log.syslog('message %d' % i)
+        log.close()
+        self.assertEqual(
+            self.read(), ''.join('line %d\n' % i for i in range(25)))
+        self.assertEqual(
+            self.handler.messages, ['message %d' % i for i in range(25)])
+        self.assertEqual(log.dropped, 0)
+
+    def test_not_started(self):
+        """ Test that messages are written right away without thread. """
+        log = async_log.AsyncLog(self.logfile, self.syslogger)
+        log.log('line\n')
+        log.syslog('message')
+        self.assertEqual(self.read(), 'line\n')
+        self.assertEqual(self.handler.messages, ['message'])
+        log.close()
+
+    def test_drop(self):
+        """ Test that a full buffer drops messages instead of blocking. """
+        log = async_log.AsyncLog(self.logfile, size=3)
+        # pretend the writer thread is stuck
+        log.thread = True
+        for i in range(5):
+            log.log('line %d\n' % i)
+        self.assertEqual(len(log.buffer), 3)
+        self.assertEqual(log.dropped, 2)
+        log.write(log.buffer)
+        self.assertEqual(self.read(), 'line 0\nline 1\nline 2\n')
+        log.thread = None
+        log.close()
+
+    def test_reopen(self):
+        """ Test that the log is reopened after logrotate moved it. """
+        log = async_log.AsyncLog(self.logfile, interval=60)
+        log.start()
+        log.log('before\n')
+        # the writer thread has not written the line yet, it goes to the
+        # new file
+        rotated = self.logfile + '.1'
+        os.rename(self.logfile, rotated)
+        log.reopen()
+        log.log('after\n')
+        log.close()
+        self.assertEqual(self.read(rotated), '')
+        self.assertEqual(self.read(), 'before\nafter\n')
+
+        log = async_log.AsyncLog(self.logfile)
+        os.rename(self.logfile, rotated)
+        log.reopen()
+        log.log('again\n')
+        log.close()
+        self.assertEqual(self.read(), 'again\n')
+
+
+if __name__ == '__main__':
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(AsyncLogTests)
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+'''
+mirrormanager2 tests for the load-aware weights of the mirrorlist server.
+'''
+
+import os
+import sys
+import unittest
+from array import array
+
+FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(FOLDER, '..', 'mirrorlist'))
+
+import host_load
+
+
+class HostLoadTests(unittest.TestCase):
+    """ Host load tests. """
+
+    def test_load_counter(self):
+        """ Test counting per host over a sliding window. """
+        counter = host_load.LoadCounter(60, 3)
+        counter.add(1, now=1000)
+        counter.add(1, now=1005)
+        counter.add(2, now=1015)
+        # unknown hosts are not counted
+        counter.add(3, now=1015)
+        counter.add(-1, now=1015)
+        self.assertEqual(counter.count(1, now=1020), 2)
+        self.assertEqual(counter.count(2, now=1020), 1)
+        self.assertEqual(counter.count(0, now=1020), 0)
+        self.assertEqual(counter.count(3, now=1020), 0)
+        # the first bucket expires, the third one not yet
+        self.assertEqual(counter.count(1, now=1061), 0)
+        self.assertEqual(counter.count(2, now=1061), 1)
+        self.assertEqual(counter.count(2, now=1081), 0)
+
+        counter.add(1, now=1082)
+        counter.grow(5)
+        counter.add(4, now=1083)
+        self.assertEqual(counter.count(1, now=1084), 1)
+        self.assertEqual(counter.count(4, now=1084), 1)
+
+    def test_expire_race(self):
+        """ Test that an increment racing with the expiry of its bucket
+        is lost instead of being counted forever. """
+
+        class RacingCounter(host_load.LoadCounter):
+            def bucket(self, now=None):
+                counts = host_load.LoadCounter.bucket(self, now)
+                # another thread expires the bucket right after add()
+                # got it
+                for i in range(self.buckets):
+                    self.expire(i)
+                return counts
+
+        counter = RacingCounter(60, 3)
+        counter.add(1, now=1000)
+        self.assertEqual(counter.count(1, now=1000), 0)
+        self.assertEqual(counter.count(1, now=2000), 0)
+
+        # a bucket expired by a grow() still in progress is short
+        counter = host_load.LoadCounter(60, 3)
+        counter.grow(5)
+        counter.counts[0] = array('l', [0]) * 3
+        counter.epochs[0] = 0
+        counter.add(4, now=0)
+        counter.add(4, now=20)
+        self.assertEqual(counter.count(4, now=20), 1)
+
+    def test_load_aware_weights(self):
+        """ Test lowering the weights of loaded hosts. """
+        counter = host_load.LoadCounter(60, 4)
+        bandwidth = {1: 100, 2: 100, 3: 10}
+        max_connections = {1: 1, 2: 5}
+        weights = host_load.LoadAwareWeights(
+            bandwidth, max_connections, counter, 1)
+        self.assertEqual(weights[1], 100 * 100)
+        self.assertEqual(weights[3], 100 * 10)
+        # no bandwidth known
+        self.assertEqual(weights[0], 100)
+
+        for i in range(10):
+            counter.add(1)
+            counter.add(2)
+        counter.add(3)
+        self.assertEqual(weights[1], 90 * 100)
+        self.assertEqual(weights[2], 50 * 100)
+        self.assertEqual(weights[3], 90 * 10)
+        for i in range(10):
+            counter.add(2)
+            counter.add(3)
+        self.assertEqual(weights[2], 1)
+        self.assertEqual(weights[3], 1)
+
+
+if __name__ == '__main__':
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(HostLoadTests)
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+'''
+mirrormanager2 tests for the compact host vectors of the mirrorlist server.
+'''
+
+import os
+import struct
+import sys
+import unittest
+from array import array
+
+FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(FOLDER, '..', 'mirrorlist'))
+
+import host_vectors
+
+
+class HostVectorsTests(unittest.TestCase):
+    """ Host vectors tests. """
+
+    def test_set_operations(self):
+        """ Test contains, union and select on sorted vectors. """
+        a = array('i', [1, 4, 9])
+        b = array('i', [2, 4, 10, 12])
+        self.assertTrue(host_vectors.contains(a, 4))
+        self.assertFalse(host_vectors.contains(a, 5))
+        self.assertFalse(host_vectors.contains(a, 10))
+        self.assertFalse(host_vectors.contains(host_vectors.empty, 1))
+
+        self.assertEqual(
+            list(host_vectors.union([a, b, host_vectors.empty])),
+            [1, 2, 4, 9, 10, 12])
+        self.assertIs(host_vectors.union([host_vectors.empty, a]), a)
+        self.assertEqual(len(host_vectors.union([])), 0)
+
+        self.assertEqual(
+            list(host_vectors.select(b, lambda h: h % 4 == 0)), [4, 12])
+        self.assertIs(host_vectors.select(a, lambda h: True), a)
+
+    def test_unpack_vector(self):
+        """ Test reading a vector in the mmap cache layout. """
+        buf = b'xx' + struct.pack('<I3i', 3, -1, 5, 70000) + b'yy'
+        v, offset = host_vectors.unpack_vector(buf, 2)
+        self.assertEqual(list(v), [-1, 5, 70000])
+        self.assertEqual(offset, len(buf) - 2)
+
+    def test_interner(self):
+        """ Test that equal subcaches of directories are shared. """
+        by_host_id = {1: [12, 11], 2: [21]}
+        directories = {
+            'a': {
+                'global': set([2, 1]),
+                'byCountry': {u'DE': set([1]), u'US': set([2])},
+                'byCountryInternet2': {},
+                'byHostId': by_host_id,
+                'ordered_mirrorlist': False,
+            },
+            'b': {
+                'global': set([1, 2]),
+                'byCountry': {u'US': set([2]), u'DE': set([1])},
+                'byCountryInternet2': {},
+                'byHostId': by_host_id,
+                'subpath': u'repodata',
+            },
+        }
+        interner = host_vectors.Interner()
+        a = interner.directory(directories['a'])
+        b = interner.directory(directories['b'])
+
+        self.assertEqual(list(a['global']), [1, 2])
+        self.assertIs(a['global'], b['global'])
+        self.assertIs(a['byCountry'], b['byCountry'])
+        self.assertIs(a['byHostId'], b['byHostId'])
+        self.assertIs(interner.vector(set([1])), a['byCountry'][u'DE'])
+        # the order of the hcurls is kept
+        self.assertEqual(list(a['byHostId'][1]), [12, 11])
+        self.assertEqual(a['byCountryInternet2'], {})
+        self.assertFalse(a['ordered_mirrorlist'])
+        self.assertEqual(b['subpath'], u'repodata')
+        # the source is left alone
+        self.assertEqual(directories['a']['global'], set([1, 2]))
+
+
+if __name__ == '__main__':
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(HostVectorsTests)
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+'''
+mirrormanager2 tests for the HTTP listener of the mirrorlist server.
+'''
+
+import os
+import socket
+import sys
+import threading
+import unittest
+
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+
+FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(FOLDER, '..', 'mirrorlist'))
+
+try:
+    import mirrorlist_http
+except SyntaxError:
+    # python 2 has no asyncio
+    mirrorlist_http = None
+
+
+@unittest.skipIf(mirrorlist_http is None, 'requires python 3')
+class MirrorlistHTTPTests(unittest.TestCase):
+    """ Mirrorlist HTTP listener tests. """
+
+    trust_forwarded_for = True
+
+    def setUp(self):
+        self.requests = []
+        self.stop = False
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(5)
+        self.port = sock.getsockname()[1]
+        self.listener = mirrorlist_http.HTTPListener(
+            sock, self.answer, lambda: self.stop,
+            trust_forwarded_for=self.trust_forwarded_for)
+        self.listener.start()
+        self.connection = httplib.HTTPConnection('127.0.0.1', self.port)
+
+    def tearDown(self):
+        self.connection.close()
+        self.stop = True
+        self.listener.thread.join()
+
+    def answer(self, d):
+        self.requests.append(d)
+        if d.get('repo') == 'broken':
+            raise RuntimeError('broken')
+        if d.get('repo') == 'empty':
+            return dict(
+                returncode=200, resulttype='mirrorlist', message=u'# none',
+                results=[])
+        if d['metalink']:
+            return dict(
+                returncode=200, resulttype='metalink', message=None,
+                results=u'<metalink/>')
+        return dict(
+            returncode=200, resulttype='mirrorlist', message=u'# header',
+            results=[(1, [u'http://example.com/fedora/'])])
+
+    def get(self, url, headers={}, method='GET'):
+        self.connection.request(method, url, headers=headers)
+        response = self.connection.getresponse()
+        return response, response.read()
+
+    def test_mirrorlist_keep_alive(self):
+        """ Test several requests on one connection. """
+        response, body = self.get(
+            '/mirrorlist?repo=fedora-29&arch=x86_64',
+            headers={'X-Forwarded-For': '10.0.0.1, 192.168.0.1'})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('Content-Type'), 'text/plain')
+        self.assertEqual(body, b'# header\nhttp://example.com/fedora/\n')
+
+        response, body = self.get('/metalink?path=pub/fedora/a+b')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(
+            response.getheader('Content-Type'), 'application/metalink+xml')
+        self.assertEqual(body, b'<metalink/>')
+
+        response, body = self.get(
+            '/mirrorlist?repo=fedora-29&arch=x86_64&redirect=1',
+            method='HEAD')
+        self.assertEqual(response.status, 302)
+        self.assertEqual(
+            response.getheader('Location'), 'http://example.com/fedora/')
+
+        self.assertEqual(self.requests, [
+            {'repo': 'fedora-29', 'arch': 'x86_64',
+             'client_ip': '192.168.0.1', 'metalink': False},
+            {'path': 'pub/fedora/a+b', 'client_ip': '127.0.0.1',
+             'metalink': True},
+            {'repo': 'fedora-29', 'arch': 'x86_64',
+             'client_ip': '127.0.0.1', 'metalink': False},
+        ])
+
+    def test_errors(self):
+        """ Test unknown paths and methods. """
+        response, body = self.get('/foo?repo=fedora-29')
+        self.assertEqual(response.status, 404)
+        response, body = self.get('/mirrorlist', method='POST')
+        self.assertEqual(response.status, 405)
+        self.assertEqual(self.requests, [])
+        response, body = self.get('/mirrorlist?repo=broken&arch=x86_64')
+        self.assertEqual(response.status, 503)
+
+    def test_redirect(self):
+        """ Test that redirect= answers with the first HTTP URL, or not
+        found if there is none. """
+        response, body = self.get(
+            '/mirrorlist?repo=fedora-29&arch=x86_64&redirect=1')
+        self.assertEqual(response.status, 302)
+        self.assertEqual(
+            response.getheader('Location'), 'http://example.com/fedora/')
+        self.assertEqual(body, b'')
+        response, body = self.get(
+            '/mirrorlist?repo=empty&arch=x86_64&redirect=1')
+        self.assertEqual(response.status, 404)
+
+    def test_concurrent_answers(self):
+        """ Test that a slow answer does not hold up the requests of
+        other connections. """
+        started = threading.Event()
+        release = threading.Event()
+        answer = self.answer
+
+        def slow_answer(d):
+            if d.get('repo') == 'slow':
+                started.set()
+                release.wait(5)
+            return answer(d)
+        self.listener.answer = slow_answer
+
+        results = []
+
+        def slow_request():
+            connection = httplib.HTTPConnection('127.0.0.1', self.port)
+            connection.request('GET', '/mirrorlist?repo=slow&arch=x86_64')
+            results.append(connection.getresponse().status)
+            connection.close()
+        thread = threading.Thread(target=slow_request)
+        thread.start()
+        try:
+            self.assertTrue(started.wait(5))
+            self.connection.timeout = 2
+            response, body = self.get('/mirrorlist?repo=fedora-29&arch=x')
+            self.assertEqual(response.status, 200)
+            self.assertEqual(results, [])
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(results, [200])
+
+
+@unittest.skipIf(mirrorlist_http is None, 'requires python 3')
+class UntrustedForwardedForTests(MirrorlistHTTPTests):
+    """ Mirrorlist HTTP listener tests without a reverse proxy in front
+    of it. """
+
+    trust_forwarded_for = False
+
+    def test_mirrorlist_keep_alive(self):
+        """ Test that X-Forwarded-For is ignored. """
+        response, body = self.get(
+            '/mirrorlist?repo=fedora-29&arch=x86_64',
+            headers={'X-Forwarded-For': '10.0.0.1, 192.168.0.1'})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(self.requests[0]['client_ip'], '127.0.0.1')
+
+
+@unittest.skipIf(mirrorlist_http is None, 'requires python 3')
+class HTTPFormatTests(unittest.TestCase):
+    """ Tests for parsing requests and formatting responses. """
+
+    def test_parse_request_head(self):
+        """ Test parsing the request line and the headers. """
+        method, target, version, headers = mirrorlist_http.parse_request_head(
+            b'GET /mirrorlist?repo=a HTTP/1.1\r\n'
+            b'Host: example.com\r\n'
+            b'X-Forwarded-For: 10.0.0.1\r\n'
+            b'x-forwarded-for:  10.0.0.2 \r\n'
+            b'\r\n')
+        self.assertEqual(method, 'GET')
+        self.assertEqual(target, '/mirrorlist?repo=a')
+        self.assertEqual(version, 'HTTP/1.1')
+        self.assertEqual(headers, {
+            'host': 'example.com',
+            'x-forwarded-for': '10.0.0.1, 10.0.0.2',
+        })
+
+    def test_parse_request_head_errors(self):
+        """ Test that malformed requests raise ValueError. """
+        for head in (
+                b'GET /mirrorlist HTTP/2.0\r\n\r\n',
+                b'GET /mirrorlist\r\n\r\n',
+                b'GET /mirrorlist HTTP/1.1\r\nno colon\r\n\r\n'):
+            self.assertRaises(
+                ValueError, mirrorlist_http.parse_request_head, head)
+
+    def test_keep_alive(self):
+        """ Test the default and explicit connection persistence of
+        HTTP/1.0 and HTTP/1.1. """
+        keep_alive = mirrorlist_http.keep_alive
+        self.assertTrue(keep_alive('HTTP/1.1', {}))
+        self.assertTrue(keep_alive('HTTP/1.1', {'connection': 'Keep-Alive'}))
+        self.assertFalse(keep_alive('HTTP/1.1', {'connection': 'Close'}))
+        self.assertFalse(keep_alive('HTTP/1.0', {}))
+        self.assertTrue(keep_alive('HTTP/1.0', {'connection': 'keep-alive'}))
+
+    def test_format_response(self):
+        """ Test the status line, the headers and HEAD responses. """
+        response = mirrorlist_http.format_response(
+            200, [('Content-Type', 'text/plain')], b'body\n', True)
+        self.assertEqual(
+            response,
+            b'HTTP/1.1 200 OK\r\n'
+            b'Content-Type: text/plain\r\n'
+            b'Content-Length: 5\r\n'
+            b'Connection: keep-alive\r\n'
+            b'\r\n'
+            b'body\n')
+        response = mirrorlist_http.format_response(
+            503, [('Retry-After', '5')], b'busy', False, head_only=True)
+        self.assertEqual(
+            response,
+            b'HTTP/1.1 503 Service Unavailable\r\n'
+            b'Retry-After: 5\r\n'
+            b'Content-Length: 4\r\n'
+            b'Connection: close\r\n'
+            b'\r\n')
+
+
+if __name__ == '__main__':
+    SUITE = unittest.TestSuite([
+        unittest.TestLoader().loadTestsFromTestCase(case)
+        for case in (
+            MirrorlistHTTPTests, UntrustedForwardedForTests,
+            HTTPFormatTests)])
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
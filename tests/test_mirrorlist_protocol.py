@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+'''
+mirrormanager2 tests for the mirrorlist client/server wire protocol.
+'''
+
+import os
+import socket
+import sys
+import unittest
+
+FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(FOLDER, '..', 'mirrorlist'))
+
+import mirrorlist_protocol
+import mirrormanager_pb2
+
+
+class MirrorlistProtocolTests(unittest.TestCase):
+    """ Mirrorlist protocol tests. """
+
+    def setUp(self):
+        self.client, self.server = socket.socketpair()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def test_pipelined_requests(self):
+        """ Test sending several requests before reading them. """
+        requests = [
+            {'repo': 'fedora-29', 'arch': 'x86_64',
+             'client_ip': '127.0.0.1', 'metalink': False},
+            {'path': 'pub/fedora/linux/', 'client_ip': '::1',
+             'metalink': True},
+        ]
+        for d in requests:
+            mirrorlist_protocol.send_message(
+                self.client, mirrorlist_protocol.encode_request(d))
+        self.client.shutdown(socket.SHUT_WR)
+
+        for d in requests:
+            request = mirrorlist_protocol.recv_message(
+                self.server, mirrormanager_pb2.MirrorListRequest)
+            self.assertEqual(mirrorlist_protocol.decode_request(request), d)
+        # a clean end of the connection between two messages
+        self.assertIsNone(mirrorlist_protocol.recv_message(
+            self.server, mirrormanager_pb2.MirrorListRequest))
+
+    def test_responses(self):
+        """ Test mirrorlist and metalink responses. """
+        mirrorlist = {
+            'returncode': 200,
+            'resulttype': 'mirrorlist',
+            'message': u'# repo = fedora-29 arch = x86_64 ',
+            'results': [
+                (3, [u'http://example.com/pub/fedora/linux/']),
+                (1, [u'https://example.org/fedora/',
+                     u'ftp://example.org/fedora/']),
+            ],
+        }
+        metalink = {
+            'returncode': 404,
+            'resulttype': 'metalink',
+            'message': None,
+            'results': u'<?xml version="1.0" encoding="utf-8"?>\n<métalink/>',
+        }
+        for r in (mirrorlist, metalink):
+            mirrorlist_protocol.send_message(
+                self.server, mirrorlist_protocol.encode_response(r))
+
+        response = mirrorlist_protocol.decode_response(
+            mirrorlist_protocol.recv_message(
+                self.client, mirrormanager_pb2.MirrorListResponse))
+        self.assertEqual(response, mirrorlist)
+
+        response = mirrorlist_protocol.decode_response(
+            mirrorlist_protocol.recv_message(
+                self.client, mirrormanager_pb2.MirrorListResponse))
+        self.assertEqual(response['returncode'], 404)
+        self.assertIsNone(response['message'])
+        self.assertEqual(
+            response['results'], metalink['results'].encode('utf-8'))
+
+        # metalink() returns documents which are already encoded
+        metalink['results'] = metalink['results'].encode('utf-8')
+        mirrorlist_protocol.send_message(
+            self.server, mirrorlist_protocol.encode_response(metalink))
+        response = mirrorlist_protocol.decode_response(
+            mirrorlist_protocol.recv_message(
+                self.client, mirrormanager_pb2.MirrorListResponse))
+        self.assertEqual(response['results'], metalink['results'])
+
+    def test_oversized_and_truncated_messages(self):
+        """ Test that oversized and truncated messages are rejected. """
+        self.client.sendall(mirrorlist_protocol.header.pack(1 << 20))
+        self.assertRaises(
+            ValueError, mirrorlist_protocol.recv_message,
+            self.server, mirrormanager_pb2.MirrorListRequest,
+            max_size=65536)
+
+        self.client.sendall(mirrorlist_protocol.header.pack(10) + b'\x0a')
+        self.client.shutdown(socket.SHUT_WR)
+        self.assertRaises(
+            EOFError, mirrorlist_protocol.recv_message,
+            self.server, mirrormanager_pb2.MirrorListRequest)
+
+    def test_request_setup(self):
+        """ Test building the request from the HTTP query parameters. """
+        d = mirrorlist_protocol.request_setup(
+            {'repo': 'centos', 'version': '7 ', 'arch': 'x86_64',
+             'cc': 'de', 'foo': 'bar'},
+            '10.0.0.1', xforwardedfor='1.2.3.4, 192.168.0.1 ')
+        self.assertEqual(d, {
+            'repo': 'centos-7', 'arch': 'x86_64', 'country': 'de',
+            'client_ip': '192.168.0.1', 'metalink': False})
+
+        d = mirrorlist_protocol.request_setup(
+            {'path': 'pub/c x/', 'ip': '10.1.1.1', 'country': 'US',
+             'cc': 'de'},
+            '10.0.0.1', xforwardedfor='1.2.3.4', metalink=True)
+        self.assertEqual(d, {
+            'path': 'pub/c+x/', 'country': 'US', 'cc': 'de',
+            'client_ip': '10.1.1.1', 'metalink': True})
+
+        d = mirrorlist_protocol.request_setup({}, '10.0.0.1')
+        self.assertEqual(d['client_ip'], '10.0.0.1')
+
+    def test_http_response(self):
+        """ Test turning answers into HTTP responses. """
+        r = {
+            'returncode': 200,
+            'resulttype': 'mirrorlist',
+            'message': u'# repo = fedora-29 arch = x86_64 ',
+            'results': [
+                (3, [u'ftp://example.com/pub/fedora/linux/']),
+                (1, [u'https://example.org/fedora/',
+                     u'http://example.org/fedora/']),
+            ],
+        }
+        self.assertEqual(
+            mirrorlist_protocol.http_response(r),
+            (200, [('Content-Type', 'text/plain')],
+             b'# repo = fedora-29 arch = x86_64 \n'
+             b'ftp://example.com/pub/fedora/linux/\n'
+             b'https://example.org/fedora/\n'))
+        self.assertEqual(
+            mirrorlist_protocol.http_response(r, redirect=True),
+            (302, [('Location', 'https://example.org/fedora/')], b''))
+
+        r['results'] = [(3, [u'ftp://example.com/pub/fedora/linux/'])]
+        self.assertEqual(
+            mirrorlist_protocol.http_response(r, redirect=True),
+            (404, [], b''))
+
+        r = {
+            'returncode': 404,
+            'resulttype': 'metalink',
+            'message': None,
+            'results': b'<metalink/>',
+        }
+        self.assertEqual(
+            mirrorlist_protocol.http_response(r, redirect=True),
+            (200, [('Content-Type', 'application/metalink+xml')],
+             b'<metalink/>'))
+
+    def test_http_response_busy(self):
+        """ Test that busy answers become 503 with Retry-After. """
+        r = {
+            'returncode': 503,
+            'resulttype': 'mirrorlist',
+            'message': u'# server busy, please try again later',
+            'results': [],
+        }
+        retry_after = ('Retry-After', '%d' % (
+            mirrorlist_protocol.busy_retry_after))
+        expected = (
+            503, [retry_after, ('Content-Type', 'text/plain')],
+            b'# server busy, please try again later\n')
+        self.assertEqual(mirrorlist_protocol.http_response(r), expected)
+        self.assertEqual(
+            mirrorlist_protocol.http_response(r, redirect=True), expected)
+
+        r['resulttype'] = 'metalink'
+        r['results'] = b'<metalink/>'
+        self.assertEqual(
+            mirrorlist_protocol.http_response(r),
+            (503, [retry_after,
+                   ('Content-Type', 'application/metalink+xml')],
+             b'<metalink/>'))
+
+
+if __name__ == '__main__':
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(
+        MirrorlistProtocolTests)
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
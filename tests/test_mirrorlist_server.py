@@ -0,0 +1,657 @@
+# -*- coding: utf-8 -*-
+
+'''
+mirrormanager2 tests for the caches of the mirrorlist server.
+'''
+
+import datetime
+import logging
+import marshal
+import os
+import pickle
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(FOLDER, '..', 'mirrorlist'))
+
+try:
+    import mirrorlist_server
+except ImportError:
+    # the server needs radix and geoip2
+    mirrorlist_server = None
+
+# the server logs to syslog, which is not there in every test environment
+logging.raiseExceptions = False
+
+
+def file_details(timestamp, size):
+    return {
+        'timestamp': timestamp,
+        'size': size,
+        'sha1': 'sha1-%d' % size,
+        'md5': 'md5-%d' % size,
+        'sha256': 'sha256-%d' % size,
+        'sha512': 'sha512-%d' % size,
+    }
+
+
+FILE_DETAILS = {
+    'pub/fedora/linux/releases/30/repodata': {
+        'repomd.xml': [
+            file_details(1351758830, 3000), file_details(1351758820, 2000)],
+    },
+    'pub/fedora/linux/updates/30/repodata': {
+        'repomd.xml': [file_details(1351758840, 4000)],
+        'other.xml': [file_details(1351758850, 5000)],
+    },
+}
+
+
+def protobuf_file_details(caches):
+    """ The FileDetailsCache of a protobuf cache with caches. """
+    mirrorlist = mirrorlist_server.mirrormanager_pb2.MirrorList()
+    for directory, files in sorted(caches.items()):
+        item = mirrorlist.FileDetailsCache.add()
+        item.directory = directory
+        for filename, detailslist in sorted(files.items()):
+            entry = item.FileDetailsCacheFiles.add()
+            entry.filename = filename
+            for details in detailslist:
+                value = entry.FileDetails.add()
+                value.TimeStamp = details['timestamp']
+                value.Size = details['size']
+                value.SHA1 = details['sha1']
+                value.MD5 = details['md5']
+                value.SHA256 = details['sha256']
+                value.SHA512 = details['sha512']
+    return mirrorlist.FileDetailsCache
+
+
+@unittest.skipIf(mirrorlist_server is None, 'requires radix and geoip2')
+class LazyFileDetailsTests(unittest.TestCase):
+    """ Tests for the file details decoded on demand. """
+
+    def test_eviction(self):
+        """ Test that only the most recently used directories are kept
+        decoded. """
+        decoded = []
+
+        def decode(record):
+            decoded.append(record)
+            return {'file': [record]}
+
+        lazy = mirrorlist_server.LazyFileDetails(
+            {'a': 'A', 'b': 'B', 'c': 'C'}, decode, 2)
+        self.assertEqual(lazy['a'], {'file': ['A']})
+        self.assertEqual(lazy['b'], {'file': ['B']})
+        self.assertIs(lazy['a'], lazy['a'])
+        self.assertEqual(decoded, ['A', 'B'])
+        # b is the least recently used one
+        lazy['c']
+        lazy['a']
+        self.assertEqual(decoded, ['A', 'B', 'C'])
+        lazy['b']
+        self.assertEqual(decoded, ['A', 'B', 'C', 'B'])
+        self.assertEqual(len(lazy.decoded), 2)
+
+    def test_lookup(self):
+        """ Test __contains__, get() and the missing directories. """
+        decoded = []
+
+        def decode(record):
+            decoded.append(record)
+            return {}
+
+        lazy = mirrorlist_server.LazyFileDetails({'a': 'A'}, decode, 2)
+        self.assertTrue('a' in lazy)
+        self.assertFalse('b' in lazy)
+        # telling whether a directory is there decodes nothing
+        self.assertEqual(decoded, [])
+        self.assertEqual(lazy.get('a'), {})
+        self.assertEqual(lazy.get('b'), None)
+        self.assertEqual(lazy.get('b', 'default'), 'default')
+        self.assertRaises(KeyError, lambda: lazy['b'])
+        self.assertEqual(decoded, ['A'])
+        self.assertEqual(len(lazy), 1)
+        self.assertEqual(list(lazy), ['a'])
+
+    def test_protobuf(self):
+        """ Test that the file details of a protobuf cache are decoded
+        into what the pickle holds and that the metalinks built from
+        them are the same. """
+        lazy = mirrorlist_server.index_file_details(
+            protobuf_file_details(FILE_DETAILS))
+        self.assertEqual(sorted(lazy), sorted(FILE_DETAILS))
+        for directory, files in FILE_DETAILS.items():
+            self.assertEqual(lazy[directory], files)
+
+        eager_db = {
+            'metalink_cache': mirrorlist_server.LRUCache(10),
+            'file_details_cache': FILE_DETAILS,
+        }
+        lazy_db = {
+            'metalink_cache': mirrorlist_server.LRUCache(10),
+            'file_details_cache': mirrorlist_server.index_file_details(
+                protobuf_file_details(FILE_DETAILS)),
+        }
+        for directory, files in FILE_DETAILS.items():
+            for filename in list(files) + ['missing.xml']:
+                self.assertEqual(
+                    mirrorlist_server.metalink_file(
+                        lazy_db, directory, filename),
+                    mirrorlist_server.metalink_file(
+                        eager_db, directory, filename))
+        self.assertIsNone(mirrorlist_server.metalink_file(
+            lazy_db, 'pub/missing', 'repomd.xml'))
+        fragment = mirrorlist_server.metalink_file(
+            lazy_db, 'pub/fedora/linux/releases/30/repodata', 'repomd.xml')
+        self.assertTrue(b'<size>2000</size>' in fragment)
+        self.assertTrue(b'<mm0:alternates>' in fragment)
+
+
+@unittest.skipIf(mirrorlist_server is None, 'requires radix and geoip2')
+class GetOrComputeTests(unittest.TestCase):
+    """ Tests for LRUCache.get_or_compute() called from several
+    threads. """
+
+    def run_threads(self, count, target):
+        """ Runs target(index) in count threads which start together and
+        returns {index: result}, the result being ('value', value) or
+        ('error', exception). """
+        results = {}
+        barrier = threading.Barrier(count)
+
+        def run(index):
+            barrier.wait()
+            try:
+                results[index] = ('value', target(index))
+            except Exception as err:
+                results[index] = ('error', err)
+
+        threads = [
+            threading.Thread(target=run, args=(index,))
+            for index in range(count)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+        return results
+
+    def test_single_compute(self):
+        """ Test that concurrent misses of a key compute it once and all
+        get its value. """
+        cache = mirrorlist_server.LRUCache(10)
+        calls = []
+
+        def compute():
+            calls.append(1)
+            # give the other threads the time to miss the key too
+            time.sleep(0.5)
+            return object()
+
+        results = self.run_threads(
+            8, lambda index: cache.get_or_compute('key', compute))
+        self.assertEqual(len(calls), 1)
+        values = set(id(value) for kind, value in results.values())
+        self.assertEqual(set(kind for kind, value in results.values()),
+                         set(['value']))
+        self.assertEqual(len(values), 1)
+        self.assertIs(cache.get('key'), results[0][1])
+        self.assertEqual(cache.pending, {})
+
+    def test_leader_error(self):
+        """ Test that the threads waiting for a computation which fails
+        are released and compute the value on their own. """
+        cache = mirrorlist_server.LRUCache(10)
+        lock = threading.Lock()
+        calls = []
+
+        def compute():
+            with lock:
+                calls.append(1)
+                first = len(calls) == 1
+            if first:
+                time.sleep(0.5)
+                raise ValueError('leader failed')
+            return 'value'
+
+        results = self.run_threads(
+            8, lambda index: cache.get_or_compute('key', compute))
+        errors = [
+            value for kind, value in results.values() if kind == 'error']
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(isinstance(errors[0], ValueError))
+        self.assertEqual(
+            sorted(value for kind, value in results.values()
+                   if kind == 'value'),
+            ['value'] * 7)
+        self.assertEqual(cache.pending, {})
+
+    def test_error_raised_to_waiters(self):
+        """ Test that the waiters run into the error of a computation
+        which keeps failing instead of hanging. """
+        cache = mirrorlist_server.LRUCache(10)
+
+        def compute():
+            time.sleep(0.2)
+            raise ValueError('broken')
+
+        results = self.run_threads(
+            4, lambda index: cache.get_or_compute('key', compute))
+        self.assertEqual(
+            set(kind for kind, value in results.values()), set(['error']))
+        self.assertEqual(cache.pending, {})
+
+
+def mirrorlist_cache(hosts):
+    """ A pickled mirrorlist cache with one repository served by hosts,
+    {hostid: (country, [url, ...])}. """
+    entry = {
+        'global': set(hosts), 'byCountry': {}, 'byHostId': {},
+        'byCountryInternet2': {}, 'ordered_mirrorlist': False,
+        'subpath': 'releases/30/Everything/x86_64/os'}
+    hcurls = {}
+    for hostid, (country, urls) in sorted(hosts.items()):
+        entry['byCountry'].setdefault(country, set()).add(hostid)
+        entry['byHostId'][hostid] = []
+        for url in urls:
+            hcurls[len(hcurls) + 1] = url
+            entry['byHostId'][hostid].append(len(hcurls))
+    directory = 'pub/fedora/linux/releases/30/Everything/x86_64/os'
+    return {
+        'mirrorlist_cache': {directory: entry},
+        'repo_arch_to_directoryname': {('fedora-30', 'x86_64'): directory},
+        'host_bandwidth_cache': dict((hostid, 100) for hostid in hosts),
+        'host_country_cache': dict(
+            (hostid, country) for hostid, (country, urls) in hosts.items()),
+        'hcurl_cache': hcurls,
+        'file_details_cache': {},
+        'host_netblock_cache': {},
+        'host_country_allowed_cache': {},
+        'host_max_connections_cache': {},
+        'repo_redirect_cache': {},
+        'country_continent_redirect_cache': {},
+        'disabled_repositories': {},
+        'asn_host_cache': {},
+        'location_cache': {},
+        'netblock_country_cache': {},
+        'time': datetime.datetime(2020, 1, 1, 12, 0, 0),
+    }
+
+
+HOSTS = {
+    1: ('DE', ['http://mirror1.example.org/pub/fedora/linux',
+               'https://mirror1.example.org/pub/fedora/linux',
+               'rsync://mirror1.example.org/fedora']),
+    2: ('DE', ['ftp://mirror2.example.org/fedora/']),
+    3: ('US', ['https://mirror3.example.org/fedora']),
+    4: ('FR', ['rsync://mirror4.example.org/fedora']),
+}
+
+
+class LoadedCacheTestCase(unittest.TestCase):
+    """ Loads mirrorlist caches written to a temporary directory. """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='mm2_mirrorlist_server')
+        self.saved = dict(
+            (name, getattr(mirrorlist_server, name))
+            for name in ('cachefile', 'patchfile', 'global_netblocks_file',
+                         'internet2_netblocks_file', 'country_continent_csv',
+                         'answer_cache_size', 'database'))
+        mirrorlist_server.cachefile = os.path.join(self.path, 'cache.pkl')
+        mirrorlist_server.patchfile = os.path.join(self.path, 'cache.patch')
+        mirrorlist_server.global_netblocks_file = None
+        mirrorlist_server.internet2_netblocks_file = None
+        mirrorlist_server.country_continent_csv = os.path.join(
+            FOLDER, '..', 'utility', 'country_continent.csv')
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(mirrorlist_server, name, value)
+        shutil.rmtree(self.path)
+
+    def load(self, hosts, **kwargs):
+        """ Loads the cache of hosts, with its entries replaced by
+        kwargs. """
+        cache = mirrorlist_cache(hosts)
+        cache.update(kwargs)
+        with open(mirrorlist_server.cachefile, 'wb') as stream:
+            pickle.dump(cache, stream, 2)
+        mirrorlist_server.load_databases_and_caches()
+
+    def mirrorlist(self, **kwargs):
+        d = {'repo': 'fedora-30', 'arch': 'x86_64',
+             'client_ip': '192.0.2.1', 'metalink': False}
+        d.update(kwargs)
+        random.seed(1)
+        return mirrorlist_server.do_mirrorlist(d)
+
+
+@unittest.skipIf(mirrorlist_server is None, 'requires radix and geoip2')
+class CachedAnswersTests(LoadedCacheTestCase):
+    """ Tests for the answers kept per loaded cache. """
+
+    def test_lru_cache(self):
+        """ Test that the least recently used entries are evicted. """
+        cache = mirrorlist_server.LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        # setting a key again makes it the most recently used one
+        cache.set('a', 4)
+        cache.set('d', 5)
+        self.assertEqual(cache.get('c', 'evicted'), 'evicted')
+        self.assertEqual(cache.get('a'), 4)
+        self.assertEqual(cache.get_or_compute('d', lambda: 6), 5)
+        # a cache without room keeps nothing
+        cache = mirrorlist_server.LRUCache(0)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_cached_hosts(self):
+        """ Test that the hosts of a stage are computed once per key and
+        that the header of each request is kept. """
+        cache = mirrorlist_server.LRUCache(10)
+        calls = []
+
+        def compute(header):
+            calls.append(header)
+            return (header + 'country = DE ', set([1, 2]))
+
+        self.assertEqual(
+            mirrorlist_server.cached_hosts(cache, 'key', 'a ', compute),
+            ('a country = DE ', (1, 2)))
+        self.assertEqual(
+            mirrorlist_server.cached_hosts(cache, 'key', 'b ', compute),
+            ('b country = DE ', (1, 2)))
+        self.assertEqual(calls, [''])
+
+    def test_cached_urls(self):
+        """ Test that the URLs of a directory with the file appended are
+        the ones computed for the file, and that they are kept once for
+        all the files. """
+        self.load(HOSTS)
+        database = mirrorlist_server.database
+        directory = database['repo_arch_to_directoryname'][
+            ('fedora-30', 'x86_64')]
+        cache = database['mirrorlist_cache'][directory]
+        answer_cache = mirrorlist_server.LRUCache(10)
+        for protocols in (None, ('https', 'http', 'ftp'), ('rsync',)):
+            for file in (None, 'repodata/repomd.xml', 'Packages/'):
+                for is_directory in (False, True):
+                    expected = mirrorlist_server.append_path(
+                        cache['byHostId'], cache, file,
+                        pathIsDirectory=is_directory)
+                    if protocols is not None:
+                        expected = mirrorlist_server.\
+                            trim_to_preferred_protocols(expected, protocols)
+                    urls = mirrorlist_server.cached_urls(
+                        answer_cache, cache, directory, protocols)
+                    self.assertEqual(
+                        dict(
+                            (hostid, mirrorlist_server.append_file(
+                                hostid_urls, file, is_directory))
+                            for hostid, hostid_urls in urls.items()),
+                        dict(expected))
+        self.assertEqual(len(answer_cache), 3)
+
+    def test_uncached(self):
+        """ Test that the answers are the same with and without the
+        answer cache. """
+        requests = [
+            {}, {'country': 'FR'}, {'country': 'global'},
+            {'protocol': 'rsync'}, {'client_ip': '2001:db8::1'},
+            {'repo': 'fedora-31'},
+            {'path': 'pub/fedora/linux/releases/30/Everything/x86_64/os/'},
+            {'path': 'pub/fedora/linux/releases/30/Everything/x86_64/os/'
+                     'Packages/f/foo.rpm'},
+        ]
+        mirrorlist_server.answer_cache_size = 0
+        self.load(HOSTS)
+        uncached = [self.mirrorlist(**d) for d in requests]
+        mirrorlist_server.answer_cache_size = 100
+        self.load(HOSTS)
+        for i in range(2):
+            self.assertEqual(
+                [self.mirrorlist(**d) for d in requests], uncached)
+        self.assertTrue(len(mirrorlist_server.database['answer_cache']) > 0)
+
+    def test_reload(self):
+        """ Test that the answers of a cache are not used anymore once
+        another one is loaded. """
+        self.load(HOSTS)
+        answer_cache = mirrorlist_server.database['answer_cache']
+        results = self.mirrorlist()['results']
+        self.assertTrue(
+            (3, ['https://mirror3.example.org/fedora/'
+                 'releases/30/Everything/x86_64/os/']) in results)
+        self.assertTrue(len(answer_cache) > 0)
+
+        hosts = dict(HOSTS)
+        hosts[3] = ('US', ['https://mirror5.example.org/fedora'])
+        self.load(hosts)
+        self.assertIsNot(mirrorlist_server.database['answer_cache'],
+                         answer_cache)
+        results = self.mirrorlist()['results']
+        self.assertTrue(
+            (3, ['https://mirror5.example.org/fedora/'
+                 'releases/30/Everything/x86_64/os/']) in results)
+
+
+@unittest.skipIf(mirrorlist_server is None, 'requires radix and geoip2')
+class RepoListingTests(LoadedCacheTestCase):
+    """ Tests for the repositories listed for an invalid repo or arch. """
+
+    def test_repo_listing(self):
+        """ Test the listing of all repositories and per repository. """
+        listing, arches = mirrorlist_server.repo_listing({
+            ('fedora-30', 'x86_64'): 'a',
+            ('fedora-29', 'x86_64'): 'b',
+            ('fedora-30', 'aarch64'): 'c',
+            (None, 'x86_64'): 'd',
+            ('epel-8', None): 'e',
+        })
+        self.assertEqual(
+            listing,
+            '# repo=fedora-29&arch=x86_64\n'
+            '# repo=fedora-30&arch=aarch64\n'
+            '# repo=fedora-30&arch=x86_64\n')
+        self.assertEqual(arches, {
+            'fedora-29': '# repo=fedora-29&arch=x86_64\n',
+            'fedora-30': '# repo=fedora-30&arch=aarch64\n'
+                         '# repo=fedora-30&arch=x86_64\n',
+        })
+        self.assertEqual(mirrorlist_server.repo_listing({}), ('', {}))
+
+    def test_invalid_repo(self):
+        """ Test the answers to invalid repositories and arches, and that
+        they follow the repositories of a patch. """
+        self.load(HOSTS)
+        message = self.mirrorlist(repo='fedora-31')['message']
+        self.assertEqual(
+            message,
+            '# repo = fedora-31 arch = x86_64 error: invalid repo or arch\n'
+            '# following repositories are available:\n'
+            '# repo=fedora-30&arch=x86_64\n')
+        message = self.mirrorlist(arch='aarch64')['message']
+        self.assertEqual(
+            message,
+            '# repo = fedora-30 arch = aarch64 error: invalid repo or arch\n'
+            '# did you mean:\n'
+            '# repo=fedora-30&arch=x86_64\n')
+
+        directory = 'pub/fedora/linux/releases/30/Everything/x86_64/os'
+        with open(mirrorlist_server.patchfile, 'wb') as stream:
+            marshal.dump({
+                'patch_version': mirrorlist_server.PATCH_VERSION,
+                'base_time': mirrorlist_server.cache_timestamp(
+                    mirrorlist_server.database['time']),
+                'time': mirrorlist_server.cache_timestamp(
+                    datetime.datetime(2020, 1, 1, 13, 0, 0)),
+                'changes': {
+                    'repo_arch_to_directoryname': (
+                        {('fedora-30', 'ppc64le'): directory,
+                         ('fedora-31', 'x86_64'): directory},
+                        [('fedora-30', 'x86_64')]),
+                },
+            }, stream, 2)
+        self.assertTrue(mirrorlist_server.apply_patch())
+        message = self.mirrorlist(repo='fedora-29')['message']
+        self.assertEqual(
+            message,
+            '# repo = fedora-29 arch = x86_64 error: invalid repo or arch\n'
+            '# following repositories are available:\n'
+            '# repo=fedora-30&arch=ppc64le\n'
+            '# repo=fedora-31&arch=x86_64\n')
+        message = self.mirrorlist()['message']
+        self.assertEqual(
+            message,
+            '# repo = fedora-30 arch = x86_64 error: invalid repo or arch\n'
+            '# did you mean:\n'
+            '# repo=fedora-30&arch=ppc64le\n')
+        self.assertEqual(
+            self.mirrorlist(arch='ppc64le')['returncode'], 200)
+        self.assertTrue(self.mirrorlist(repo='fedora-31')['results'])
+
+
+@unittest.skipIf(mirrorlist_server is None, 'requires radix and geoip2')
+class SupervisorTests(unittest.TestCase):
+    """ Tests for the management of the pre-forked workers. """
+
+    def setUp(self):
+        self.pids = iter(range(100, 200))
+        self.pool = mirrorlist_server.WorkerPool(lambda: next(self.pids))
+
+    def tearDown(self):
+        mirrorlist_server.reload_requested = False
+        mirrorlist_server.patch_requested = False
+
+    def test_respawn(self):
+        """ Test that a worker which died is replaced, unless the
+        supervisor is exiting. """
+        self.pool.spawn(3)
+        self.assertEqual(self.pool.current, set([100, 101, 102]))
+        self.assertTrue(self.pool.exited(101))
+        self.assertEqual(self.pool.current, set([100, 102, 103]))
+        # not one of the workers
+        self.assertFalse(self.pool.exited(42))
+        self.assertEqual(self.pool.current, set([100, 102, 103]))
+        self.assertFalse(self.pool.exited(100, respawn=False))
+        self.assertEqual(self.pool.current, set([102, 103]))
+        self.assertEqual(self.pool.all(), set([102, 103]))
+
+    def test_roll(self):
+        """ Test that a new generation is started while the old one
+        finishes its requests. """
+        self.pool.spawn(2)
+        mirrorlist_server.supervisor_sighup_handler(None, None)
+        mirrorlist_server.supervisor_sigusr1_handler(None, None)
+        self.assertEqual(mirrorlist_server.requested_action(), 'reload')
+        # the reload covers the patch
+        self.assertEqual(mirrorlist_server.requested_action(), None)
+
+        self.assertEqual(self.pool.roll(2), set([100, 101]))
+        self.assertEqual(self.pool.current, set([102, 103]))
+        self.assertEqual(self.pool.retiring, set([100, 101]))
+        # the old workers exiting are not replaced
+        self.assertFalse(self.pool.exited(100))
+        self.assertEqual(self.pool.current, set([102, 103]))
+        self.assertEqual(self.pool.all(), set([101, 102, 103]))
+
+        mirrorlist_server.supervisor_sigusr1_handler(None, None)
+        self.assertEqual(mirrorlist_server.requested_action(), 'patch')
+        self.assertEqual(self.pool.roll(2), set([101, 102, 103]))
+        self.assertEqual(self.pool.current, set([104, 105]))
+        # a worker of the new generation dying is replaced
+        self.assertTrue(self.pool.exited(105))
+        self.assertEqual(self.pool.current, set([104, 106]))
+        for pid in (101, 102, 103):
+            self.assertFalse(self.pool.exited(pid))
+        self.assertEqual(self.pool.all(), set([104, 106]))
+
+
+@unittest.skipIf(mirrorlist_server is None, 'requires radix and geoip2')
+@unittest.skipIf(not hasattr(time, 'tzset'), 'requires time.tzset()')
+class CacheAgeTests(LoadedCacheTestCase):
+    """ Tests for the age of the loaded cache on the stats socket, which
+    must not depend on the time zone of the server. """
+
+    def setUp(self):
+        LoadedCacheTestCase.setUp(self)
+        self.saved['stats'] = mirrorlist_server.stats
+        mirrorlist_server.stats = mirrorlist_server.server_stats.Stats(1)
+        self.tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'America/New_York'
+        time.tzset()
+
+    def tearDown(self):
+        if self.tz is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = self.tz
+        time.tzset()
+        LoadedCacheTestCase.tearDown(self)
+
+    def cache_age(self):
+        for line in mirrorlist_server.render_stats().splitlines():
+            if line.startswith('mirrorlist_cache_age_seconds '):
+                return float(line.split()[1])
+        self.fail('no mirrorlist_cache_age_seconds')
+
+    def test_pickle(self):
+        """ Test the age of a pickle cache built just now. """
+        self.load(HOSTS, time=datetime.datetime.utcnow())
+        self.assertTrue(abs(self.cache_age()) < 60, self.cache_age())
+        self.load(HOSTS, time=datetime.datetime.utcnow()
+                  - datetime.timedelta(hours=2))
+        self.assertTrue(abs(self.cache_age() - 7200) < 60)
+
+    def test_timestamps(self):
+        """ Test that the timestamps of the memory-mapped caches and the
+        patches are seconds since the epoch and give the times back. """
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        timestamp = mirrorlist_server.cache_timestamp(now)
+        self.assertTrue(abs(timestamp - time.time()) < 60)
+        self.assertEqual(mirrorlist_server.cache_time(timestamp), now)
+
+    def test_patch(self):
+        """ Test the age after a patch written just now. """
+        self.load(HOSTS, time=datetime.datetime.utcnow()
+                  - datetime.timedelta(hours=2))
+        with open(mirrorlist_server.patchfile, 'wb') as stream:
+            marshal.dump({
+                'patch_version': mirrorlist_server.PATCH_VERSION,
+                'base_time': mirrorlist_server.cache_timestamp(
+                    mirrorlist_server.database['time']),
+                'time': int(time.time()),
+                'changes': {},
+            }, stream, 2)
+        self.assertTrue(mirrorlist_server.apply_patch())
+        self.assertTrue(abs(self.cache_age()) < 60, self.cache_age())
+
+
+if __name__ == '__main__':
+    SUITE = unittest.TestSuite([
+        unittest.TestLoader().loadTestsFromTestCase(LazyFileDetailsTests),
+        unittest.TestLoader().loadTestsFromTestCase(GetOrComputeTests),
+        unittest.TestLoader().loadTestsFromTestCase(CachedAnswersTests),
+        unittest.TestLoader().loadTestsFromTestCase(RepoListingTests),
+        unittest.TestLoader().loadTestsFromTestCase(SupervisorTests),
+        unittest.TestLoader().loadTestsFromTestCase(CacheAgeTests),
+    ])
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
@@ -15,9 +15,22 @@ import mirrormanager2.lib.mirrorlist
 import mirrormanager2.lib.mirrormanager_pb2
 import tests
 import tempfile
+import calendar
 import datetime
+import marshal
 import pickle
+import struct
 from IPy import IP
+import sqlalchemy
+
+FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(FOLDER, '..', 'mirrorlist'))
+
+try:
+    import mirrorlist_server
+except ImportError:
+    # the server needs radix and geoip2
+    mirrorlist_server = None
 
 
 class MMLibtests(tests.Modeltests):
@@ -41,6 +54,14 @@ class MMLibtests(tests.Modeltests):
         results = mirrormanager2.lib.query_directories(self.session)
         self.assertEqual(len(results), 12)
 
+        # streamed a few rows at a time, in the same order
+        streamed = mirrormanager2.lib.query_directories(
+            self.session, yield_per=5)
+        self.assertEqual(list(streamed), results)
+        self.assertEqual(
+            [row.dname for row in results],
+            sorted(row.dname for row in results))
+
     def test_get_site(self):
         """ Test the get_site function of mirrormanager2.lib. """
         tests.create_site(self.session)
@@ -1349,9 +1370,549 @@ class MMLibtests(tests.Modeltests):
                 mc['byHostId'][id.key] = []
                 for h, hcurl in enumerate(id.value):
                     mc['byHostId'][id.key].append(hcurl)
+                # shrink() turns the lists into tuples
+                mc['byHostId'][id.key] = tuple(mc['byHostId'][id.key])
 
         self.assertEqual(data['mirrorlist_cache'], mirrorlist_cache)
 
+    def test_mirrorlist_export_mmap(self):
+        """ Test the export to the memory-mapped mirrorlist cache by
+        reading back the section table, the meta section and the
+        directory index.
+        """
+
+        tests.create_base_items(self.session)
+        tests.create_site(self.session)
+        tests.create_hosts(self.session)
+        tests.create_directory(self.session)
+        tests.create_filedetail(self.session)
+        tests.create_category(self.session)
+        tests.create_categorydirectory(self.session)
+        tests.create_hostcategory(self.session)
+        tests.create_hostcategoryurl(self.session)
+        tests.create_hostcategorydir(self.session)
+        tests.create_hostnetblock(self.session)
+        tests.create_netblockcountry(self.session)
+        tests.create_repositoryredirect(self.session)
+        tests.create_version(self.session)
+        tests.create_repository(self.session)
+
+        mirrormanager2.lib.mirrorlist.populate_all_caches(self.session)
+        data = mirrormanager2.lib.mirrorlist.data
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        mirrormanager2.lib.mirrorlist.dump_caches(
+            self.session, mmap_file=path)
+
+        with open(path, 'rb') as f:
+            buf = f.read()
+        os.remove(path)
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+        magic, version, nsections, timestamp = struct.unpack_from(
+            '<8sIIq', buf, 0)
+        self.assertEqual(magic, b'MMLCACHE')
+        self.assertEqual(version, 2)
+        # seconds since the epoch of the UTC creation time
+        self.assertEqual(
+            timestamp, calendar.timegm(data['time'].utctimetuple()))
+
+        sections = {}
+        for i in range(nsections):
+            name, start, length = struct.unpack_from(
+                '<8sQQ', buf, struct.calcsize('<8sIIq') + i * 24)
+            sections[name.rstrip(b'\0')] = (start, length)
+        self.assertEqual(
+            sorted(sections), [b'dirs', b'files', b'hcurls', b'meta'])
+
+        start, length = sections[b'meta']
+        meta = marshal.loads(buf[start:start + length])
+        self.assertEqual(
+            meta['repo_redirect_cache'], data['repo_redirect_cache'])
+        self.assertEqual(
+            meta['host_bandwidth_cache'], data['host_bandwidth_cache'])
+        self.assertEqual(
+            meta['host_netblock_cache'], {'192.168.0.0/24': [3]})
+
+        # the directory index is sorted and has one entry per directory
+        start, length = sections[b'dirs']
+        (count,) = struct.unpack_from('<I', buf, start)
+        offsets = struct.unpack_from('<%dI' % (count + 1), buf, start + 4)
+        keys_base = start + 4 + 4 * (count + 1) + 4 * count
+        names = [
+            buf[keys_base + offsets[i]:keys_base + offsets[i + 1]].decode()
+            for i in range(count)
+        ]
+        self.assertEqual(names, sorted(data['mirrorlist_cache']))
+
+    @unittest.skipIf(mirrorlist_server is None, 'requires radix and geoip2')
+    def test_mirrorlist_mmap_round_trip(self):
+        """ Test that the mirrorlist server reads the same caches from
+        the memory-mapped cache as from the pickle.
+        """
+        tests.create_base_items(self.session)
+        tests.create_site(self.session)
+        tests.create_hosts(self.session)
+        tests.create_directory(self.session)
+        tests.create_filedetail(self.session)
+        tests.create_category(self.session)
+        tests.create_categorydirectory(self.session)
+        tests.create_hostcategory(self.session)
+        tests.create_hostcategoryurl(self.session)
+        tests.create_hostcategorydir(self.session)
+        tests.create_hostcategorydir_one_more(self.session)
+        tests.create_hostpeerasn(self.session)
+        tests.create_hostnetblock(self.session)
+        tests.create_netblockcountry(self.session)
+        tests.create_repositoryredirect(self.session)
+        tests.create_version(self.session)
+        tests.create_repository(self.session)
+        tests.create_hostcountry(self.session)
+        tests.create_host_country_allowed(self.session)
+
+        mirrormanager2.lib.mirrorlist.populate_all_caches(self.session)
+        path = tempfile.mkdtemp(prefix='mm2_mmap')
+        pickle_file = os.path.join(path, 'cache.pkl')
+        mmap_file = os.path.join(path, 'cache.mmap')
+        mirrormanager2.lib.mirrorlist.dump_caches(
+            self.session, filename=pickle_file, mmap_file=mmap_file)
+
+        with open(pickle_file, 'rb') as f:
+            expected = pickle.load(f)
+        with open(mmap_file, 'rb') as f:
+            info = mirrorlist_server.read_mmap_cache(f)
+        os.remove(pickle_file)
+        os.remove(mmap_file)
+        os.rmdir(path)
+
+        self.assertEqual(
+            info['time'], expected['time'].replace(microsecond=0))
+        self.assertEqual(
+            info['repo_redirect'], expected['repo_redirect_cache'])
+        for key in (
+                'host_country_allowed_cache', 'host_bandwidth_cache',
+                'host_country_cache', 'host_max_connections_cache',
+                'asn_host_cache', 'repo_arch_to_directoryname',
+                'country_continent_redirect_cache', 'disabled_repositories',
+                'location_cache', 'host_netblock_cache',
+                'netblock_country_cache'):
+            self.assertEqual(info[key], expected[key], key)
+
+        # the directories come out in the compact form of the server
+        interner = mirrorlist_server.host_vectors.Interner()
+        directories = info['mirrorlist_cache']
+        self.assertEqual(
+            sorted(directories), sorted(expected['mirrorlist_cache']))
+        self.assertEqual(
+            len(directories), len(expected['mirrorlist_cache']))
+        for directory, c in expected['mirrorlist_cache'].items():
+            self.assertTrue(directory in directories)
+            compact = interner.directory(c)
+            decoded = directories[directory]
+            for key in ('global', 'byCountry', 'byCountryInternet2',
+                        'byHostId'):
+                self.assertEqual(decoded[key], compact[key], key)
+            self.assertEqual(
+                decoded['ordered_mirrorlist'],
+                bool(c.get('ordered_mirrorlist')))
+            self.assertEqual(decoded.get('subpath'), c.get('subpath'))
+            # decoded directories are kept
+            self.assertTrue(directories[directory] is decoded)
+        self.assertFalse('no/such/directory' in directories)
+        self.assertRaises(
+            KeyError, lambda: directories['no/such/directory'])
+
+        hcurls = info['hcurl_cache']
+        self.assertEqual(len(hcurls), len(expected['hcurl_cache']))
+        for hcurl_id, url in expected['hcurl_cache'].items():
+            self.assertEqual(hcurls[hcurl_id], url)
+        self.assertFalse(-1 in hcurls)
+
+        file_details = info['file_details_cache']
+        self.assertEqual(
+            sorted(file_details), sorted(expected['file_details_cache']))
+        self.assertTrue(len(expected['file_details_cache']) > 0)
+        for directory, files in expected['file_details_cache'].items():
+            self.assertEqual(sorted(file_details[directory]), sorted(files))
+            for filename, detailslist in files.items():
+                self.assertEqual(
+                    file_details[directory][filename], detailslist)
+
+    @unittest.skipIf(mirrorlist_server is None, 'requires radix and geoip2')
+    def test_mirrorlist_mmap_magic(self):
+        """ Test that the mirrorlist server refuses files which are not
+        memory-mapped caches.
+        """
+        with tempfile.TemporaryFile() as f:
+            f.write(b'NOTACACHE' + b'\0' * 64)
+            f.flush()
+            self.assertRaises(
+                ValueError, mirrorlist_server.read_mmap_cache, f)
+
+    def test_shrink(self):
+        """ Test that shrink() shares equal subcaches, also nested ones.
+        """
+        def entry(hosts, countries):
+            return {
+                'global': set(hosts),
+                'byCountry': dict(
+                    (c, set(hosts)) for c in countries),
+                'byHostId': dict((h, [h * 10]) for h in hosts),
+                'byCountryInternet2': {},
+            }
+
+        cache = {
+            'a': entry([1, 2], ['US']),
+            'b': entry([2, 1], ['US']),
+            'c': entry([1, 2], ['DE']),
+        }
+        report = mirrormanager2.lib.mirrorlist.shrink(cache)
+        shrunk = cache
+        for name, countries in (('a', 'US'), ('b', 'US'), ('c', 'DE')):
+            self.assertEqual(shrunk[name], {
+                'global': frozenset([1, 2]),
+                'byCountry': {countries: frozenset([1, 2])},
+                'byHostId': {1: (10,), 2: (20,)},
+                'byCountryInternet2': {},
+            })
+        for key in ('global', 'byCountry', 'byHostId', 'byCountryInternet2'):
+            self.assertIs(shrunk['a'][key], shrunk['b'][key])
+        self.assertIsNot(shrunk['a']['byCountry'], shrunk['c']['byCountry'])
+        self.assertIs(shrunk['c']['byCountry']['DE'], shrunk['a']['global'])
+        self.assertIs(shrunk['c']['byHostId'], shrunk['a']['byHostId'])
+        # an empty dict is not an empty set
+        self.assertEqual(shrunk['a']['byCountryInternet2'], {})
+        # the shared subcaches cannot be changed in place
+        self.assertRaises(AttributeError, lambda: shrunk['a']['global'].add)
+        self.assertRaises(
+            AttributeError, lambda: shrunk['a']['byHostId'][1].append)
+
+        self.assertEqual(
+            report, '14 of 21 sets, lists and dicts shared (66.7%)')
+
+    def test_dump_deterministic(self):
+        """ Test that two builds from the same database are pickled to
+        the same bytes.
+        """
+        tests.create_base_items(self.session)
+        tests.create_site(self.session)
+        tests.create_hosts(self.session)
+        tests.create_directory(self.session)
+        tests.create_filedetail(self.session)
+        tests.create_category(self.session)
+        tests.create_categorydirectory(self.session)
+        tests.create_hostcategory(self.session)
+        tests.create_hostcategoryurl(self.session)
+        tests.create_hostcategorydir(self.session)
+        tests.create_hostcategorydir_one_more(self.session)
+        tests.create_hostnetblock(self.session)
+        tests.create_netblockcountry(self.session)
+        tests.create_version(self.session)
+        tests.create_repository(self.session)
+
+        mirrorlist = mirrormanager2.lib.mirrorlist
+        dumps = []
+        for i in range(2):
+            mirrorlist.populate_all_caches(self.session)
+            # only the time of the build differs
+            mirrorlist.data['time'] = datetime.datetime(2026, 1, 1)
+            fd, path = tempfile.mkstemp()
+            os.close(fd)
+            mirrorlist.dump_caches(self.session, filename=path)
+            with open(path, 'rb') as f:
+                dumps.append(f.read())
+            os.remove(path)
+        self.assertEqual(dumps[0], dumps[1])
+
+    def test_file_details_cache(self):
+        """ Test building the file details of the metalinks, newest first.
+        """
+        tests.create_directory(self.session)
+        tests.create_filedetail(self.session)
+        for timestamp, size in ((1351758830, 3000), (1351758820, 2000)):
+            self.session.add(mirrormanager2.lib.model.FileDetail(
+                filename='repomd.xml',
+                directory_id=4,
+                timestamp=timestamp,
+                size=size,
+            ))
+        self.session.commit()
+
+        cache = mirrormanager2.lib.mirrorlist.file_details_cache(
+            self.session)
+        self.assertEqual(len(cache), 4)
+        details = cache['pub/fedora/linux/releases/26']['repomd.xml']
+        self.assertEqual(
+            [d['timestamp'] for d in details],
+            [1351758830, 1351758825, 1351758820])
+        self.assertEqual(details[1], {
+            'timestamp': 1351758825, 'size': 2972, 'sha1': 'foo_sha1',
+            'md5': 'foo_md5', 'sha256': 'foo_sha256',
+            'sha512': 'foo_sha512'})
+
+        cache = mirrormanager2.lib.mirrorlist.file_details_cache(
+            self.session, max_file_details=2)
+        details = cache['pub/fedora/linux/releases/26']['repomd.xml']
+        self.assertEqual(
+            [d['size'] for d in details], [3000, 2972])
+
+    def test_populate_host_caches_queries(self):
+        """ Test that populate_host_caches() issues the same few queries
+        however many hosts there are.
+        """
+        tests.create_base_items(self.session)
+        tests.create_site(self.session)
+        tests.create_hosts(self.session)
+        tests.create_hostnetblock(self.session)
+        tests.create_hostpeerasn(self.session)
+        tests.create_host_country_allowed(self.session)
+        # load every relation anew, like a fresh refresh would
+        self.session.expire_all()
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        engine = self.session.get_bind()
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', count)
+        try:
+            mirrormanager2.lib.mirrorlist.populate_host_caches(self.session)
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute', count)
+        self.assertEqual(len(statements), 4)
+
+        caches = mirrormanager2.lib.mirrorlist.global_caches
+        self.assertEqual(
+            caches['host_netblock_cache'], {IP('192.168.0.0/24'): [3]})
+        self.assertEqual(
+            caches['host_country_allowed_cache'], {4: ['HR', 'US']})
+        self.assertEqual(
+            caches['host_bandwidth_cache'], {1: 100, 2: 100, 3: 100, 4: 300})
+        self.assertEqual(caches['host_max_connections_cache'][1], 10)
+        self.assertEqual(caches['host_asn_cache'], {100: [2]})
+
+    def test_mirrorlist_delta(self):
+        """ Test that populate_changed_caches() produces the same caches
+        as a full rebuild and a patch with only the differences.
+        """
+
+        tests.create_base_items(self.session)
+        tests.create_site(self.session)
+        tests.create_hosts(self.session)
+        tests.create_directory(self.session)
+        tests.create_filedetail(self.session)
+        tests.create_category(self.session)
+        tests.create_categorydirectory(self.session)
+        tests.create_hostcategory(self.session)
+        tests.create_hostcategoryurl(self.session)
+        tests.create_hostcategorydir(self.session)
+        tests.create_hostnetblock(self.session)
+        tests.create_netblockcountry(self.session)
+        tests.create_repositoryredirect(self.session)
+        tests.create_version(self.session)
+        tests.create_repository(self.session)
+
+        mirrorlist = mirrormanager2.lib.mirrorlist
+        mirrorlist.populate_all_caches(self.session)
+        # as read back by mm2_refresh_mirrorlist_cache --delta
+        previous = pickle.loads(pickle.dumps(mirrorlist.data))
+
+        # nothing changed
+        patch = mirrorlist.populate_changed_caches(self.session, previous)
+        self.assertEqual(patch['base_time'], previous['time'])
+        self.assertEqual(patch['time'], mirrorlist.data['time'])
+        self.assertEqual(patch['changes'], {})
+
+        # a crawl finds the second host out of date and the first host
+        # moves to another country
+        hcd = mirrormanager2.lib.get_hostcategorydir_by_hostcategoryid_and_path(
+            self.session, 3, 'pub/fedora/linux/releases/27')[0]
+        hcd.up2date = False
+        host = mirrormanager2.lib.get_host(self.session, 2)
+        host.last_crawled = datetime.datetime.utcnow()
+        host = mirrormanager2.lib.get_host(self.session, 1)
+        host.country = 'DE'
+        self.session.commit()
+
+        patch = mirrorlist.populate_changed_caches(self.session, previous)
+        delta = mirrorlist.data
+        mirrorlist.populate_all_caches(self.session)
+        full = mirrorlist.data
+
+        for key in full:
+            if key == 'time':
+                continue
+            self.assertEqual(delta[key], full[key], key)
+
+        changes = patch['changes']
+        self.assertEqual(
+            sorted(changes), ['host_country_cache', 'mirrorlist_cache'])
+        updated, removed = changes['mirrorlist_cache']
+        self.assertEqual(removed, [])
+        self.assertEqual(
+            sorted(updated),
+            ['pub/fedora/linux', 'pub/fedora/linux/releases/26',
+             'pub/fedora/linux/releases/27'])
+        self.assertEqual(
+            updated['pub/fedora/linux/releases/27']['byCountry'],
+            {'DE': set([1])})
+        self.assertEqual(
+            list(updated['pub/fedora/linux/releases/27']['byHostId']), [1])
+        self.assertEqual(changes['host_country_cache'], ({1: 'DE'}, []))
+
+        # the patch turns the previous caches into the new ones
+        for key, (updated, removed) in changes.items():
+            cache = dict(previous[key])
+            for k in removed:
+                del cache[k]
+            cache.update(updated)
+            self.assertEqual(cache, full[key], key)
+
+        # the unchanged entries are still the same objects
+        previous = pickle.loads(pickle.dumps(full))
+        mirrorlist.populate_changed_caches(self.session, previous)
+        self.assertIs(
+            mirrorlist.data['mirrorlist_cache']['pub/fedora/linux'],
+            previous['mirrorlist_cache']['pub/fedora/linux'])
+
+        # the second host is up to date again: only its directory is
+        # rebuilt, sharing its subcaches with the unchanged ones
+        hcd.up2date = True
+        host = mirrormanager2.lib.get_host(self.session, 2)
+        host.last_crawled = datetime.datetime.utcnow()
+        self.session.commit()
+        patch = mirrorlist.populate_changed_caches(self.session, previous)
+        delta = mirrorlist.data
+        mirrorlist.populate_all_caches(self.session)
+        full = mirrorlist.data
+        for key in full:
+            if key != 'time':
+                self.assertEqual(delta[key], full[key], key)
+        self.assertEqual(
+            sorted(patch['changes']['mirrorlist_cache'][0]),
+            ['pub/fedora/linux/releases/27'])
+        cache = delta['mirrorlist_cache']
+        self.assertIs(
+            cache['pub/fedora/linux/releases/27']['byHostId'][1],
+            cache['pub/fedora/linux']['byHostId'][1])
+
+        # no host is active anymore: the directories no host carries are
+        # left out, together with their repositories
+        previous = pickle.loads(pickle.dumps(full))
+        for hostid in (1, 2):
+            host = mirrormanager2.lib.get_host(self.session, hostid)
+            host.user_active = False
+        self.session.commit()
+        patch = mirrorlist.populate_changed_caches(self.session, previous)
+        delta = mirrorlist.data
+        mirrorlist.populate_all_caches(self.session)
+        full = mirrorlist.data
+        for key in full:
+            if key != 'time':
+                self.assertEqual(delta[key], full[key], key)
+        self.assertEqual(delta['mirrorlist_cache'], {})
+        self.assertEqual(delta['repo_arch_to_directoryname'], {})
+        updated, removed = patch['changes']['mirrorlist_cache']
+        self.assertEqual(
+            sorted(removed),
+            ['pub/fedora/linux', 'pub/fedora/linux/releases/26',
+             'pub/fedora/linux/releases/27'])
+
+        # FileDetails are added to one directory and deleted from
+        # another: only their entries are read again
+        previous = pickle.loads(pickle.dumps(full))
+        self.session.add(mirrormanager2.lib.model.FileDetail(
+            filename='repomd.xml',
+            directory_id=4,
+            timestamp=1351758900,
+            size=2990,
+        ))
+        self.session.query(mirrormanager2.lib.model.FileDetail).filter(
+            mirrormanager2.lib.model.FileDetail.directory_id == 7).delete()
+        self.session.commit()
+        patch = mirrorlist.populate_changed_caches(self.session, previous)
+        delta = mirrorlist.data
+        mirrorlist.populate_all_caches(self.session)
+        full = mirrorlist.data
+        for key in full:
+            if key != 'time':
+                self.assertEqual(delta[key], full[key], key)
+        self.assertEqual(sorted(patch['changes']), ['file_details_cache'])
+        updated, removed = patch['changes']['file_details_cache']
+        self.assertEqual(sorted(updated), ['pub/fedora/linux/releases/26'])
+        self.assertEqual(
+            [d['size'] for d in
+             updated['pub/fedora/linux/releases/26']['repomd.xml']],
+            [2990, 2972])
+        self.assertEqual(
+            removed, ['pub/fedora/linux/updates/testing/25/x86_64'])
+        # the others are kept from the previous run
+        self.assertIs(
+            delta['file_details_cache'][
+                'pub/fedora/linux/updates/testing/26/x86_64'],
+            previous['file_details_cache'][
+                'pub/fedora/linux/updates/testing/26/x86_64'])
+
+        # a new repository needs a full refresh
+        item = mirrormanager2.lib.model.Repository(
+            name='pub/fedora/linux/releases/26',
+            prefix='fedora-26',
+            category_id=1,
+            version_id=1,
+            arch_id=3,
+            directory_id=4,
+        )
+        self.session.add(item)
+        self.session.commit()
+        self.assertIsNone(
+            mirrorlist.populate_changed_caches(self.session, previous))
+
+        # so does a cache written before delta refreshes existed
+        del previous['host_state']
+        self.assertIsNone(
+            mirrorlist.populate_changed_caches(self.session, previous))
+
+
+    def test_dump_patch(self):
+        """ Test writing a patch of populate_changed_caches(). """
+        base_time = datetime.datetime(2026, 1, 1, 12, 0, 0, 500)
+        patch = {
+            'patch_version': mirrormanager2.lib.mirrorlist.PATCH_VERSION,
+            'base_time': base_time,
+            'time': base_time + datetime.timedelta(minutes=5),
+            'changes': {
+                'host_netblock_cache': (
+                    {IP('192.168.0.0/24'): [1, 2]}, [IP('2001:db8::/32')]),
+                'mirrorlist_cache': ({
+                    'pub/fedora/linux': {
+                        'global': frozenset([1]),
+                        'byCountry': {'US': frozenset([1])},
+                        'byCountryInternet2': {},
+                        'byHostId': {1: (3, 4)},
+                        'ordered_mirrorlist': True,
+                        'subpath': '',
+                    }}, []),
+            },
+        }
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        mirrormanager2.lib.mirrorlist.dump_patch(path, patch)
+        with open(path, 'rb') as f:
+            written = marshal.load(f)
+        os.remove(path)
+        self.assertEqual(written['patch_version'], patch['patch_version'])
+        self.assertEqual(
+            written['base_time'], calendar.timegm(base_time.utctimetuple()))
+        self.assertEqual(written['time'] - written['base_time'], 300)
+        self.assertEqual(
+            written['changes']['host_netblock_cache'],
+            ({'192.168.0.0/24': [1, 2]},
+             [IP('2001:db8::/32').strNormal()]))
+        self.assertEqual(
+            written['changes']['mirrorlist_cache'],
+            patch['changes']['mirrorlist_cache'])
+
 
 if __name__ == '__main__':
     SUITE = unittest.TestLoader().loadTestsFromTestCase(MMLibtests)
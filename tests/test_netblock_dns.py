@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+'''
+mirrormanager2 tests for the resolution of host names given as netblocks.
+'''
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import mirrormanager2.lib.netblock_dns as netblock_dns
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+
+class NetblockDNSTests(unittest.TestCase):
+    """ Netblock DNS tests. """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='mm2_netblock_dns')
+        self.cache_file = os.path.join(self.path, 'dns.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def resolve_names(self, *args, **kwargs):
+        """ netblock_dns.resolve_names(), returns its results and the
+        lines it printed. """
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            results = netblock_dns.resolve_names(*args, **kwargs)
+            printed = sys.stdout.getvalue().splitlines()
+        finally:
+            sys.stdout = stdout
+        return results, printed
+
+    def test_resolve_names(self):
+        """ Test resolving names and keeping the answers until their TTL
+        runs out. """
+        looked_up = []
+
+        def resolve(name, lifetime):
+            looked_up.append(name)
+            if name == 'broken.example.com':
+                raise netblock_dns.ResolveError(name)
+            return ['192.0.2.%d' % len(name), '2001:db8::1'], 300
+
+        results, printed = self.resolve_names(
+            ['a.example.com', 'broken.example.com', 'a.example.com'],
+            cache_file=self.cache_file, resolve=resolve, now=1000)
+        self.assertEqual(printed, [
+            'Cannot resolve 1 host names, keeping their last answers, '
+            'if any: broken.example.com'])
+        self.assertEqual(results, {
+            'a.example.com': ['192.0.2.13', '2001:db8::1'],
+            'broken.example.com': [],
+        })
+        self.assertEqual(
+            sorted(looked_up), ['a.example.com', 'broken.example.com'])
+        with open(self.cache_file) as stream:
+            self.assertEqual(json.load(stream), {
+                'a.example.com': [1300, ['192.0.2.13', '2001:db8::1']]})
+
+        # still valid
+        del looked_up[:]
+        results, printed = self.resolve_names(
+            ['a.example.com'], cache_file=self.cache_file, resolve=resolve,
+            now=1200)
+        self.assertEqual(results['a.example.com'][0], '192.0.2.13')
+        self.assertEqual(looked_up, [])
+        self.assertEqual(printed, [])
+
+        # expired, but the name servers fail: the last answer is kept
+        def failing(name, lifetime):
+            if name == 'b.example.com':
+                raise ValueError(name)
+            raise netblock_dns.ResolveError(name)
+
+        results, printed = self.resolve_names(
+            ['a.example.com', 'b.example.com'], cache_file=self.cache_file,
+            resolve=failing, now=2000)
+        self.assertEqual(results['a.example.com'][0], '192.0.2.13')
+        self.assertEqual(printed, [
+            'Cannot resolve 2 host names, keeping their last answers, '
+            'if any: a.example.com, b.example.com'])
+        with open(self.cache_file) as stream:
+            self.assertEqual(json.load(stream)['a.example.com'][0], 1300)
+
+        # names which are not asked for anymore are forgotten
+        netblock_dns.resolve_names(
+            [], cache_file=self.cache_file, resolve=resolve)
+        with open(self.cache_file) as stream:
+            self.assertEqual(json.load(stream), {})
+
+    def test_deadline(self):
+        """ Test that slow names do not hold up the others past the
+        deadline and that at most workers names are resolved at once. """
+        running = []
+        most = []
+        lock = threading.Lock()
+        release = threading.Event()
+
+        def resolve(name, lifetime):
+            with lock:
+                running.append(name)
+                most.append(len(running))
+            if name.startswith('slow'):
+                release.wait(5)
+            with lock:
+                running.remove(name)
+            return ['192.0.2.1'], 300
+
+        names = ['fast%d.example.com' % i for i in range(20)]
+        names.append('slow.example.com')
+        names.append('slow2.example.com')
+        start = time.time()
+        try:
+            results, printed = self.resolve_names(
+                names, workers=4, deadline=0.5, resolve=resolve)
+        finally:
+            release.set()
+        self.assertTrue(time.time() - start < 3)
+        self.assertTrue(max(most) <= 4)
+        self.assertEqual(results['slow.example.com'], [])
+        self.assertEqual(printed, [
+            'No answer within 0.5 seconds for 2 host names, keeping their '
+            'last answers, if any: slow.example.com, slow2.example.com'])
+        self.assertEqual(
+            sum(1 for name in names if results[name] == ['192.0.2.1']),
+            20)
+
+
+if __name__ == '__main__':
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(NetblockDNSTests)
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+'''
+mirrormanager2 tests for the netblock index.
+'''
+
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+import mirrormanager2.lib.netblocks as netblocks
+
+FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(FOLDER, '..', 'mirrorlist'))
+
+try:
+    import mirrorlist_server
+except ImportError:
+    # the server needs radix and geoip2
+    mirrorlist_server = None
+
+
+def open_index(netblocks_file):
+    """ The index of netblocks_file, as bytes. """
+    index_file = netblocks_file + '.idx'
+    netblocks.dump_netblock_index(netblocks_file, index_file)
+    with open(index_file, 'rb') as f:
+        return f.read()
+
+
+class NetblocksTests(unittest.TestCase):
+    """ Netblock index tests. """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='mm2_netblocks')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_parse_prefix(self):
+        """ Test parsing the prefixes of the BGP dumps. """
+        self.assertEqual(
+            netblocks.parse_prefix('10.1.2.3/16'), (4, 0x0a010000, 16))
+        # abbreviated the way inet_aton() reads it
+        self.assertEqual(
+            netblocks.parse_prefix('12.0/16'), (4, 0x0c000000, 16))
+        self.assertEqual(
+            netblocks.parse_prefix('2001:db8::1/32'),
+            (6, 0x20010db8 << 96, 32))
+        for prefix in ('10.1.2.3', '10.1.2.3/33', 'foo/8', '::/129'):
+            self.assertRaises(ValueError, netblocks.parse_prefix, prefix)
+
+    def test_flatten_netblocks(self):
+        """ Test turning nested netblocks into ranges. """
+        ranges = netblocks.flatten_netblocks([
+            (0, 255, 24, 1),
+            (16, 31, 28, 2),
+            (16, 31, 28, 3),
+            (32, 47, 28, 4),
+            (512, 767, 24, 5),
+        ], 1023)
+        self.assertEqual(ranges, [
+            (0, ((24, 1),)),
+            (16, ((28, 3), (28, 2), (24, 1))),
+            (32, ((28, 4), (24, 1))),
+            (48, ((24, 1),)),
+            (256, ()),
+            (512, ((24, 5),)),
+            (768, ()),
+        ])
+        # the end of the address space
+        ranges = netblocks.flatten_netblocks([(0, 1023, 22, 1)], 1023)
+        self.assertEqual(ranges, [(0, ((22, 1),))])
+
+    def test_dump_netblock_index(self):
+        """ Test writing the index of a netblocks file. """
+        netblocks_file = os.path.join(self.path, 'global_netblocks.txt')
+        with open(netblocks_file, 'w') as f:
+            f.write('10.0.0.0/8 64500\n')
+            f.write('10.1.0.0/16 4200000000\n')
+            f.write('0.0.0.0/0 1\n')
+            f.write('garbage\n')
+            f.write('2001:db8::/32 64501\n')
+        index_file = netblocks_file + '.idx'
+        netblocks.dump_netblock_index(netblocks_file, index_file)
+
+        with open(index_file, 'rb') as f:
+            data = f.read()
+        header = netblocks.NETBLOCK_INDEX_HEADER
+        magic, version, n4, n6, nchains = header.unpack_from(data, 0)
+        self.assertEqual(magic, netblocks.NETBLOCK_INDEX_MAGIC)
+        self.assertEqual(version, netblocks.NETBLOCK_INDEX_VERSION)
+        self.assertEqual((n4, n6, nchains), (4, 2, 11))
+
+        offset = header.size
+        self.assertEqual(
+            struct.unpack_from('<4I', data, offset),
+            (0x0a000000, 0x0a010000, 0x0a020000, 0x0b000000))
+        self.assertEqual(
+            struct.unpack_from('<4i', data, offset + 16), (0, 3, 0, -1))
+        offset += 32
+        self.assertEqual(
+            struct.unpack_from('<2Q', data, offset),
+            (0x20010db800000000, 0x20010db900000000))
+        self.assertEqual(struct.unpack_from('<2Q', data, offset + 16), (0, 0))
+        self.assertEqual(
+            struct.unpack_from('<2i', data, offset + 32), (8, -1))
+        offset += 40
+        self.assertEqual(
+            struct.unpack_from('<11I', data, offset),
+            (1, 8, 64500, 2, 16, 4200000000, 8, 64500, 1, 32, 64501))
+        self.assertEqual(len(data), offset + 44)
+
+    @unittest.skipIf(mirrorlist_server is None, 'requires radix and geoip2')
+    def test_netblock_index_lookup(self):
+        """ Test that the index answers like the radix tree built of the
+        same netblocks file. """
+        rand = random.Random(3)
+        lines = [
+            # nested
+            '10.0.0.0/8 64500', '10.1.0.0/16 64501', '10.1.2.0/24 64502',
+            '10.1.2.128/25 64503', '10.1.2.129/32 64504',
+            # the same netblock twice, the last one counts
+            '12.1.0.0/16 7', '12.1.0.0/16 8',
+            # the ends of the address space
+            '0.0.0.0/8 64505', '255.255.255.0/24 64506',
+            '255.255.255.255/32 64507',
+            '::/16 64508', 'ffff::/16 64509',
+            'ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff/128 64510',
+            '2001:db8::/32 64511', '2001:db8:1::/48 64512',
+            '2001:db8:1:0:8000::/65 64513',
+            '0.0.0.0/0 1', 'garbage', '1.2.3.4/33 4',
+        ]
+        prefixes = []
+        for i in range(300):
+            length = rand.choice([8, 12, 16, 20, 24, 28, 32])
+            address = rand.getrandbits(32) >> (32 - length) << (32 - length)
+            prefixes.append((4, address, length))
+            length = rand.choice([16, 32, 48, 64, 96, 128])
+            address = (0x2001 << 112) | (rand.getrandbits(24) << 88)
+            address = address >> (128 - length) << (128 - length)
+            prefixes.append((6, address, length))
+        for version, address, length in prefixes:
+            ip = mirrorlist_server.ClientIP(version, address)
+            lines.append('%s/%d %d' % (
+                ip.strNormal(), length, rand.choice([64500, 64501, 65000])))
+        netblocks_file = os.path.join(self.path, 'global_netblocks.txt')
+        with open(netblocks_file, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        addresses = [(4, 0), (4, 2 ** 32 - 1), (6, 0), (6, 2 ** 128 - 1)]
+        for line in lines:
+            try:
+                version, address, length = netblocks.parse_prefix(
+                    line.split()[0])
+            except ValueError:
+                continue
+            bits = 32 if version == 4 else 128
+            last = address + 2 ** (bits - length) - 1
+            for value in (address - 1, address, (address + last) // 2,
+                          last, last + 1):
+                if 0 <= value < 2 ** bits:
+                    addresses.append((version, value))
+
+        for asns_wanted in (None, set([64501, 64503, 64509, 8])):
+            tree = mirrorlist_server.setup_netblocks(
+                netblocks_file, asns_wanted)
+            self.assertFalse(
+                isinstance(tree, mirrorlist_server.NetblockIndex))
+            netblocks.dump_netblock_index(
+                netblocks_file, netblocks_file + '.idx')
+            index = mirrorlist_server.setup_netblocks(
+                netblocks_file, asns_wanted)
+            self.assertTrue(
+                isinstance(index, mirrorlist_server.NetblockIndex))
+            found = 0
+            for version, value in addresses:
+                ip = mirrorlist_server.ClientIP(version, value)
+                asn = mirrorlist_server.lookup_ip_asn(tree, ip)
+                self.assertEqual(
+                    mirrorlist_server.lookup_ip_asn(index, ip), asn,
+                    ip.strNormal())
+                if asn is not None:
+                    found += 1
+            self.assertTrue(found > len(addresses) // 4)
+            os.unlink(netblocks_file + '.idx')
+
+        index = mirrorlist_server.NetblockIndex(
+            open_index(netblocks_file))
+        self.assertEqual(
+            index.covering(4, 0x0a010281),
+            [(32, 64504), (25, 64503), (24, 64502), (16, 64501),
+             (8, 64500)])
+        self.assertEqual(index.covering(4, 0x0b000000), [])
+        self.assertEqual(index.lookup_asn(4, 0x0c010000), 8)
+        self.assertEqual(index.lookup_asn(6, 2 ** 128 - 1), 64510)
+        self.assertEqual(index.lookup_asn(6, 2 ** 128 - 2), 64509)
+        self.assertEqual(index.lookup_asn(4, 2 ** 32 - 1), 64507)
+
+
+if __name__ == '__main__':
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(NetblocksTests)
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+'''
+mirrormanager2 tests for the request statistics of the mirrorlist server.
+'''
+
+import os
+import sys
+import unittest
+
+FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(FOLDER, '..', 'mirrorlist'))
+
+import server_stats
+
+
+class ServerStatsTests(unittest.TestCase):
+    """ Server statistics tests. """
+
+    def test_slots(self):
+        """ Test that the slots of all processes are added up. """
+        stats = server_stats.Stats(3)
+        stats.observe('netblocks', 0.00002)
+        stats.count('global')
+        stats.use_slot(2)
+        stats.observe('netblocks', 0.003)
+        stats.observe('netblocks', 5)
+        stats.count('global')
+        stats.count('netblocks')
+        stats.count('unknown')
+
+        totals = stats.totals()
+        offset = server_stats.STAGE_OFFSETS['netblocks']
+        histogram = totals[offset:offset + server_stats.HISTOGRAM_SIZE]
+        self.assertEqual(histogram[1], 1)
+        self.assertEqual(histogram[server_stats.BUCKETS.index(0.005)], 1)
+        self.assertEqual(histogram[-2], 1)
+        self.assertEqual(sum(histogram[:-1]), 3)
+        self.assertAlmostEqual(histogram[-1], 5.00302)
+        self.assertEqual(
+            totals[server_stats.SOURCE_OFFSETS['global']], 2)
+        self.assertEqual(
+            totals[server_stats.SOURCE_OFFSETS['netblocks']], 1)
+
+    def test_render(self):
+        """ Test the Prometheus text format. """
+        stats = server_stats.Stats(1)
+        clock = stats.clock()
+        clock.lap('lookup')
+        clock.answered('geoip')
+        clock.done()
+        text = stats.render([
+            ('mirrorlist_cache_section_load_seconds', 'gauge', 'Sections.',
+             {'section="read"': 0.5, 'section="compact"': 0.25}),
+            ('mirrorlist_cache_loads_total', 'counter', 'Loads.', 2)])
+        lines = text.splitlines()
+        self.assertIn(
+            'mirrorlist_stage_seconds_bucket{stage="lookup",le="+Inf"} 1',
+            lines)
+        self.assertIn(
+            'mirrorlist_stage_seconds_count{stage="total"} 1', lines)
+        self.assertIn(
+            'mirrorlist_stage_seconds_count{stage="read"} 0', lines)
+        self.assertIn('mirrorlist_answers_total{source="geoip"} 1', lines)
+        self.assertIn('# TYPE mirrorlist_cache_loads_total counter', lines)
+        self.assertIn(
+            'mirrorlist_cache_section_load_seconds{section="read"} 0.5',
+            lines)
+        self.assertEqual(lines[-1], 'mirrorlist_cache_loads_total 2')
+        # the buckets are cumulative
+        buckets = [
+            int(line.split()[-1]) for line in lines
+            if line.startswith('mirrorlist_stage_seconds_bucket'
+                               '{stage="lookup"')]
+        self.assertEqual(buckets, sorted(buckets))
+        self.assertEqual(len(buckets), len(server_stats.BUCKETS) + 1)
+
+        # the clock of disabled statistics does nothing
+        clock = server_stats.null_clock
+        clock.lap('lookup')
+        clock.answered('geoip')
+        clock.done()
+
+
+if __name__ == '__main__':
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(ServerStatsTests)
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
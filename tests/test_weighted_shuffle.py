@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+'''
+mirrormanager2 tests for the weighted shuffle used by the mirrorlist server.
+'''
+
+import itertools
+import os
+import random
+import sys
+import unittest
+
+FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(FOLDER, '..', 'mirrorlist'))
+
+import weighted_shuffle
+
+
+# chi-square critical values for p = 0.001, indexed by degrees of freedom
+CHI2_CRITICAL = {3: 16.266, 5: 20.515, 23: 49.728}
+
+
+def permutation_probability(weights):
+    """ Probability of drawing the weights in the given order when
+    repeatedly picking one item with a probability proportional to its
+    weight and removing it (the reference O(n^2) algorithm).
+    """
+    probability = 1.0
+    remaining = sum(weights)
+    for weight in weights:
+        probability *= float(weight) / remaining
+        remaining -= weight
+    return probability
+
+
+def chi_square(observed, expected):
+    return sum(
+        (observed.get(key, 0) - value) ** 2 / value
+        for key, value in expected.items())
+
+
+class WeightedShuffleTests(unittest.TestCase):
+    """ Weighted shuffle tests. """
+
+    def setUp(self):
+        random.seed(1234)
+
+    def test_weighted_shuffle_keeps_items(self):
+        """ Test that weighted_shuffle returns a permutation of its input.
+        """
+        items = [(1000, 1), (1000, 2), (100, 3), (100, 4), (10, 5), (1, 6)]
+        result = weighted_shuffle.weighted_shuffle(items)
+        self.assertEqual(sorted(result), sorted(items))
+        self.assertEqual(weighted_shuffle.weighted_shuffle([]), [])
+
+    def test_weighted_shuffle_clamps_weights(self):
+        """ Test that invalid weights are treated as a weight of 1. """
+        result = weighted_shuffle.weighted_shuffle(
+            [(0, 'a'), (-5, 'b'), (None, 'c'), ('10', 'd'), (7, 'e')])
+        self.assertEqual(
+            sorted(result),
+            [(1, 'a'), (1, 'b'), (1, 'c'), (1, 'd'), (7, 'e')])
+
+    def test_weighted_order(self):
+        """ Test weighted_order with a weight lookup table. """
+        weights = {1: 10000, 2: 1, 3: 0}
+        result = weighted_shuffle.weighted_order([3, 2, 1], weights)
+        self.assertEqual(sorted(result), [1, 2, 3])
+        self.assertEqual(weighted_shuffle.weighted_order([], weights), [])
+
+    def test_permutation_distribution(self):
+        """ Test that every permutation is drawn with the same probability
+        as with the sequential weighted sampling.
+        """
+        items = [(3, 'a'), (2, 'b'), (1, 'c')]
+        rounds = 60000
+        observed = {}
+        for _ in range(rounds):
+            order = tuple(
+                data for (weight, data) in
+                weighted_shuffle.weighted_shuffle(items))
+            observed[order] = observed.get(order, 0) + 1
+
+        expected = {}
+        for perm in itertools.permutations(items):
+            key = tuple(data for (weight, data) in perm)
+            expected[key] = rounds * permutation_probability(
+                [weight for (weight, data) in perm])
+        self.assertEqual(set(observed), set(expected))
+        self.assertLess(chi_square(observed, expected), CHI2_CRITICAL[5])
+
+    def test_permutation_distribution_bandwidths(self):
+        """ Test the distribution of complete orders for weights spread
+        like mirror bandwidths.
+        """
+        weights = {1: 1000, 2: 100, 3: 100, 4: 10}
+        rounds = 100000
+        observed = {}
+        for _ in range(rounds):
+            order = tuple(weighted_shuffle.weighted_order(
+                sorted(weights), weights))
+            observed[order] = observed.get(order, 0) + 1
+
+        expected = {}
+        for perm in itertools.permutations(sorted(weights)):
+            expected[perm] = rounds * permutation_probability(
+                [weights[hostid] for hostid in perm])
+        self.assertLess(chi_square(observed, expected), CHI2_CRITICAL[23])
+
+    def test_first_position_distribution(self):
+        """ Test how often every item comes first. """
+        weights = {1: 50, 2: 30, 3: 15, 4: 5}
+        rounds = 40000
+        observed = {}
+        for _ in range(rounds):
+            first = weighted_shuffle.weighted_order(weights, weights)[0]
+            observed[first] = observed.get(first, 0) + 1
+        total = float(sum(weights.values()))
+        expected = dict(
+            (hostid, rounds * weight / total)
+            for hostid, weight in weights.items())
+        self.assertLess(chi_square(observed, expected), CHI2_CRITICAL[3])
+
+
+if __name__ == '__main__':
+    SUITE = unittest.TestLoader().loadTestsFromTestCase(WeightedShuffleTests)
+    unittest.TextTestRunner(verbosity=2).run(SUITE)
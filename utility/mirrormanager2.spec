@@ -270,8 +270,22 @@ install -m 644 mirrorlist/mirrorlist_server.py \
     $RPM_BUILD_ROOT/%{_datadir}/mirrormanager2/mirrorlist_server.py
 install -m 644 mirrorlist/weighted_shuffle.py \
     $RPM_BUILD_ROOT/%{_datadir}/mirrormanager2/weighted_shuffle.py
+install -m 644 mirrorlist/host_vectors.py \
+    $RPM_BUILD_ROOT/%{_datadir}/mirrormanager2/host_vectors.py
+install -m 644 mirrorlist/host_load.py \
+    $RPM_BUILD_ROOT/%{_datadir}/mirrormanager2/host_load.py
+install -m 644 mirrorlist/async_log.py \
+    $RPM_BUILD_ROOT/%{_datadir}/mirrormanager2/async_log.py
+install -m 644 mirrorlist/server_stats.py \
+    $RPM_BUILD_ROOT/%{_datadir}/mirrormanager2/server_stats.py
+install -m 644 mirrorlist/admission.py \
+    $RPM_BUILD_ROOT/%{_datadir}/mirrormanager2/admission.py
 install -m 644 mirrorlist/mirrormanager_pb2.py \
     $RPM_BUILD_ROOT/%{_datadir}/mirrormanager2/mirrormanager_pb2.py
+install -m 644 mirrorlist/mirrorlist_protocol.py \
+    $RPM_BUILD_ROOT/%{_datadir}/mirrormanager2/mirrorlist_protocol.py
+install -m 644 mirrorlist/mirrorlist_http.py \
+    $RPM_BUILD_ROOT/%{_datadir}/mirrormanager2/mirrorlist_http.py
 
 # Install the createdb script
 install -m 644 createdb.py \
@@ -406,11 +420,25 @@ MM2_SKIP_NETWORK_TESTS=1 ./runtests.sh -v
 %{_datadir}/mirrormanager2/mirrorlist_client.wsgi
 %{_datadir}/mirrormanager2/mirrorlist_server.py*
 %{_datadir}/mirrormanager2/weighted_shuffle.py*
+%{_datadir}/mirrormanager2/host_vectors.py*
+%{_datadir}/mirrormanager2/host_load.py*
+%{_datadir}/mirrormanager2/async_log.py*
+%{_datadir}/mirrormanager2/server_stats.py*
+%{_datadir}/mirrormanager2/admission.py*
 %{_datadir}/mirrormanager2/mirrormanager_pb2.py*
+%{_datadir}/mirrormanager2/mirrorlist_protocol.py*
+%{_datadir}/mirrormanager2/mirrorlist_http.py*
 %if ! (0%{?rhel} && 0%{?rhel} <= 7)
 %{_datadir}/mirrormanager2/__pycache__/mirrorlist_server.*.py*
 %{_datadir}/mirrormanager2/__pycache__/weighted_shuffle.*.py*
+%{_datadir}/mirrormanager2/__pycache__/host_vectors.*.py*
+%{_datadir}/mirrormanager2/__pycache__/host_load.*.py*
+%{_datadir}/mirrormanager2/__pycache__/async_log.*.py*
+%{_datadir}/mirrormanager2/__pycache__/server_stats.*.py*
+%{_datadir}/mirrormanager2/__pycache__/admission.*.py*
 %{_datadir}/mirrormanager2/__pycache__/mirrormanager_pb2.*.py*
+%{_datadir}/mirrormanager2/__pycache__/mirrorlist_protocol.*.py*
+%{_datadir}/mirrormanager2/__pycache__/mirrorlist_http.*.py*
 %endif
 
 
@@ -430,6 +458,7 @@ MM2_SKIP_NETWORK_TESTS=1 ./runtests.sh -v
 %attr(755,mirrormanager,mirrormanager) %dir %{_localstatedir}/run/mirrormanager
 %{_tmpfilesdir}/%{name}-backend.conf
 %{_datadir}/mirrormanager2/zebra-dump-parser/
+%{_bindir}/mm2_build_netblock_index
 %{_bindir}/mm2_emergency-expire-repo
 %{_bindir}/mm2_get_global_netblocks
 %{_bindir}/mm2_get_internet2_netblocks